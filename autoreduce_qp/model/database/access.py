@@ -6,12 +6,25 @@
 # ############################################################################### #
 """Common functions for accessing and creating records in the database."""
 # pylint:disable=no-member
+import copy
 import os
+import threading
+from collections import OrderedDict
+import time
 from functools import wraps
-from typing import List, Union
+from typing import Callable, Collection, Dict, List, Optional, Tuple, TypeVar, Union
 from django.db import transaction, connection, OperationalError, InterfaceError
+from django.db.models import Count, Max, Q, QuerySet
 
-from autoreduce_db.reduction_viewer.models import Software, Status, Experiment, Instrument
+from autoreduce_db.reduction_viewer.models import Software, Status, Experiment, Instrument, ReductionRun, RunNumber
+from autoreduce_qp.queue_processor.metrics import REFERENCE_CACHE_LOOKUPS
+
+# The number of seconds statuses, instruments and software are cached for. This
+# is how long a change to an instrument, e.g. pausing it, can take to be seen.
+# Set to 0 to turn the cache off
+REFERENCE_CACHE_TTL = float(os.getenv("AUTOREDUCE_QP_REFERENCE_CACHE_TTL", "60"))
+
+T = TypeVar("T")
 
 
 # Adapted from the following github repository using an MIT license:
@@ -37,12 +50,71 @@ def check_mysql_gone_away(function):
     return wrapper
 
 
-@check_mysql_gone_away
-@transaction.atomic
+class ReferenceCache:
+    """
+    A process-local cache of the records that almost never change, so that
+    handling a run doesn't need a query for each of them. Entries expire after
+    `ttl` seconds and can be invalidated explicitly. Safe to share between
+    threads.
+
+    Entries are keyed on a tuple of the kind of record followed by the values
+    it was looked up with, e.g. ("instrument", "GEM"). If `max_size` is given,
+    the least recently used entries are evicted to keep to it.
+
+    Each lookup returns a copy of the cached record, so that a caller changing
+    its record doesn't change the record seen by everyone else.
+    """
+
+    def __init__(self, ttl: float = REFERENCE_CACHE_TTL, max_size: Optional[int] = None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple, Tuple[float, object]] = OrderedDict()
+
+    def get(self, key: Tuple, load: Callable[[], T]) -> T:
+        """Return the cached record for the key, calling `load` to get it if it isn't cached or has expired."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                REFERENCE_CACHE_LOOKUPS.inc(kind=key[0], result="hit")
+                return copy.copy(entry[1])
+            self.misses += 1
+        REFERENCE_CACHE_LOOKUPS.inc(kind=key[0], result="miss")
+
+        record = load()
+        if self.ttl > 0 and self.max_size != 0:
+            with self._lock:
+                self._entries[key] = (now + self.ttl, record)
+                self._entries.move_to_end(key)
+                if self.max_size is not None and len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+            return copy.copy(record)
+        return record
+
+    def invalidate(self, *key):
+        """
+        Remove the entries whose key starts with the given values, e.g.
+        `invalidate("instrument", "GEM")` for one instrument,
+        `invalidate("instrument")` for every instrument, or `invalidate()` for
+        everything.
+        """
+        with self._lock:
+            for cached_key in [cached_key for cached_key in self._entries if cached_key[:len(key)] == key]:
+                del self._entries[cached_key]
+
+
+REFERENCE_CACHE = ReferenceCache()
+
+
 def get_instrument(instrument_name: str) -> Instrument:
     """
     Find the instrument record associated with the name provided in the
-    database.
+    database. Cached in REFERENCE_CACHE.
 
     Args:
         instrument_name: The name of the instrument to search for.
@@ -50,6 +122,12 @@ def get_instrument(instrument_name: str) -> Instrument:
     Returns:
         The instrument object from the database.
     """
+    return REFERENCE_CACHE.get(("instrument", instrument_name), lambda: _get_instrument(instrument_name))
+
+
+@check_mysql_gone_away
+@transaction.atomic
+def _get_instrument(instrument_name: str) -> Instrument:
     instrument, _ = Instrument.objects.get_or_create(name=instrument_name)
     return instrument
 
@@ -74,11 +152,10 @@ def get_all_instrument_names() -> List[str]:
     return list(Instrument.objects.values_list("name", flat=True))
 
 
-@check_mysql_gone_away
-@transaction.atomic
 def get_status(status_value: str) -> Status:
     """
     Find the status record associated with the value provided in the database.
+    Cached in REFERENCE_CACHE.
 
     Args:
         status_value: The value of the status record e.g. 'Completed'.
@@ -94,6 +171,12 @@ def get_status(status_value: str) -> Status:
     if status_value not in ['e', 'q', 'p', 'c', 's']:
         raise ValueError("Invalid status value passed")
 
+    return REFERENCE_CACHE.get(("status", status_value), lambda: _get_status(status_value))
+
+
+@check_mysql_gone_away
+@transaction.atomic
+def _get_status(status_value: str) -> Status:
     return Status.objects.get_or_create(value=status_value)[0]
 
 
@@ -113,11 +196,10 @@ def get_experiment(rb_number: str) -> Experiment:
     return Experiment.objects.get_or_create(reference_number=rb_number)[0]
 
 
-@check_mysql_gone_away
-@transaction.atomic
 def get_software(name: str, version: str) -> Software:
     """
     Find the Software record associated with the name and version provided.
+    Cached in REFERENCE_CACHE, apart from unsupported software.
 
     Args:
         name: The name of the software.
@@ -126,6 +208,12 @@ def get_software(name: str, version: str) -> Software:
     Return:
         The Software object from the database
     """
+    return REFERENCE_CACHE.get(("software", name, version), lambda: _get_software(name, version))
+
+
+@check_mysql_gone_away
+@transaction.atomic
+def _get_software(name: str, version: str) -> Software:
     # If running in test env, create and delete a test software record
     if "AUTOREDUCTION_PRODUCTION" not in os.environ:
         return Software.objects.get_or_create(name=name, version=version)[0]
@@ -135,10 +223,49 @@ def get_software(name: str, version: str) -> Software:
         return Software.objects.get(name=name, version=version)
 
 
+def lock_experiment(experiment: Experiment) -> Experiment:
+    """
+    Lock the experiment's row until the end of the current transaction, so that
+    no other queue processor can allocate a run version for the experiment
+    until this one has created its run. Must be called inside
+    transaction.atomic, before the highest run version is looked up.
+
+    Args:
+        experiment: The experiment to lock.
+
+    Returns:
+        The experiment, as read with the lock held.
+    """
+    return Experiment.objects.select_for_update().get(pk=experiment.pk)
+
+
+def batch_runs_matching(reduction_runs: QuerySet, run_numbers: List[int]) -> QuerySet:
+    """
+    Filter runs down to the batch runs that span exactly the given run numbers,
+    in a single query rather than comparing the run numbers of each run.
+
+    Args:
+        reduction_runs: The runs to filter, e.g. an experiment's runs.
+        run_numbers: The run numbers of the batch run.
+
+    Returns:
+        The matching batch runs.
+    """
+    run_numbers = set(run_numbers)
+    # A run matches if it has as many run numbers as the batch, and all of them are in the batch
+    return reduction_runs.filter(batch_run=True).annotate(
+        total_run_numbers=Count("run_numbers__run_number", distinct=True),
+        matching_run_numbers=Count("run_numbers__run_number",
+                                   filter=Q(run_numbers__run_number__in=run_numbers),
+                                   distinct=True)).filter(total_run_numbers=len(run_numbers),
+                                                          matching_run_numbers=len(run_numbers))
+
+
 @check_mysql_gone_away
 def find_highest_run_version(experiment: str, run_number: Union[int, List[int]]) -> int:
     """
-    Search for the highest run version in the database.
+    Search for the highest run version in the database. Takes one query,
+    however many runs the experiment has.
 
     Args:
         experiment: The experiment number associated with the run.
@@ -147,31 +274,95 @@ def find_highest_run_version(experiment: str, run_number: Union[int, List[int]])
     Returns:
         The highest known run version for a given run number.
     """
-    last_run = None
     if isinstance(run_number, int):
-        last_run = experiment.reduction_runs.filter(run_numbers__run_number=run_number).order_by('-run_version').first()
+        runs = experiment.reduction_runs.filter(run_numbers__run_number=run_number)
     else:
-        # filter the batch runs that contain any of the run numbers in the list
-        runs_containing_run_numbers = experiment.reduction_runs.filter(
-            batch_run=True, run_numbers__run_number__in=run_number).order_by('-run_version').distinct()
-
-        # now find one that matches all run numbers inside the list.
-        # If any mismatch then this is is considered a new batch run
-        for run in runs_containing_run_numbers:
-            # converts the RunNumber DB objects to a list of run numbers,
-            # then compares with the ones we are looking for
-            if [run_number_obj.run_number for run_number_obj in run.run_numbers.all()] == run_number:
-                last_run = run
-                # the runs are ordered by highest run_number, so we can break out
-                # as soon as a matching run_number list is found
-                break
-
-    if last_run:  # previous run exists - increment version by 1 for this run
-        return last_run.run_version + 1
+        runs = batch_runs_matching(experiment.reduction_runs.all(), run_number)
+
+    last_version = runs.aggregate(last_version=Max("run_version"))["last_version"]
+    if last_version is not None:  # previous run exists - increment version by 1 for this run
+        return last_version + 1
     else:  # previous run doesn't exist - start at 0
         return 0
 
 
+@check_mysql_gone_away
+def find_requeued_run(experiment: Experiment, instrument: Instrument,
+                      run_number: Union[int, List[int]]) -> Optional[ReductionRun]:
+    """
+    Search for a run that was requeued when the queue processor was stopped
+    part way through reducing it. These are the only queued runs that have a
+    start time.
+
+    Args:
+        experiment: The experiment associated with the run.
+        instrument: The instrument associated with the run.
+        run_number: The run number, or list of run numbers for a batch run.
+
+    Returns:
+        The requeued run, or None if there isn't one.
+    """
+    requeued_runs = experiment.reduction_runs.filter(instrument=instrument,
+                                                     status=get_status('q'),
+                                                     started__isnull=False).order_by('run_version')
+    if isinstance(run_number, int):
+        return requeued_runs.filter(batch_run=False, run_numbers__run_number=run_number).first()
+
+    return batch_runs_matching(requeued_runs, run_number).first()
+
+
+@check_mysql_gone_away
+def find_highest_run_versions(experiment_ids: Collection[int],
+                              run_numbers: Collection[int]) -> Dict[Tuple[int, int], int]:
+    """
+    Search for the highest run versions of several runs at once, in a single
+    query, e.g. for a batch of messages.
+
+    Args:
+        experiment_ids: The primary keys of the experiments of the runs.
+        run_numbers: The run numbers of the runs.
+
+    Returns:
+        The version for the next run of each experiment and run number that has
+        runs already, by experiment primary key and run number. The rest start
+        at version 0, as with find_highest_run_version.
+    """
+    last_versions = RunNumber.objects.filter(reduction_run__experiment_id__in=experiment_ids,
+                                             run_number__in=run_numbers).values(
+                                                 "reduction_run__experiment_id",
+                                                 "run_number").annotate(last_version=Max("reduction_run__run_version"))
+    return {(row["reduction_run__experiment_id"], row["run_number"]): row["last_version"] + 1 for row in last_versions}
+
+
+@check_mysql_gone_away
+def find_requeued_runs(experiment_ids: Collection[int],
+                       run_numbers: Collection[int]) -> Dict[Tuple[int, int, int], ReductionRun]:
+    """
+    Search for the requeued runs of several runs at once, in a single query, as
+    with find_requeued_run. Batch runs are not included.
+
+    Args:
+        experiment_ids: The primary keys of the experiments of the runs.
+        run_numbers: The run numbers of the runs.
+
+    Returns:
+        The requeued runs by the primary keys of their experiment and
+        instrument, and their run number.
+    """
+    requeued = RunNumber.objects.filter(
+        reduction_run__experiment_id__in=experiment_ids,
+        reduction_run__status=get_status('q'),
+        reduction_run__started__isnull=False,
+        reduction_run__batch_run=False,
+        run_number__in=run_numbers).select_related("reduction_run").order_by("reduction_run__run_version")
+    requeued_runs = {}
+    for run_number in requeued:
+        reduction_run = run_number.reduction_run
+        requeued_runs.setdefault((reduction_run.experiment_id, reduction_run.instrument_id, run_number.run_number),
+                                 reduction_run)
+    return requeued_runs
+
+
 @check_mysql_gone_away
 def save_record(record):
     """
@@ -7,20 +7,41 @@
 # ############################################################################ #
 """Contains various helper methods for managing or creating ORM records."""
 # pylint:disable=no-member,redefined-builtin
+import hashlib
 import json
 import logging
+import math
+import os
 import socket
-from typing import List, Optional, Tuple, Union
+from typing import List, NamedTuple, Optional, Tuple, Union
 
+from django.db import DatabaseError, connections, transaction
 from django.utils import timezone
 import requests
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, RequestException, Timeout
 
 from autoreduce_db.reduction_viewer.models import (DataLocation, Experiment, Instrument, ReductionArguments,
                                                    ReductionScript, RunNumber, ReductionRun, Status, Software)
+from autoreduce_qp.model.database.access import REFERENCE_CACHE_TTL, ReferenceCache
 from autoreduce_qp.queue_processor.reduction.service import ReductionScript as ReductionScriptFile
+from autoreduce_qp.queue_processor.remote_files import REMOTE_FILES, RemoteFile
+from autoreduce_qp.queue_processor.script_files import SCRIPT_FILES, text_digest
+from autoreduce_qp.queue_processor.stage_timing import stage
 from autoreduce_qp.queue_processor.variable_utils import VariableUtils
 
+# The number of reduction scripts whose records are cached by the digest of
+# their text. Set to 0 to turn the cache off
+SCRIPT_CACHE_SIZE = int(os.getenv("AUTOREDUCE_QP_SCRIPT_CACHE_SIZE", "256"))
+# Scripts are never changed, only added, so their entries don't expire
+SCRIPT_CACHE = ReferenceCache(ttl=math.inf, max_size=SCRIPT_CACHE_SIZE)
+# The number of argument sets whose records are cached, by instrument and the
+# digest of their canonical JSON. They can be edited from the webapp, so their
+# entries expire like those of the reference cache
+ARGUMENTS_CACHE_SIZE = int(os.getenv("AUTOREDUCE_QP_ARGUMENTS_CACHE_SIZE", "1024"))
+ARGUMENTS_CACHE = ReferenceCache(ttl=REFERENCE_CACHE_TTL, max_size=ARGUMENTS_CACHE_SIZE)
+# The number of rows inserted by each query when records are created in bulk
+BULK_CREATE_BATCH_SIZE = int(os.getenv("AUTOREDUCE_QP_BULK_CREATE_BATCH_SIZE", "500"))
+
 logger = logging.getLogger(__file__)
 
 
@@ -63,11 +84,11 @@ def get_script_and_arguments(instrument: Instrument, script: str, arguments: dic
         dictionary, and any error messages encountered.
     """
     if not script:
-        rscript = ReductionScriptFile(instrument)
-        script = rscript.text()
+        script = SCRIPT_FILES.read(ReductionScriptFile(instrument)).text
 
     if not arguments:
-        arguments = VariableUtils.get_default_variables(instrument)
+        with stage("load_default_arguments"):
+            arguments = VariableUtils.get_default_variables(instrument)
 
     error_msgs = fetch_from_remote_source(arguments)
     arguments_str = json.dumps(arguments, separators=(',', ':'))
@@ -77,7 +98,7 @@ def get_script_and_arguments(instrument: Instrument, script: str, arguments: dic
 def fetch_from_remote_source(arguments: dict) -> Optional[str]:
     """
     Search through a supplied dictionary and fetch the content of any raw GitHub
-    files.
+    files. The files are fetched at the same time, and cached, by REMOTE_FILES.
 
     Args:
         arguments: Reduction arguments that will be used for the reduction.
@@ -91,6 +112,7 @@ def fetch_from_remote_source(arguments: dict) -> Optional[str]:
         heading_value: {"url": <GitHub path>, "default": "mari_res2013.map"}
     """
     error_msgs = []
+    remote_files = []
     for category, headings in arguments.items():
         for heading, heading_value in headings.items():
 
@@ -109,29 +131,107 @@ def fetch_from_remote_source(arguments: dict) -> Optional[str]:
                 if errored:
                     continue
 
-                url = heading_value["url"] + heading_value["default"]
-
-                try:
-                    req = requests.get(url)
-                    status = req.status_code
-                    if status == requests.codes.ok:
-                        arguments[category][heading]["value"] = req.text
-                    elif status == requests.codes.forbidden:
-                        error_msgs.append(f"cannot access {url} for {heading} under {category}")
-                    elif status == requests.codes.not_found:
-                        error_msgs.append(f"cannot find {url} for {heading} under {category}")
-                    else:
-                        error_msgs.append(f"{status} error at {url} for {heading} under {category}")
-                except ConnectionError:
-                    error_msgs.append(f"could not connect to remote source at {url} for {heading} under {category}")
+                remote_files.append((category, heading, heading_value["url"] + heading_value["default"]))
+
+    fetched = {}
+    if remote_files:
+        with stage("fetch_remote_files"):
+            fetched = REMOTE_FILES.fetch_all(url for _, _, url in remote_files)
+    for category, heading, url in remote_files:
+        result = fetched[url]
+        if isinstance(result, RemoteFile) and result.status_code == requests.codes.ok:
+            arguments[category][heading]["value"] = result.text
+        else:
+            error_msgs.append(f"{_remote_source_error(result, url)} for {heading} under {category}")
 
     return (", ".join(error_msgs)).capitalize() if error_msgs else None
 
 
+def _remote_source_error(result: Union[RemoteFile, RequestException], url: str) -> str:
+    """Describe why a remote file could not be fetched."""
+    if isinstance(result, ConnectionError):
+        return f"could not connect to remote source at {url}"
+    if isinstance(result, Timeout):
+        return f"timed out fetching remote source at {url}"
+    if isinstance(result, RequestException):
+        return f"could not fetch remote source at {url}: {result}"
+    if result.status_code == requests.codes.forbidden:
+        return f"cannot access {url}"
+    if result.status_code == requests.codes.not_found:
+        return f"cannot find {url}"
+    return f"{result.status_code} error at {url}"
+
+
+def get_or_create_script(text: str, digest: Optional[str] = None) -> ReductionScript:
+    """
+    Return the ReductionScript record with the given text, creating it if there
+    isn't one. The primary key of the record is cached by the SHA-256 digest of
+    the text, so only the first lookup of a script compares its text against
+    the table.
+
+    Args:
+        text: The text of the reduction script.
+        digest: The SHA-256 digest of the text, if it is already known.
+
+    Returns:
+        The ReductionScript record.
+    """
+    if digest is None:
+        digest = text_digest(text)
+    script_id = SCRIPT_CACHE.get(("script", digest), lambda: ReductionScript.objects.get_or_create(text=text)[0].pk)
+    return ReductionScript(pk=script_id, text=text)
+
+
+def canonical_arguments_json(arguments: dict) -> str:
+    """Return reduction arguments as compact JSON with sorted keys, so equal arguments always give the same text."""
+    return json.dumps(arguments, separators=(',', ':'), sort_keys=True)
+
+
+def get_or_create_arguments(instrument: Instrument, arguments_json: str) -> ReductionArguments:
+    """
+    Return the instrument's ReductionArguments record with the given arguments,
+    creating it with canonical JSON if there isn't one. The primary key of the
+    record is cached by the instrument and the SHA-256 digest of the canonical
+    JSON, so that recently used arguments are found without a query whatever
+    order their keys are in.
+
+    Args:
+        instrument: The instrument the arguments are for.
+        arguments_json: The arguments as JSON.
+
+    Returns:
+        The ReductionArguments record.
+    """
+    raw = canonical_arguments_json(json.loads(arguments_json))
+
+    def load():
+        # Arguments saved before they were canonicalised have their keys in the
+        # order they were given
+        arguments = instrument.arguments.filter(raw__in={raw, arguments_json}).order_by("pk").first()
+        if arguments is None:
+            arguments = instrument.arguments.create(raw=raw)
+        return arguments.pk, arguments.raw
+
+    digest = hashlib.sha256(raw.encode("utf_8")).hexdigest()
+    arguments_id, stored_raw = ARGUMENTS_CACHE.get(("arguments", instrument.pk, digest), load)
+    return ReductionArguments(pk=arguments_id, raw=stored_raw, instrument=instrument)
+
+
+def invalidate_caches():
+    """Empty the caches of scripts and arguments."""
+    SCRIPT_FILES.clear()
+    SCRIPT_CACHE.invalidate()
+    ARGUMENTS_CACHE.invalidate()
+
+
 def _make_script_and_arguments(experiment: Experiment, instrument: Instrument, message, batch_run: bool):
-    script, arguments_json, error_msgs = get_script_and_arguments(instrument, message.reduction_script,
-                                                                  message.reduction_arguments)
-    script, _ = ReductionScript.objects.get_or_create(text=script)
+    script, digest = message.reduction_script, None
+    if not script:
+        # The script on disk is cached with its digest, so it is neither read nor hashed again until it changes
+        with stage("read_script"):
+            script, digest = SCRIPT_FILES.read(ReductionScriptFile(instrument))
+    script, arguments_json, error_msgs = get_script_and_arguments(instrument, script, message.reduction_arguments)
+    script = get_or_create_script(script, digest)
 
     if message.reduction_arguments is None and not batch_run:
         # Branch when a new run is submitted - find args from pre-configured new
@@ -152,43 +252,69 @@ def _make_script_and_arguments(experiment: Experiment, instrument: Instrument, m
                 # The arguments don't seem to exist, create a new object with
                 # the defaults from reduce_vars get_or_create is used so that if
                 # they match with any previous args they are still re-used
-                arguments, _ = instrument.arguments.get_or_create(raw=arguments_json)
+                arguments = get_or_create_arguments(instrument, arguments_json)
     else:
         # Branch for reruns and batch runs
-        arguments, _ = instrument.arguments.get_or_create(raw=arguments_json)
+        arguments = get_or_create_arguments(instrument, arguments_json)
 
     return script, arguments, error_msgs
 
 
-def create_reduction_run_record(experiment: Experiment, instrument: Instrument, message, run_version: int,
-                                status: Status, software: Software):
+class ScriptAndArguments(NamedTuple):
+    """The script and arguments records of a new run, and any errors met finding them."""
+    script: ReductionScript
+    arguments: ReductionArguments
+    error_msgs: Optional[str]
+
+
+def find_script_and_arguments(experiment: Experiment, instrument: Instrument, message) -> ScriptAndArguments:
     """
-    Create an ORM record for the given reduction run and return this record
-    without saving it to the DB.
+    Find, or create, the script and arguments records that a new run for the
+    message would have. This reads the script and default arguments and
+    fetches remote files, so should be done before any rows are locked.
     """
-    time_now = timezone.now()
-    batch_run = isinstance(message.run_number, list)
-    script, arguments, error_msgs = _make_script_and_arguments(experiment, instrument, message, batch_run)
-    reduction_run = ReductionRun.objects.create(run_version=run_version,
-                                                run_title=message.run_title,
-                                                run_description=message.description,
-                                                hidden_in_failviewer=0,
-                                                admin_log='',
-                                                reduction_log='',
-                                                created=time_now,
-                                                last_updated=time_now,
-                                                experiment=experiment,
-                                                instrument=instrument,
-                                                status_id=status.id,
-                                                started_by=message.started_by,
-                                                reduction_host=socket.getfqdn(),
-                                                batch_run=batch_run,
-                                                script=script,
-                                                software=software,
-                                                arguments=arguments)
-    _make_run_numbers(reduction_run, message.run_number)
-    _make_data_locations(reduction_run, message.data)
+    return ScriptAndArguments(
+        *_make_script_and_arguments(experiment, instrument, message, isinstance(message.run_number, list)))
 
+
+class NewRun(NamedTuple):
+    """
+    A run to create the records of with create_reduction_run_records. Its
+    script and arguments are found when it is created if they aren't given.
+    """
+    experiment: Experiment
+    instrument: Instrument
+    message: object
+    run_version: int
+    software: Software
+    script_and_arguments: Optional[ScriptAndArguments] = None
+
+
+def _reduction_run_fields(new_run: NewRun, status: Status, script: ReductionScript, arguments: ReductionArguments,
+                          time_now, reduction_host: str) -> dict:
+    """Return the fields of a new ReductionRun record."""
+    return dict(run_version=new_run.run_version,
+                run_title=new_run.message.run_title,
+                run_description=new_run.message.description,
+                hidden_in_failviewer=0,
+                admin_log='',
+                reduction_log='',
+                created=time_now,
+                last_updated=time_now,
+                experiment=new_run.experiment,
+                instrument=new_run.instrument,
+                status_id=status.id,
+                started_by=new_run.message.started_by,
+                reduction_host=reduction_host,
+                batch_run=isinstance(new_run.message.run_number, list),
+                script=script,
+                software=new_run.software,
+                arguments=arguments)
+
+
+def _update_message(new_run: NewRun, script: ReductionScript, arguments: ReductionArguments, error_msgs: Optional[str]):
+    """Update the message with the values of its new run."""
+    message = new_run.message
     # Changes the message values as they are used going forwards in the
     # ReductionRunner
     message.reduction_script = script.text
@@ -198,8 +324,118 @@ def create_reduction_run_record(experiment: Experiment, instrument: Instrument,
     # passed into the reduction execution and there is no other source of a
     # run_version. The run_version is used to create the output folder name, if
     # flat_output is False
-    message.run_version = run_version
-    message.flat_output = instrument.is_flat_output
+    message.run_version = new_run.run_version
+    message.flat_output = new_run.instrument.is_flat_output
 
     message.message = error_msgs
+
+
+def create_reduction_run_record(experiment: Experiment,
+                                instrument: Instrument,
+                                message,
+                                run_version: int,
+                                status: Status,
+                                software: Software,
+                                script_and_arguments: Optional[ScriptAndArguments] = None):
+    """
+    Create an ORM record for the given reduction run and return this record
+    without saving it to the DB. The script and arguments are found as by
+    find_script_and_arguments if they aren't given.
+    """
+    time_now = timezone.now()
+    batch_run = isinstance(message.run_number, list)
+    if script_and_arguments is None:
+        script_and_arguments = _make_script_and_arguments(experiment, instrument, message, batch_run)
+    script, arguments, error_msgs = script_and_arguments
+    new_run = NewRun(experiment, instrument, message, run_version, software)
+    reduction_run = ReductionRun.objects.create(
+        **_reduction_run_fields(new_run, status, script, arguments, time_now, socket.getfqdn()))
+    _make_run_numbers(reduction_run, message.run_number)
+    _make_data_locations(reduction_run, message.data)
+
+    _update_message(new_run, script, arguments, error_msgs)
     return reduction_run, message
+
+
+def _bulk_create_run_numbers_and_data_locations(reduction_runs: List[ReductionRun], messages: list):
+    """Create the RunNumber and DataLocation records of several saved runs with a query each."""
+    run_numbers = []
+    data_locations = []
+    for reduction_run, message in zip(reduction_runs, messages):
+        for run_number in message.run_number if isinstance(message.run_number, list) else [message.run_number]:
+            run_numbers.append(RunNumber(reduction_run=reduction_run, run_number=run_number))
+        for file_path in [message.data] if isinstance(message.data, str) else message.data:
+            data_locations.append(DataLocation(file_path=file_path, reduction_run=reduction_run))
+    RunNumber.objects.bulk_create(run_numbers, batch_size=BULK_CREATE_BATCH_SIZE)
+    DataLocation.objects.bulk_create(data_locations, batch_size=BULK_CREATE_BATCH_SIZE)
+
+
+def _find_inserted_keys(reduction_runs: List[ReductionRun], reduction_host: str):
+    """
+    Set the primary keys of runs inserted together on a database that can't
+    return them, e.g. MySQL. They are needed to link the run numbers and data
+    locations. The new rows are selected by their experiment, host and creation
+    time, which bulk_create sets on each run, in the order of their
+    auto-increment keys. That is the order they were inserted in, which tells
+    apart any runs created at the same time.
+
+    Raises:
+        DatabaseError: If the selected rows don't match the inserted runs,
+        e.g. because another host inserted runs at the same time without
+        locking their experiment.
+    """
+    experiment_ids = {reduction_run.experiment_id for reduction_run in reduction_runs}
+    created = {reduction_run.created for reduction_run in reduction_runs}
+    inserted = list(
+        ReductionRun.objects.filter(experiment_id__in=experiment_ids,
+                                    reduction_host=reduction_host,
+                                    created__in=created).order_by('id').values_list('id', 'experiment_id',
+                                                                                    'run_version', 'created'))
+    expected = [(run.experiment_id, run.run_version, run.created) for run in reduction_runs]
+    if [tuple(natural_key) for _, *natural_key in inserted] != expected:
+        raise DatabaseError(f"Found {len(inserted)} rows that don't match the {len(reduction_runs)} runs inserted")
+    for reduction_run, (primary_key, *_) in zip(reduction_runs, inserted):
+        reduction_run.pk = primary_key
+
+
+@transaction.atomic
+def create_reduction_run_records(new_runs: List[NewRun], status: Status) -> List[Tuple[ReductionRun, object]]:
+    """
+    Create the ORM records for several reduction runs in one transaction. The
+    runs, their run numbers and their data locations are each inserted with
+    bulk_create, rather than with a query per record. The experiments of the
+    runs must be locked where the database can't return the primary keys of
+    the inserted runs, so that they can be selected again.
+
+    Args:
+        new_runs: The runs to create the records of.
+        status: The status of the new runs.
+
+    Returns:
+        For each run, in order, the ReductionRun record and its message, updated
+        in the same way as by create_reduction_run_record.
+    """
+    time_now = timezone.now()
+    reduction_host = socket.getfqdn()
+    reduction_runs = []
+    updates = []
+    for new_run in new_runs:
+        script_and_arguments = new_run.script_and_arguments
+        if script_and_arguments is None:
+            batch_run = isinstance(new_run.message.run_number, list)
+            script_and_arguments = _make_script_and_arguments(new_run.experiment, new_run.instrument, new_run.message,
+                                                              batch_run)
+        script, arguments, error_msgs = script_and_arguments
+        reduction_runs.append(
+            ReductionRun(**_reduction_run_fields(new_run, status, script, arguments, time_now, reduction_host)))
+        updates.append((script, arguments, error_msgs))
+
+    ReductionRun.objects.bulk_create(reduction_runs, batch_size=BULK_CREATE_BATCH_SIZE)
+    if not connections[ReductionRun.objects.db].features.can_return_rows_from_bulk_insert:
+        _find_inserted_keys(reduction_runs, reduction_host)
+
+    _bulk_create_run_numbers_and_data_locations(reduction_runs, [new_run.message for new_run in new_runs])
+
+    for new_run, (script, arguments, error_msgs) in zip(new_runs, updates):
+        _update_message(new_run, script, arguments, error_msgs)
+    return [(reduction_run, new_run.message) for reduction_run, new_run in zip(reduction_runs, new_runs)]
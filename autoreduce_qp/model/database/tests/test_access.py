@@ -9,11 +9,14 @@
 Unit tests to exercise the code responsible for common database access methods
 """
 import os
+import time
+from unittest import skipUnless
 from unittest.mock import Mock, patch
 from django.test import TestCase
+from django.utils import timezone
 
 from autoreduce_db.reduction_viewer.models import Experiment, Instrument, Software
-from autoreduce_qp.model.database import access
+from autoreduce_qp.model.database import access, records
 from autoreduce_qp.model.database.access import get_all_instrument_names, is_instrument_flat_output
 from autoreduce_qp.model.database.records import create_reduction_run_record
 from autoreduce_qp.queue_processor.tests.test_handle_message import make_test_message
@@ -24,6 +27,11 @@ class TestAccess(TestCase):
     Test the access functionality for the database
     """
 
+    def setUp(self):
+        # Cached records would outlive the test database transaction
+        access.REFERENCE_CACHE.invalidate()
+        records.invalidate_caches()
+
     def test_get_instrument_valid(self):
         """
         Test: The correct instrument object is returned
@@ -72,6 +80,92 @@ class TestAccess(TestCase):
         self.assertIsNotNone(actual)
         self.assertEqual('Completed', actual.value_verbose())
 
+    def test_reference_records_cached(self):
+        """
+        Test: Statuses, instruments and software are only queried for the first time they are looked up
+        When: They are looked up again before the cache expires
+        """
+        hits, misses = access.REFERENCE_CACHE.hits, access.REFERENCE_CACHE.misses
+        instrument = access.get_instrument('GEM')
+        software = access.get_software('Mantid', '6.2.0')
+        status = access.get_status('q')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(instrument, access.get_instrument('GEM'))
+            self.assertEqual(software, access.get_software('Mantid', '6.2.0'))
+            self.assertEqual(status, access.get_status('q'))
+        self.assertEqual(hits + 3, access.REFERENCE_CACHE.hits)
+        self.assertEqual(misses + 3, access.REFERENCE_CACHE.misses)
+
+    def test_reference_cache_invalidate(self):
+        """
+        Test: Only the invalidated records are looked up again
+        When: The cache is invalidated for one instrument
+        """
+        access.get_instrument('GEM')
+        access.get_instrument('WISH')
+        access.REFERENCE_CACHE.invalidate("instrument", "GEM")
+
+        with self.assertNumQueries(0):
+            access.get_instrument('WISH')
+        misses = access.REFERENCE_CACHE.misses
+        access.get_instrument('GEM')
+        self.assertEqual(misses + 1, access.REFERENCE_CACHE.misses)
+
+    def test_reference_cache_returns_copies(self):
+        """
+        Test: Changing a looked up record doesn't change the cached one
+        When: The record is looked up again
+        """
+        instrument = access.get_instrument('GEM')
+        instrument.is_paused = True
+
+        cached = access.get_instrument('GEM')
+        self.assertIsNot(instrument, cached)
+        self.assertFalse(cached.is_paused)
+        self.assertIsNot(cached, access.get_instrument('GEM'))
+
+    @patch("autoreduce_qp.model.database.access.time.monotonic")
+    def test_reference_cache_expiry(self, monotonic: Mock):
+        """
+        Test: A record is looked up again
+        When: Its cache entry has expired
+        """
+        cache = access.ReferenceCache(ttl=10)
+        load = Mock(side_effect=[1, 2])
+        monotonic.return_value = 100
+        self.assertEqual(1, cache.get(("kind", ), load))
+        monotonic.return_value = 109
+        self.assertEqual(1, cache.get(("kind", ), load))
+        monotonic.return_value = 110
+        self.assertEqual(2, cache.get(("kind", ), load))
+
+    def test_reference_cache_max_size(self):
+        """
+        Test: The least recently used entry is evicted
+        When: The cache has more entries than its max_size
+        """
+        cache = access.ReferenceCache(ttl=10, max_size=2)
+        cache.get(("kind", 1), lambda: 1)
+        cache.get(("kind", 2), lambda: 2)
+        cache.get(("kind", 1), Mock())
+        cache.get(("kind", 3), lambda: 3)
+
+        self.assertEqual(1, cache.get(("kind", 1), Mock()))
+        self.assertEqual(3, cache.get(("kind", 3), Mock()))
+        self.assertEqual("reloaded", cache.get(("kind", 2), lambda: "reloaded"))
+
+    def test_reference_cache_disabled(self):
+        """
+        Test: Every lookup loads the record
+        When: The cache has a TTL of 0
+        """
+        cache = access.ReferenceCache(ttl=0)
+        load = Mock(side_effect=[1, 2])
+        self.assertEqual(1, cache.get(("kind", ), load))
+        self.assertEqual(2, cache.get(("kind", ), load))
+        self.assertEqual(0, cache.hits)
+
     def test_get_experiment(self):
         """
         Test: The correct Experiment record is returned
@@ -198,6 +292,100 @@ class TestAccess(TestCase):
         assert access.find_highest_run_version(experiment, [1234567, 1234568, 1234572]) == 0
         assert access.find_highest_run_version(experiment, [1234566, 1234567, 1234568, 1234572]) == 0
 
+    def test_find_highest_run_version_batch_run_single_query(self):
+        """
+        Test: The highest version is found in one query, and batch runs match on their set of run numbers
+        When: Calling find_highest_run_version with many overlapping batch runs
+        """
+        experiment, _ = Experiment.objects.get_or_create(reference_number=1231231)
+        instrument, _ = Instrument.objects.get_or_create(name="ARMI", is_active=1, is_paused=0)
+        software, _ = Software.objects.get_or_create(name="Mantid", version="6.2.0")
+        status = access.get_status("q")
+        msg = make_test_message(instrument.name)
+
+        for i, run_numbers in enumerate([[1, 2, 3], [1, 2], [1, 2, 3, 4], [1, 2, 3], [3, 3, 1]]):
+            msg.run_number = run_numbers
+            create_reduction_run_record(experiment, instrument, msg, i, status, software)
+
+        with self.assertNumQueries(1):
+            assert access.find_highest_run_version(experiment, [1, 2, 3]) == 4
+        assert access.find_highest_run_version(experiment, [3, 2, 1]) == 4
+        assert access.find_highest_run_version(experiment, [1, 2]) == 2
+        assert access.find_highest_run_version(experiment, [1, 3]) == 5
+        assert access.find_highest_run_version(experiment, [2, 3]) == 0
+
+    def test_lock_experiment(self):
+        """
+        Test: The experiment is read again with a row lock
+        When: Calling lock_experiment inside a transaction
+        """
+        experiment, _ = Experiment.objects.get_or_create(reference_number=1231231)
+        with patch.object(Experiment.objects, "select_for_update", wraps=Experiment.objects.select_for_update) as lock:
+            self.assertEqual(experiment, access.lock_experiment(experiment))
+        lock.assert_called_once_with()
+
+    def test_find_requeued_run(self):
+        """
+        Test: Only a queued run with a start time is found as requeued
+        When: Calling find_requeued_run
+        """
+        experiment, _ = Experiment.objects.get_or_create(reference_number=1231231)
+        instrument, _ = Instrument.objects.get_or_create(name="ARMI", is_active=1, is_paused=0)
+        software, _ = Software.objects.get_or_create(name="Mantid", version="6.2.0")
+        msg = make_test_message(instrument.name)
+        create_reduction_run_record(experiment, instrument, msg, 0, access.get_status("c"), software)
+        queued_run, _ = create_reduction_run_record(experiment, instrument, msg, 1, access.get_status("q"), software)
+
+        assert access.find_requeued_run(experiment, instrument, msg.run_number) is None
+
+        queued_run.started = timezone.now()
+        queued_run.save()
+        assert access.find_requeued_run(experiment, instrument, msg.run_number) == queued_run
+        assert access.find_requeued_run(experiment, instrument, msg.run_number + 1) is None
+        assert access.find_requeued_run(experiment, instrument, [msg.run_number]) is None
+
+    def test_find_highest_run_versions(self):
+        """
+        Test: The next version of each run is returned, in a single query
+        When: Calling find_highest_run_versions
+        """
+        experiment, _ = Experiment.objects.get_or_create(reference_number=1231231)
+        other_experiment, _ = Experiment.objects.get_or_create(reference_number=3213213)
+        instrument, _ = Instrument.objects.get_or_create(name="ARMI", is_active=1, is_paused=0)
+        software, _ = Software.objects.get_or_create(name="Mantid", version="6.2.0")
+        status = access.get_status("q")
+        msg = make_test_message(instrument.name)
+        for i in range(3):
+            create_reduction_run_record(experiment, instrument, msg, i, status, software)
+        create_reduction_run_record(other_experiment, instrument, msg, 0, status, software)
+
+        with self.assertNumQueries(1):
+            versions = access.find_highest_run_versions({experiment.pk, other_experiment.pk},
+                                                        {msg.run_number, msg.run_number + 1})
+
+        assert versions == {(experiment.pk, msg.run_number): 3, (other_experiment.pk, msg.run_number): 1}
+
+    def test_find_requeued_runs(self):
+        """
+        Test: Only queued runs with a start time are found as requeued, by
+              experiment, instrument and run number
+        When: Calling find_requeued_runs
+        """
+        experiment, _ = Experiment.objects.get_or_create(reference_number=1231231)
+        instrument, _ = Instrument.objects.get_or_create(name="ARMI", is_active=1, is_paused=0)
+        software, _ = Software.objects.get_or_create(name="Mantid", version="6.2.0")
+        msg = make_test_message(instrument.name)
+        create_reduction_run_record(experiment, instrument, msg, 0, access.get_status("c"), software)
+        queued_run, _ = create_reduction_run_record(experiment, instrument, msg, 1, access.get_status("q"), software)
+
+        assert not access.find_requeued_runs({experiment.pk}, {msg.run_number})
+
+        queued_run.started = timezone.now()
+        queued_run.save()
+        assert access.find_requeued_runs({experiment.pk}, {msg.run_number, msg.run_number + 1}) == {
+            (experiment.pk, instrument.pk, msg.run_number): queued_run
+        }
+
     def test_save_record(self):
         """
         Test: .save() is called on the provided object
@@ -213,3 +401,39 @@ class TestAccess(TestCase):
         When: Calling access.get_status()
         """
         self.assertRaises(ValueError, access.get_status, "test")
+
+
+@skipUnless(os.getenv("AUTOREDUCE_QP_BENCHMARK"), "set AUTOREDUCE_QP_BENCHMARK to run the benchmarks")
+class BenchmarkFindHighestRunVersion(TestCase):
+    """
+    Time finding the version of a batch run in an experiment with many batch
+    runs, e.g. with AUTOREDUCE_QP_BENCHMARK=1 AUTOREDUCE_QP_BENCHMARK_RUNS=10000
+    """
+
+    def test_batch_run_version_with_many_batch_runs(self):
+        """
+        Test: The version of a batch run is found with one query, however many
+              batch runs the experiment has
+        When: Every batch run shares a run number with the one looked up, the
+              worst case
+        """
+        total_runs = int(os.getenv("AUTOREDUCE_QP_BENCHMARK_RUNS", "10000"))
+        experiment, _ = Experiment.objects.get_or_create(reference_number=1231231)
+        instrument, _ = Instrument.objects.get_or_create(name="ARMI", is_active=1, is_paused=0)
+        software, _ = Software.objects.get_or_create(name="Mantid", version="6.2.0")
+        script_and_arguments = records.find_script_and_arguments(experiment, instrument,
+                                                                 make_test_message(instrument.name))
+        new_runs = []
+        for index in range(total_runs):
+            msg = make_test_message(instrument.name)
+            msg.run_number = [1, 100000 + index]
+            new_runs.append(records.NewRun(experiment, instrument, msg, 0, software, script_and_arguments))
+        records.create_reduction_run_records(new_runs, access.get_status("q"))
+
+        start = time.perf_counter()
+        with self.assertNumQueries(1):
+            version = access.find_highest_run_version(experiment, [1, 2])
+        elapsed = time.perf_counter() - start
+
+        assert version == 0
+        print(f"find_highest_run_version with {total_runs} batch runs: {elapsed * 1000:.1f} ms")
@@ -8,14 +8,19 @@
 """Unit tests for the record helper module."""
 # pylint:disable=no-member,protected-access,invalid-name,redefined-outer-name,redefined-builtin,line-too-long
 import socket
+import tempfile
+from pathlib import Path
 from typing import List, Union
 from unittest import mock
 
+from django.db import DatabaseError, connection
 from django.test import TestCase
+from django.utils import timezone
 from parameterized import parameterized
 from requests.exceptions import ConnectionError
 
-from autoreduce_db.reduction_viewer.models import DataLocation, Experiment, Instrument, ReductionRun, RunNumber
+from autoreduce_db.reduction_viewer.models import (DataLocation, Experiment, Instrument, ReductionArguments,
+                                                   ReductionRun, ReductionScript, RunNumber, Software, Status)
 from autoreduce_qp.model.database import records
 from autoreduce_qp.queue_processor.tests.test_handle_message import make_test_message
 from autoreduce_qp.queue_processor.tests.test_variable_utils import FakeModule
@@ -25,6 +30,10 @@ class TestDatabaseRecords(TestCase):
     """Tests the Record helpers for the ORM layer."""
     fixtures = ["status_fixture", "run_with_multiple_variables"]
 
+    def setUp(self):
+        # Cached records would outlive the test database transaction
+        records.invalidate_caches()
+
     @mock.patch("autoreduce_qp.model.database.records.timezone")
     @mock.patch.multiple("autoreduce_qp.model.database.records",
                          ReductionRun=mock.DEFAULT,
@@ -88,6 +97,71 @@ class TestDatabaseRecords(TestCase):
         _make_run_numbers.assert_called_once_with(returned_run, mock_msg.run_number)
         _make_data_locations.assert_called_once_with(returned_run, mock_msg.data)
 
+    @parameterized.expand([[True], [False]])
+    def test_create_reduction_run_records(self, can_return_rows_from_bulk_insert: bool):
+        """
+        Test that the records of several runs are created together, with a
+        query for all of the runs, run numbers and data locations, and another
+        to find the keys of the runs where the database can't return the
+        primary keys of rows inserted together.
+        """
+        instrument: Instrument = Instrument.objects.first()
+        experiment: Experiment = Experiment.objects.first()
+        software = Software.objects.create(name="Mantid", version="latest")
+        status = Status.get_queued()
+        messages = [make_test_message(instrument.name) for _ in range(3)]
+        messages[2].run_number = [100, 101]
+        messages[2].data = ["/path/100", "/path/101"]
+        new_runs = [records.NewRun(experiment, instrument, message, 5, software) for message in messages]
+        # Look up the script and arguments first, so that only the inserts are counted
+        records._make_script_and_arguments(experiment, instrument, make_test_message(instrument.name), False)
+
+        with mock.patch.object(type(connection.features),
+                               "can_return_rows_from_bulk_insert",
+                               new_callable=mock.PropertyMock,
+                               return_value=can_return_rows_from_bulk_insert):
+            with self.assertNumQueries(5 if can_return_rows_from_bulk_insert else 6):
+                created = records.create_reduction_run_records(new_runs, status)
+
+        self.assertEqual([new_run.message for new_run in new_runs], [message for _, message in created])
+        for reduction_run, message in created:
+            reduction_run.refresh_from_db()
+            self.assertEqual(5, reduction_run.run_version)
+            self.assertEqual(5, message.run_version)
+            self.assertEqual(status, reduction_run.status)
+            self.assertEqual(message.reduction_script, reduction_run.script.text)
+        self.assertEqual([7654321], list(created[0][0].run_numbers.values_list("run_number", flat=True)))
+        self.assertEqual(["/path"], list(created[0][0].data_location.values_list("file_path", flat=True)))
+        self.assertEqual([100, 101], sorted(created[2][0].run_numbers.values_list("run_number", flat=True)))
+        self.assertTrue(created[2][0].batch_run)
+        self.assertEqual(3, len({reduction_run.pk for reduction_run, _ in created}))
+
+    def test_create_reduction_run_records_keys_not_found(self):
+        """
+        Test that no records are created if the inserted runs can't be found
+        again on a database that can't return their primary keys.
+        """
+        instrument: Instrument = Instrument.objects.first()
+        experiment: Experiment = Experiment.objects.first()
+        software = Software.objects.create(name="Mantid", version="latest")
+        new_runs = [records.NewRun(experiment, instrument, make_test_message(instrument.name), 5, software)]
+        # Another run of the experiment inserted at the same time
+        time_now = timezone.now()
+        ReductionRun.objects.filter(pk=ReductionRun.objects.first().pk).update(experiment=experiment,
+                                                                               created=time_now,
+                                                                               reduction_host=socket.getfqdn())
+        runs_before = ReductionRun.objects.count()
+
+        with mock.patch.object(type(connection.features),
+                               "can_return_rows_from_bulk_insert",
+                               new_callable=mock.PropertyMock,
+                               return_value=False), \
+                mock.patch.object(records.timezone, "now", return_value=time_now):
+            with self.assertRaises(DatabaseError):
+                records.create_reduction_run_records(new_runs, Status.get_queued())
+
+        self.assertEqual(runs_before, ReductionRun.objects.count())
+
     @parameterized.expand([["/test/data/loc"], [["/test/data/loc/", "/test/data/loc2"]]])
     def test_make_data_locations(self, data_locs: Union[str, List[str]]):
         """
@@ -118,6 +192,45 @@ class TestDatabaseRecords(TestCase):
         else:
             assert RunNumber.objects.count() == len(run_numbers) + 1
 
+    def test_get_or_create_script(self):
+        """Test that a script is only looked up by its text once, and then by its digest."""
+        script = records.get_or_create_script("print('hello')")
+        self.assertEqual("print('hello')", ReductionScript.objects.get(pk=script.pk).text)
+
+        with self.assertNumQueries(0):
+            cached = records.get_or_create_script("print('hello')")
+        self.assertEqual(script.pk, cached.pk)
+        self.assertEqual("print('hello')", cached.text)
+
+        other = records.get_or_create_script("print('goodbye')")
+        self.assertNotEqual(script.pk, other.pk)
+        self.assertEqual(1, ReductionScript.objects.filter(text="print('hello')").count())
+
+    def test_get_or_create_arguments_canonical(self):
+        """Test that arguments are saved with sorted keys and found again whatever order their keys are in."""
+        instrument = Instrument.objects.create(name="ARGS")
+        arguments = records.get_or_create_arguments(instrument, '{"b":{"y":1,"x":2},"a":3}')
+        self.assertEqual('{"a":3,"b":{"x":2,"y":1}}', ReductionArguments.objects.get(pk=arguments.pk).raw)
+
+        with self.assertNumQueries(0):
+            cached = records.get_or_create_arguments(instrument, '{"a":3,"b":{"y":1,"x":2}}')
+        self.assertEqual(arguments.pk, cached.pk)
+        self.assertEqual({"a": 3, "b": {"x": 2, "y": 1}}, cached.as_dict())
+
+        other_instrument = Instrument.objects.create(name="OTHER")
+        self.assertNotEqual(arguments.pk,
+                            records.get_or_create_arguments(other_instrument, '{"a":3,"b":{"x":2,"y":1}}').pk)
+
+    def test_get_or_create_arguments_legacy(self):
+        """Test that arguments saved before they were canonicalised are reused."""
+        instrument = Instrument.objects.create(name="ARGS")
+        legacy = instrument.arguments.create(raw='{"b":1,"a":2}')
+
+        arguments = records.get_or_create_arguments(instrument, '{"b":1,"a":2}')
+
+        self.assertEqual(legacy.pk, arguments.pk)
+        self.assertEqual(1, instrument.arguments.count())
+
     @mock.patch("autoreduce_qp.model.database.records.ReductionScriptFile.load")
     def test_make_script_and_arguments_with_experiment_var(self, load: mock.Mock):
         """
@@ -288,7 +401,34 @@ class TestDatabaseRecords(TestCase):
 
         assert rscript.text == text.return_value
 
-    @mock.patch("autoreduce_qp.model.database.records.requests.get")
+    @mock.patch("autoreduce_qp.model.database.records.text_digest", wraps=records.text_digest)
+    def test_make_script_and_arguments_script_read_once(self, text_digest: mock.Mock):
+        """
+        Test that the script on disk is read and hashed once for several runs
+        while it is unchanged.
+        """
+        instrument: Instrument = Instrument.objects.first()
+        experiment: Experiment = Experiment.objects.first()
+
+        with tempfile.TemporaryDirectory() as scripts_dir, \
+                mock.patch("autoreduce_qp.queue_processor.reduction.service.SCRIPTS_DIRECTORY", f"{scripts_dir}/%s"), \
+                mock.patch.object(records.ReductionScriptFile, "text", autospec=True,
+                                  side_effect=records.ReductionScriptFile.text) as text:
+            script_path = Path(scripts_dir, instrument.name, "reduce.py")
+            script_path.parent.mkdir()
+            script_path.write_text("print('from disk')", encoding="utf_8")
+
+            for _ in range(2):
+                msg = make_test_message(instrument.name)
+                msg.reduction_script = None
+                msg.reduction_arguments = {"standard_vars": {"variable": "value"}}
+                rscript, *_ = records._make_script_and_arguments(experiment, instrument, msg, False)
+                assert rscript.text == "print('from disk')"
+
+        text.assert_called_once()
+        text_digest.assert_not_called()
+
+    @mock.patch("autoreduce_qp.model.database.records.REMOTE_FILES.fetch")
     def test_remote_source_connection_error(self, text: mock.Mock):
         """
         Test that fetch_from_remote_source() catches a ConnectionError and
@@ -307,7 +447,7 @@ class TestDatabaseRecords(TestCase):
         assert "Could not connect to remote source at" in text.return_value
 
     # pylint:disable=unsupported-membership-test
-    @mock.patch("autoreduce_qp.model.database.records.requests.get")
+    @mock.patch("autoreduce_qp.model.database.records.REMOTE_FILES.fetch")
     def test_remote_source_403_code(self, text: mock.Mock):
         """
         Test that fetch_from_remote_source() appends an appropriate error
@@ -326,7 +466,7 @@ class TestDatabaseRecords(TestCase):
         assert "Cannot access" in result
 
     # pylint:disable=unsupported-membership-test
-    @mock.patch("autoreduce_qp.model.database.records.requests.get")
+    @mock.patch("autoreduce_qp.model.database.records.REMOTE_FILES.fetch")
     def test_remote_source_404_code(self, text: mock.Mock):
         """
         Test that fetch_from_remote_source() appends an appropriate error
@@ -345,7 +485,7 @@ class TestDatabaseRecords(TestCase):
         assert "Cannot find" in result
 
     # pylint:disable=unsupported-membership-test
-    @mock.patch("autoreduce_qp.model.database.records.requests.get")
+    @mock.patch("autoreduce_qp.model.database.records.REMOTE_FILES.fetch")
     def test_remote_source_other_codes(self, text: mock.Mock):
         """
         Test that fetch_from_remote_source() appends an appropriate error
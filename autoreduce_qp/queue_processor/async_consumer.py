@@ -0,0 +1,411 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""
+An asyncio engine for the queue processor, selected with
+AUTOREDUCE_QP_ENGINE=asyncio.
+
+Polling Kafka, creating the database records and reducing each run are awaited
+concurrently on one event loop. The client libraries underneath are blocking,
+so each kind of call runs on its own executor: Kafka calls on a single thread,
+ORM calls on a small pool and reductions, which wait on their Docker container,
+on a pool with a thread per concurrent reduction. The handling of offsets,
+redelivered messages, dead letters and rebalances is shared with the thread
+engine through BaseConsumer.
+"""
+import asyncio
+import functools
+import logging
+import os
+import signal
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set
+
+from confluent_kafka import DeserializingConsumer, KafkaException
+from confluent_kafka.serialization import StringDeserializer
+from django.db import close_old_connections
+from pydantic import ValidationError
+from autoreduce_utils.clients.connection_exception import ConnectionException
+from autoreduce_utils.message.message import Message
+
+from autoreduce_qp.queue_processor.base_consumer import (DRAIN_TIMEOUT, HIGH_WATER_MARK, INSTRUMENT_CONCURRENCY,
+                                                         LOW_WATER_MARK, REDUCTION_WORKERS, RETRY_DELAY, BaseConsumer)
+from autoreduce_qp.queue_processor.handle_message import HandleMessage, RunRequeued
+from autoreduce_qp.queue_processor.lanes import LANE_TOPICS, FairQueue, lane_for_topic
+from autoreduce_qp.queue_processor.metrics import METRICS_PORT, start_metrics_server
+
+# The number of threads used for database calls outside of the reductions
+DATABASE_THREADS = int(os.getenv("AUTOREDUCE_QP_DATABASE_THREADS", "4"))
+# The number of seconds a drain waits for the reductions it requeued to end once
+# their containers have been stopped
+REQUEUE_STOP_TIMEOUT = float(os.getenv("AUTOREDUCE_QP_REQUEUE_STOP_TIMEOUT", "30"))
+
+
+class _Reduction:
+    """A data_ready message being handled, and whether its reduction has started."""
+
+    def __init__(self, incoming_message, lane: str):
+        self.incoming_message = incoming_message
+        self.lane = lane
+        self.partition = (incoming_message.topic(), incoming_message.partition())
+        self.started = False
+        self.task: Optional[asyncio.Task] = None
+
+
+class _SlotWaiter:
+    """A reduction waiting for a slot, with its fair queuing tag."""
+
+    def __init__(self, lane: str, tag: float):
+        self.lane = lane
+        self.tag = tag
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class _LaneSlots:
+    """
+    The concurrent reduction slots, shared between the lanes in proportion to
+    their weights in the same way as the worker pool's workers. Only used from
+    the event loop.
+    """
+
+    def __init__(self, slots: int, lane_weights: Dict[str, float]):
+        self.free = slots
+        self.fair_queue = FairQueue(lane_weights)
+        self._waiting: List[_SlotWaiter] = []
+
+    async def acquire(self, lane: str):
+        """Wait for a slot, starting with the reduction with the earliest tag whenever one is released."""
+        tag = self.fair_queue.tag(lane)
+        if self.free > 0 and not self._waiting:
+            self.free -= 1
+            self.fair_queue.started(tag)
+            return
+
+        waiter = _SlotWaiter(lane, tag)
+        self._waiting.append(waiter)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter in self._waiting:
+                self._waiting.remove(waiter)
+            else:
+                # It was given the slot as it was cancelled
+                self.release()
+            raise
+
+    def release(self):
+        """Give a slot to the waiting reduction with the earliest tag, or free it."""
+        if not self._waiting:
+            self.free += 1
+            return
+
+        waiter = min(self._waiting, key=lambda waiter: waiter.tag)
+        self._waiting.remove(waiter)
+        self.fair_queue.started(waiter.tag)
+        waiter.future.set_result(None)
+
+    def set_weight(self, lane: str, weight: float):
+        """Change the weight of a lane, re-tagging its waiting reductions."""
+        if self.fair_queue.set_weight(lane, weight):
+            for waiter in self._waiting:
+                if waiter.lane == lane:
+                    waiter.tag = self.fair_queue.tag(lane)
+
+
+class AsyncConsumer(BaseConsumer):
+    """
+    Reads messages from the lane topics and reduces them concurrently on an
+    asyncio event loop.
+
+    Like the threaded consumer, runs with the same ordering key are reduced
+    one at a time in the order they were received, at most
+    `instrument_concurrency` runs of an instrument are reduced at once, the
+    reductions are shared between the lanes by their weights, and offsets are
+    only committed once every message before them has finished.
+    """
+
+    # pylint:disable=too-many-arguments
+    def __init__(self,
+                 consumer=None,
+                 concurrency=REDUCTION_WORKERS,
+                 instrument_concurrency=INSTRUMENT_CONCURRENCY,
+                 dead_letters=None,
+                 high_water_mark=HIGH_WATER_MARK,
+                 low_water_mark=LOW_WATER_MARK,
+                 deduplication=None,
+                 lane_weights=None):
+        super().__init__(dead_letters=dead_letters,
+                         deduplication=deduplication,
+                         lane_weights=lane_weights,
+                         high_water_mark=high_water_mark,
+                         low_water_mark=low_water_mark)
+        self.consumer = consumer
+        self.message_handler = HandleMessage()
+        self.concurrency = concurrency
+        self.instrument_concurrency = instrument_concurrency
+
+        # Kafka calls are kept on one thread, as the rebalance callbacks run
+        # on whichever thread calls poll
+        self._kafka_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="kafka")
+        self._database_executor = ThreadPoolExecutor(max_workers=DATABASE_THREADS, thread_name_prefix="database")
+        self._reduction_executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="reduction")
+
+        # Only used from the event loop
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop_event: Optional[asyncio.Event] = None
+        self._slots = _LaneSlots(concurrency, self.lane_weights.get_all())
+        self._reductions: Set[_Reduction] = set()
+        self._key_locks: Dict[str, asyncio.Lock] = {}
+        self._key_waiting: Dict[str, int] = {}
+        self._instrument_slots: Dict[str, asyncio.Semaphore] = {}
+        self._drain_deadline = None
+        self.drained = True
+        # The reductions in flight in each lane, changed on the event loop and
+        # read from the Kafka thread for backpressure
+        self._lane_in_flight = {lane: 0 for lane in LANE_TOPICS}
+
+        if self.consumer is None:
+            try:
+                config = self.kafka_config()
+                config['key.deserializer'] = StringDeserializer('utf_8')
+                config['value.deserializer'] = StringDeserializer('utf_8')
+                self.consumer = DeserializingConsumer(config)
+            except KafkaException as err:
+                self.logger.error("Could not initialize the consumer: %s", err)
+                raise ConnectionException("Could not initialize the consumer") from err
+
+        self.consumer.subscribe(list(LANE_TOPICS.values()), on_assign=self.on_assign, on_revoke=self.on_revoke)
+
+    async def run(self):
+        """Poll for messages and handle them until the consumer is stopped or drained."""
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        try:
+            while not self._stop_event.is_set():
+                await self._call(self._kafka_executor, self.retry_quarantines)
+                await self._call(self._kafka_executor, self.commit_completed)
+                self.refresh_lane_weights()
+                await self._call(self._kafka_executor, self.apply_backpressure)
+                msg = await self._call(self._kafka_executor, self.consumer.poll, 1.0)
+                if msg is None:
+                    continue
+                if msg.error():
+                    self.logger.error("Undefined error in consumer loop")
+                    raise KafkaException(msg.error())
+                self.on_message(msg)
+
+            self.logger.info("Stopping the consumer")
+            await self._finish()
+        finally:
+            self._kafka_executor.shutdown(wait=False)
+            self._database_executor.shutdown(wait=False)
+            self._reduction_executor.shutdown(wait=self._drain_deadline is None)
+
+    def stop(self):
+        """Stop polling, and wait for every reduction to finish. Must be called on the event loop."""
+        self._stop_event.set()
+
+    def drain(self, timeout: float = DRAIN_TIMEOUT):
+        """
+        Stop polling, and wait up to `timeout` seconds for the reductions that
+        have started. Reductions that haven't started are dropped and those
+        still running at the deadline are requeued, so that only the offsets of
+        finished messages are committed. Must be called on the event loop.
+        """
+        self.logger.info("Draining the consumer, waiting up to %s seconds for reductions in flight", timeout)
+        self._drain_deadline = time.monotonic() + timeout
+        self._stop_event.set()
+
+    def in_flight(self, lane: Optional[str] = None) -> int:
+        """Return the number of reductions running or waiting to run, in every lane or only the given one."""
+        if lane is None:
+            return sum(self._lane_in_flight.values())
+        return self._lane_in_flight.get(lane, 0)
+
+    def scheduled_lane_weights(self):
+        return dict(self._slots.fair_queue.weights)
+
+    def set_lane_weight(self, lane, weight):
+        self._slots.set_weight(lane, weight)
+
+    def is_processing_message(self):
+        """Return whether any reduction is in flight."""
+        return self.in_flight() > 0
+
+    async def _call(self, executor, func, *args):
+        """Run a blocking call on an executor and await its result."""
+        return await self._loop.run_in_executor(executor, functools.partial(func, *args))
+
+    async def _call_with_database(self, executor, func, *args):
+        """Run a blocking call that uses the database, dropping stale connections like the worker pool does."""
+
+        def call():
+            close_old_connections()
+            try:
+                return func(*args)
+            finally:
+                close_old_connections()
+
+        return await self._call(executor, call)
+
+    def on_message(self, incoming_message):
+        """Start handling a message in a new task."""
+        topic = incoming_message.topic()
+        self.track(incoming_message)
+        try:
+            message = Message.parse_raw(incoming_message.value())
+        except (ValidationError, TypeError):
+            self.logger.error("Could not decode message: %s", incoming_message.value())
+            self._loop.run_in_executor(self._database_executor, self.quarantine, incoming_message,
+                                       "Could not decode message")
+            return
+
+        lane = lane_for_topic(topic)
+        if lane is None:
+            self.logger.error("Received a message on an unknown topic '%s'", topic)
+            self.mark_completed(incoming_message)
+            return
+
+        if self.drop_duplicate(incoming_message):
+            return
+
+        reduction = _Reduction(incoming_message, lane)
+        self._reductions.add(reduction)
+        self._lane_in_flight[lane] += 1
+        reduction.task = self._loop.create_task(self.handle(reduction, message))
+
+    async def handle(self, reduction: _Reduction, message: Message):
+        """
+        Wait for the run's turn, then create its records and reduce it. Waits
+        in order for the run's ordering key, then for a slot for its
+        instrument and finally for one of the concurrent reduction slots,
+        which are shared between the lanes by their weights.
+        """
+        incoming_message = reduction.incoming_message
+        key = self.ordering_key(incoming_message, message)
+        key_lock = self._key_locks.setdefault(key, asyncio.Lock())
+        self._key_waiting[key] = self._key_waiting.get(key, 0) + 1
+        instrument_slots = self._instrument_slots.setdefault(message.instrument,
+                                                             asyncio.Semaphore(self.instrument_concurrency))
+        try:
+            async with key_lock, instrument_slots:
+                await self._slots.acquire(reduction.lane)
+                try:
+                    reduction.started = True
+                    await self.reduce(incoming_message, message)
+                finally:
+                    self._slots.release()
+        except asyncio.CancelledError:
+            # Dropped before it started, e.g. because its partition was revoked
+            self.logger.debug("Dropped reduction of %s before it started", message.run_number)
+        finally:
+            self._reductions.discard(reduction)
+            self._lane_in_flight[reduction.lane] -= 1
+            self._key_waiting[key] -= 1
+            if not self._key_waiting[key]:
+                del self._key_waiting[key]
+                del self._key_locks[key]
+
+    async def reduce(self, incoming_message, message: Message):
+        """
+        Create the records for a run and reduce it, each on its executor,
+        retrying after RETRY_DELAY seconds if that fails until the message has
+        used up its attempts. The message is not marked completed if this is
+        cancelled, e.g. when the event loop closes after a drain deadline
+        passed, or if its run was requeued while it was being reduced.
+        """
+        if not await self._call(self._database_executor, self.count_attempt, incoming_message):
+            return
+
+        while True:
+            try:
+                run_records = (await self._call_with_database(self._database_executor,
+                                                              self.message_handler.data_ready_batch, [message]))[0]
+                if isinstance(run_records, Exception):
+                    # The handler has logged the error
+                    raise run_records
+
+                await self._call_with_database(self._reduction_executor, self.message_handler.process_run_records,
+                                               *run_records)
+            except RunRequeued:
+                await self._call(self._database_executor, self.requeued, incoming_message)
+            except Exception as exp:  # pylint:disable=broad-except
+                if await self._call(self._database_executor, self.on_handler_exception, incoming_message, exp):
+                    await asyncio.sleep(RETRY_DELAY)
+                    # The handler fills in the message, so a fresh copy is parsed
+                    message = Message.parse_raw(incoming_message.value())
+                    continue
+            else:
+                await self._call(self._database_executor, self.succeeded, incoming_message)
+            return
+
+    def on_revoke(self, _, partitions):
+        """
+        Called on the Kafka thread before a rebalance takes partitions away.
+        Commits what has completed and drops the partitions' reductions that
+        have not started.
+        """
+        revoked = self.forget_partitions(partitions)
+        self._loop.call_soon_threadsafe(self._cancel_pending, revoked)
+
+    def _cancel_pending(self, partitions=None):
+        """Cancel the reductions that have not started, from the given partitions or from all of them."""
+        cancelled = 0
+        for reduction in list(self._reductions):
+            if not reduction.started and (partitions is None or reduction.partition in partitions):
+                reduction.task.cancel()
+                cancelled += 1
+        if cancelled:
+            self.logger.info("Dropped %s pending reductions", cancelled)
+
+    async def _finish(self):
+        """Wait for the reductions in flight, requeueing them if a drain deadline passes, then close."""
+        if self._drain_deadline is not None:
+            self._cancel_pending()
+
+        tasks = [reduction.task for reduction in self._reductions]
+        if tasks:
+            timeout = None if self._drain_deadline is None else max(0.0, self._drain_deadline - time.monotonic())
+            _, unfinished = await asyncio.wait(tasks, timeout=timeout)
+            if unfinished:
+                self.drained = False
+                await self._call_with_database(self._database_executor, self.requeue_unfinished)
+                # Stopping their containers ends the requeued reductions, which
+                # give back their attempts without marking their messages done
+                await asyncio.wait(unfinished, timeout=REQUEUE_STOP_TIMEOUT)
+
+        await self._call_with_database(self._database_executor, self.message_handler.close)
+        await self._call(self._kafka_executor, self.close_consumer)
+
+
+def main():
+    """Entry point for the asyncio engine."""
+    logger = logging.getLogger(__package__)
+    try:
+        consumer = AsyncConsumer()
+    except ConnectionException as exp:
+        logger.error("Exception occurred while connecting: %s %s\n\n%s",
+                     type(exp).__name__, exp, traceback.format_exc())
+        raise
+
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+
+    async def run():
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, consumer.drain)
+        await consumer.run()
+
+    logger.info("Kafka consumer started with the asyncio engine.")
+    asyncio.run(run())
+    logger.info("Consumer stopped")
+    if not consumer.drained:
+        # Requeued reductions are still running on executor threads, which
+        # would otherwise keep the process alive
+        logging.shutdown()
+        os._exit(0)  # pylint:disable=protected-access
@@ -0,0 +1,395 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""
+The handling of Kafka messages shared by the consumer engines: tracking and
+committing offsets, dropping redelivered messages, counting attempts and
+quarantining messages, pausing busy lanes, lane weights and the bookkeeping of
+a rebalance.
+
+The engines decide how runs are reduced. The thread engine in
+confluent_consumer calls these methods directly, and the asyncio engine in
+async_consumer calls the blocking ones on its executors.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+from typing import Dict, Optional, Set, Tuple
+
+from autoreduce_utils.clients.kafka_utils import kafka_config_from_env
+from autoreduce_utils.message.message import Message
+
+from autoreduce_qp.queue_processor.dead_letter import DeadLetterQueue
+from autoreduce_qp.queue_processor.deduplication import DeduplicationStore
+from autoreduce_qp.queue_processor.lanes import LANE_TOPICS, LANE_WEIGHTS_REFRESH, LaneWeights
+from autoreduce_qp.queue_processor.metrics import (CONSUMER_LAG, MESSAGES_COMPLETED, MESSAGES_RECEIVED,
+                                                   REDUCTIONS_IN_FLIGHT)
+from autoreduce_qp.queue_processor.offset_tracker import OffsetTracker
+
+GROUP_ID = 'data_ready-group'
+# The number of reductions that may run at the same time, and how many of those
+# may belong to a single instrument
+REDUCTION_WORKERS = int(os.getenv("AUTOREDUCE_QP_WORKERS", "1"))
+INSTRUMENT_CONCURRENCY = int(os.getenv("AUTOREDUCE_QP_INSTRUMENT_CONCURRENCY", "1"))
+# Completed offsets are committed once this many messages have completed, or
+# once this many seconds have passed since the last commit
+COMMIT_BATCH_SIZE = int(os.getenv("AUTOREDUCE_QP_COMMIT_BATCH_SIZE", "50"))
+COMMIT_INTERVAL = float(os.getenv("AUTOREDUCE_QP_COMMIT_INTERVAL", "5"))
+# Fetching from a lane is paused once this many of its reductions are in
+# flight, and resumed once they have dropped to the low-water mark. The consumer
+# keeps polling while paused so that it stays in the consumer group
+HIGH_WATER_MARK = int(os.getenv("AUTOREDUCE_QP_HIGH_WATER_MARK", str(2 * REDUCTION_WORKERS)))
+LOW_WATER_MARK = int(os.getenv("AUTOREDUCE_QP_LOW_WATER_MARK", str(REDUCTION_WORKERS)))
+# The number of seconds a drain waits for the reductions in flight to finish
+# before requeueing them
+DRAIN_TIMEOUT = float(os.getenv("AUTOREDUCE_QP_DRAIN_TIMEOUT", "300"))
+# The number of seconds to wait before retrying a message whose handling failed,
+# e.g. because the database or Docker was briefly unavailable
+RETRY_DELAY = float(os.getenv("AUTOREDUCE_QP_RETRY_DELAY", "5"))
+# How often, in seconds, publishing the messages that could not be published to
+# the dead-letter topic is retried
+DEAD_LETTER_RETRY_INTERVAL = float(os.getenv("AUTOREDUCE_QP_DEAD_LETTER_RETRY_INTERVAL", "10"))
+# How often librdkafka reports statistics, such as the consumer lag
+STATS_INTERVAL_MS = int(os.getenv("AUTOREDUCE_QP_STATS_INTERVAL_MS", "15000"))
+
+
+class BaseConsumer:
+    """
+    The state and message handling common to the consumer engines. Each engine
+    sets `consumer` to its Kafka consumer and `message_handler` to its
+    HandleMessage, and says how many runs are in flight and how the lane
+    weights are applied.
+    """
+
+    def __init__(self,
+                 dead_letters: Optional[DeadLetterQueue] = None,
+                 deduplication: Optional[DeduplicationStore] = None,
+                 lane_weights: Optional[LaneWeights] = None,
+                 high_water_mark: int = HIGH_WATER_MARK,
+                 low_water_mark: int = LOW_WATER_MARK):
+        self.logger = logging.getLogger(__package__)
+        if low_water_mark >= high_water_mark:
+            raise ValueError(f"The low-water mark ({low_water_mark}) must be below "
+                             f"the high-water mark ({high_water_mark})")
+
+        self.consumer = None
+        self.message_handler = None
+        # Each message is marked as completed in the offset tracker once it has
+        # been handled, so that its offset can be committed
+        self.offsets = OffsetTracker()
+        self._last_commit = time.monotonic()
+        self.lane_weights = lane_weights or LaneWeights()
+        self._last_weights_refresh = time.monotonic()
+
+        # The partitions of each lane paused because too many of its reductions
+        # are in flight. Only changed from the thread that polls, which also
+        # runs the rebalance callbacks
+        self.high_water_mark = high_water_mark
+        self.low_water_mark = low_water_mark
+        self.paused_partitions = {}
+        REDUCTIONS_IN_FLIGHT.set_function(lambda: {(lane, ): self.in_flight(lane) for lane in LANE_TOPICS})
+
+        # Messages that can't be processed are quarantined on the dead-letter topic
+        self.dead_letters = dead_letters or DeadLetterQueue()
+        # The messages that could not be published to the dead-letter topic, by
+        # topic, partition and offset, with why they were quarantined. They
+        # hold back their partition's commits until publishing them is retried
+        self._unpublished = {}
+        self._unpublished_lock = threading.Lock()
+        self._last_publish_retry = time.monotonic()
+        # Messages that have finished processing, so that redelivered copies are dropped
+        self.deduplication = deduplication or DeduplicationStore()
+
+    def in_flight(self, lane: Optional[str] = None) -> int:
+        """Return the number of runs being handled, in every lane or only in the given one."""
+        raise NotImplementedError
+
+    def scheduled_lane_weights(self) -> Dict[str, float]:
+        """Return the lane weights that reductions are currently being scheduled with."""
+        raise NotImplementedError
+
+    def set_lane_weight(self, lane: str, weight: float):
+        """Change the weight a lane's reductions are scheduled with."""
+        raise NotImplementedError
+
+    def kafka_config(self) -> dict:
+        """Return the configuration of the Kafka consumer, apart from any deserializers."""
+        config = kafka_config_from_env()
+        config['on_commit'] = self.on_commit
+        config['group.id'] = GROUP_ID
+        config['auto.offset.reset'] = 'earliest'
+        # Offsets are committed once the reduction has finished
+        config['enable.auto.commit'] = False
+        config['stats_cb'] = self.on_stats
+        config['statistics.interval.ms'] = STATS_INTERVAL_MS
+        return config
+
+    def refresh_lane_weights(self, force=False):
+        """Apply lane weights that have been changed at runtime"""
+        if not force and time.monotonic() - self._last_weights_refresh < LANE_WEIGHTS_REFRESH:
+            return
+
+        self._last_weights_refresh = time.monotonic()
+        current = self.scheduled_lane_weights()
+        for lane, weight in self.lane_weights.get_all().items():
+            if current.get(lane) != weight:
+                self.logger.info("Setting the weight of lane %s to %s", lane, weight)
+                self.set_lane_weight(lane, weight)
+
+    def apply_backpressure(self):
+        """
+        Pause a lane's assigned partitions when the number of its reductions in
+        flight reaches the high-water mark, and resume them once it has dropped
+        to the low-water mark. Lanes are paused separately so that a backlog of
+        reruns does not hold up live runs. Polling carries on while paused, so
+        the consumer does not exceed max.poll.interval.ms and get rebalanced
+        out of the group. Must be called on the thread that polls.
+        """
+        assignment = None
+        for lane, topic in LANE_TOPICS.items():
+            in_flight = self.in_flight(lane)
+            if lane not in self.paused_partitions and in_flight >= self.high_water_mark:
+                if assignment is None:
+                    assignment = self.consumer.assignment()
+                partitions = [partition for partition in assignment if partition.topic == topic]
+                if partitions:
+                    self.logger.info("%s reductions in flight in lane %s, pausing partitions: %s", in_flight, lane,
+                                     partitions)
+                    self.consumer.pause(partitions)
+                    self.paused_partitions[lane] = partitions
+            elif lane in self.paused_partitions and in_flight <= self.low_water_mark:
+                partitions = self.paused_partitions.pop(lane)
+                self.logger.info("%s reductions in flight in lane %s, resuming partitions: %s", in_flight, lane,
+                                 partitions)
+                self.consumer.resume(partitions)
+
+    def on_commit(self, error, partition_list):
+        """ Called when the consumer commits it's new offset """
+        self.logger.info("On Commit: Error: %s Partitions: %s", error, partition_list)
+
+    def on_assign(self, _, partitions):
+        """
+        Called after a rebalance when the consumer is given partitions. A new
+        assignment is not paused, so if too many reductions are still in flight
+        the next pass of the polling loop pauses it again.
+        """
+        self.logger.info("Assigned partitions: %s", partitions)
+        self.paused_partitions = {}
+
+    def forget_partitions(self, partitions) -> Set[Tuple[str, int]]:
+        """
+        Commit what has completed and stop tracking partitions that are being
+        revoked. Called on the thread that polls, before a rebalance takes them
+        away.
+
+        Returns:
+            The revoked (topic, partition) pairs.
+        """
+        self.logger.info("Revoking partitions: %s", partitions)
+        self.commit_completed(force=True, asynchronous=False)
+        revoked = {(partition.topic, partition.partition) for partition in partitions}
+        self.offsets.forget(revoked)
+        with self._unpublished_lock:
+            # The new owner quarantines them again
+            for topic, partition, offset in list(self._unpublished):
+                if (topic, partition) in revoked:
+                    del self._unpublished[(topic, partition, offset)]
+        for topic, partition in revoked:
+            CONSUMER_LAG.remove(topic=topic, partition=partition)
+        for lane, paused in list(self.paused_partitions.items()):
+            paused = [partition for partition in paused if (partition.topic, partition.partition) not in revoked]
+            if paused:
+                self.paused_partitions[lane] = paused
+            else:
+                del self.paused_partitions[lane]
+        return revoked
+
+    @staticmethod
+    def on_stats(stats_json):
+        """ Called with librdkafka's statistics. Records the consumer lag of each assigned partition """
+        stats = json.loads(stats_json)
+        for topic, topic_stats in stats.get("topics", {}).items():
+            for partition, partition_stats in topic_stats.get("partitions", {}).items():
+                # Partition -1 is librdkafka's internal unassigned partition,
+                # and the lag is -1 until the partition's offsets are known
+                lag = partition_stats.get("consumer_lag", -1)
+                if partition != "-1" and lag >= 0:
+                    CONSUMER_LAG.set(lag, topic=topic, partition=partition)
+
+    @staticmethod
+    def ordering_key(incoming_message, message: Message):
+        """
+        Return the key that runs must be processed in order for. This is the
+        Kafka message key if the producer set one, otherwise the instrument and
+        RB number, because run versions are allocated per experiment.
+        """
+        return incoming_message.key() or f"{message.instrument}/{message.rb_number}"
+
+    def track(self, incoming_message):
+        """ Record that a message has been received and is being processed """
+        MESSAGES_RECEIVED.inc(topic=incoming_message.topic())
+        self.offsets.track(incoming_message.topic(), incoming_message.partition(), incoming_message.offset())
+
+    def mark_completed(self, incoming_message):
+        """ Record that a message has finished processing and its offset can be committed """
+        MESSAGES_COMPLETED.inc(topic=incoming_message.topic())
+        self.deduplication.record(incoming_message)
+        self.offsets.complete(incoming_message.topic(), incoming_message.partition(), incoming_message.offset())
+
+    def commit_completed(self, force=False, asynchronous=True):
+        """
+        Commit, for each partition, the offset below which every message has
+        finished processing. Commits are batched, and only happen once enough
+        messages have completed or enough time has passed, unless forced. Must
+        be called on the thread that polls.
+        """
+        if not force and self.offsets.completed_since_commit() < COMMIT_BATCH_SIZE \
+                and time.monotonic() - self._last_commit < COMMIT_INTERVAL:
+            return
+
+        self._last_commit = time.monotonic()
+        offsets = self.offsets.committable()
+        if offsets:
+            self.consumer.commit(offsets=offsets, asynchronous=asynchronous)
+
+    def drop_duplicate(self, incoming_message) -> bool:
+        """
+        Drop a message that has already been processed, marking it completed.
+
+        Returns:
+            True if the message was dropped.
+        """
+        if not self.deduplication.seen(incoming_message):
+            return False
+
+        self.logger.info("Dropping message from %s that has already been processed: %s", incoming_message.topic(),
+                         incoming_message.value())
+        self.mark_completed(incoming_message)
+        return True
+
+    def count_attempt(self, incoming_message) -> bool:
+        """
+        Count an attempt at processing a message, quarantining it instead if it
+        has already used up its attempts.
+
+        Returns:
+            True if the message should be processed.
+        """
+        if self.dead_letters.start_attempt(incoming_message):
+            return True
+
+        self.quarantine(incoming_message,
+                        f"Processing was started {self.dead_letters.max_attempts} times without finishing")
+        return False
+
+    def start_attempt(self, incoming_message) -> bool:
+        """
+        Drop a message that has already been processed, otherwise count an
+        attempt at processing it.
+
+        Returns:
+            True if the message should be processed.
+        """
+        return not self.drop_duplicate(incoming_message) and self.count_attempt(incoming_message)
+
+    def succeeded(self, incoming_message):
+        """ Forget the attempts at a message that has been processed, and mark it completed """
+        try:
+            self.dead_letters.succeeded(incoming_message)
+        finally:
+            self.mark_completed(incoming_message)
+
+    def quarantine(self, incoming_message, reason: str):
+        """
+        Quarantine a message, and mark it completed once it has been published
+        to the dead-letter topic. If it couldn't be, publishing it is retried
+        by retry_quarantines, and its offset is not committed until then.
+        """
+        if self.dead_letters.quarantine(incoming_message, reason):
+            self.mark_completed(incoming_message)
+            return
+
+        self.logger.warning("Retrying quarantining message from %s in %s seconds", incoming_message.topic(),
+                            DEAD_LETTER_RETRY_INTERVAL)
+        with self._unpublished_lock:
+            self._unpublished[(incoming_message.topic(), incoming_message.partition(),
+                               incoming_message.offset())] = (incoming_message, reason)
+
+    def retry_quarantines(self, force=False):
+        """
+        Retry publishing the messages that could not be published to the
+        dead-letter topic, marking them completed once they have been. Retries
+        happen every DEAD_LETTER_RETRY_INTERVAL seconds, unless forced. Must be
+        called on the thread that polls.
+        """
+        if not force and time.monotonic() - self._last_publish_retry < DEAD_LETTER_RETRY_INTERVAL:
+            return
+
+        self._last_publish_retry = time.monotonic()
+        with self._unpublished_lock:
+            unpublished = list(self._unpublished.items())
+        for key, (incoming_message, reason) in unpublished:
+            if not self.dead_letters.quarantine(incoming_message, reason):
+                # The dead-letter topic is still unavailable
+                return
+            with self._unpublished_lock:
+                self._unpublished.pop(key, None)
+            self.mark_completed(incoming_message)
+
+    def retry_or_quarantine(self, incoming_message, exp: Exception) -> bool:
+        """
+        Count another attempt at a message whose handling failed, quarantining
+        it instead once it has used up its attempts.
+
+        Returns:
+            True if the message should be handled again.
+        """
+        if self.dead_letters.start_attempt(incoming_message):
+            self.logger.info("Retrying message from %s after %s: %s", incoming_message.topic(),
+                             type(exp).__name__, incoming_message.value())
+            return True
+
+        self.quarantine(incoming_message,
+                        f"Failed {self.dead_letters.max_attempts} times, last with {type(exp).__name__}: {exp}")
+        return False
+
+    def on_handler_exception(self, incoming_message, exp: Exception) -> bool:
+        """
+        Log an exception raised by the handler, then retry or quarantine the
+        message that caused it.
+
+        Returns:
+            True if the message should be handled again.
+        """
+        self.logger.error("Unhandled exception encountered: %s %s\n\n%s",
+                          type(exp).__name__, exp,
+                          "".join(traceback.format_exception(type(exp), exp, exp.__traceback__)))
+        return self.retry_or_quarantine(incoming_message, exp)
+
+    def requeued(self, incoming_message):
+        """
+        Leave a message whose run was requeued while it was being reduced
+        uncompleted, giving back its attempt, so that it is delivered again
+        and resumes the run.
+        """
+        self.logger.info("Run of message from %s was requeued, it will be processed again: %s",
+                         incoming_message.topic(), incoming_message.value())
+        self.dead_letters.cancel_attempt(incoming_message)
+
+    def requeue_unfinished(self):
+        """Requeue the runs still being reduced once the drain deadline has passed."""
+        requeued = self.message_handler.requeue_active_runs()
+        self.logger.warning("Drain deadline passed, requeued %s unfinished runs", len(requeued))
+
+    def close_consumer(self):
+        """Commit what has completed and close the Kafka consumer. Must be called on the thread that polls."""
+        self.retry_quarantines(force=True)
+        self.commit_completed(force=True, asynchronous=False)
+        self.consumer.close()
@@ -1,110 +1,423 @@
 from contextlib import contextmanager
+from functools import partial
+import signal
 import threading
+import time
 import traceback
 import logging
 import os
-from typing import Tuple
+from typing import List, Tuple
 from pydantic import ValidationError
-from confluent_kafka import DeserializingConsumer, KafkaException
+from confluent_kafka import Consumer as KafkaConsumer, DeserializingConsumer, KafkaException
 from confluent_kafka.serialization import StringDeserializer
 from autoreduce_utils.clients.connection_exception import ConnectionException
 from autoreduce_utils.message.message import Message
 from autoreduce_utils.clients.producer import Publisher
-from autoreduce_utils.clients.kafka_utils import kafka_config_from_env
-from autoreduce_qp.queue_processor.handle_message import HandleMessage
-
-TRANSACTIONS_TOPIC = os.getenv('KAFKA_TOPIC')
+from autoreduce_qp.queue_processor.base_consumer import (DRAIN_TIMEOUT, HIGH_WATER_MARK, INSTRUMENT_CONCURRENCY,
+                                                         LOW_WATER_MARK, REDUCTION_WORKERS, RETRY_DELAY, BaseConsumer)
+from autoreduce_qp.queue_processor.handle_message import HandleMessage, RunRequeued
+from autoreduce_qp.queue_processor.lanes import LANE_TOPICS, LIVE_LANE, lane_for_topic
+from autoreduce_qp.queue_processor.metrics import METRICS_PORT, start_metrics_server
+from autoreduce_qp.queue_processor.pipeline import ReductionPipeline
+from autoreduce_qp.queue_processor.worker_pool import ReductionWorkerPool
+
+TRANSACTIONS_TOPIC = LANE_TOPICS[LIVE_LANE]
 KAFKA_BROKER_URL = os.getenv("KAFKA_BROKER_URL")
-GROUP_ID = 'data_ready-group'
-
-
-class Consumer(threading.Thread):
+# The maximum number of messages fetched at once. With more than 1 the messages
+# are fetched with consume() and their records are created as a batch
+BATCH_SIZE = int(os.getenv("AUTOREDUCE_QP_BATCH_SIZE", "1"))
+# The consumer engine: "thread" for the worker pool, or "asyncio" for the
+# event loop in async_consumer
+ENGINE = os.getenv("AUTOREDUCE_QP_ENGINE", "thread")
+# Whether data_ready messages are handled by the intake, scheduling and
+# execution stages of the pipeline, so that their runs are queued straight away
+PIPELINE = os.getenv("AUTOREDUCE_QP_PIPELINE", "false").lower() == "true"
+
+
+class Consumer(threading.Thread, BaseConsumer):
     """ A class to read messages from a Kafka topic """
 
-    def __init__(self, consumer=None):
-        super().__init__()
-        self.logger = logging.getLogger(__package__)
+    # pylint:disable=too-many-arguments
+    def __init__(self,
+                 consumer=None,
+                 workers=REDUCTION_WORKERS,
+                 instrument_concurrency=INSTRUMENT_CONCURRENCY,
+                 batch_size=BATCH_SIZE,
+                 dead_letters=None,
+                 high_water_mark=HIGH_WATER_MARK,
+                 low_water_mark=LOW_WATER_MARK,
+                 lane_weights=None,
+                 deduplication=None,
+                 pipeline=PIPELINE):
+        threading.Thread.__init__(self)
+        BaseConsumer.__init__(self,
+                              dead_letters=dead_letters,
+                              deduplication=deduplication,
+                              lane_weights=lane_weights,
+                              high_water_mark=high_water_mark,
+                              low_water_mark=low_water_mark)
         self.logger.debug("Initializing the consumer")
 
         self.consumer = consumer
+        self.batch_size = batch_size
         self.message_handler = HandleMessage()
         self._stop_event = threading.Event()
-
-        # Track whether there is currently a message being processed. Just a raw
-        # bool is OK because the subscription is configured to prefetch 1
-        # message at a time - i.e. this function should NOT run in parallel
+        # Set when the polling loop has exited and the consumer is closed
+        self._finished = threading.Event()
+        # When draining, the time by which the reductions in flight must finish
+        self._drain_deadline = None
+
+        # Reductions run on the pool, and each message is marked as completed
+        # once its reduction has finished so that the polling thread can commit
+        # its offset
+        self.pool = ReductionWorkerPool(max_workers=workers,
+                                        instrument_limit=instrument_concurrency,
+                                        lane_weights=self.lane_weights.get_all())
+        # With the pipeline, the records of runs are created as soon as they
+        # are consumed, and the pool only reduces them
+        self.pipeline = ReductionPipeline(
+            self.message_handler, self.pool, self.finish_run, release=self.release_discarded) if pipeline else None
+
+        # Track whether a message is currently being dispatched. Just a raw bool
+        # is OK because messages are only dispatched from the polling thread
         self._processing = False
 
         while self.consumer is None:
             try:
                 self.logger.debug("Getting the kafka consumer")
 
-                config = kafka_config_from_env()
-
-                config['key.deserializer'] = StringDeserializer('utf_8')
-                config['value.deserializer'] = StringDeserializer('utf_8')
-                config['on_commit'] = self.on_commit
-                config['group.id'] = GROUP_ID
-                config['auto.offset.reset'] = 'earliest'
-                self.consumer = DeserializingConsumer(config)
+                config = self.kafka_config()
+                if self.batch_size > 1:
+                    # consume() does not support deserializers, so the values
+                    # are decoded when the batch is parsed
+                    self.consumer = KafkaConsumer(config)
+                else:
+                    config['key.deserializer'] = StringDeserializer('utf_8')
+                    config['value.deserializer'] = StringDeserializer('utf_8')
+                    self.consumer = DeserializingConsumer(config)
             except KafkaException as err:
                 self.logger.error("Could not initialize the consumer: %s", err)
                 raise ConnectionException("Could not initialize the consumer") from err
 
-        self.consumer.subscribe([TRANSACTIONS_TOPIC])
+        self.consumer.subscribe(list(LANE_TOPICS.values()), on_assign=self.on_assign, on_revoke=self.on_revoke)
 
     def run(self):
         """ Run the consumer """
-        while not self._stop_event.is_set():
-            msg = self.consumer.poll(timeout=1.0)
-            if msg is None:
-                continue
-            if not msg.error():
-                self.on_message(msg)
+        try:
+            while not self._stop_event.is_set():
+                self.retry_quarantines()
+                self.commit_completed()
+                self.refresh_lane_weights()
+                self.apply_backpressure()
+                if self.batch_size > 1:
+                    self.consume_batch()
+                    continue
+
+                msg = self.consumer.poll(timeout=1.0)
+                if msg is None:
+                    continue
+                if not msg.error():
+                    self.on_message(msg)
+                else:
+                    self.logger.error("Undefined error in consumer loop")
+                    raise KafkaException(msg.error())
+                if self._stop_event.is_set():
+                    self.logger.info("Stopping the consumer")
+                    break
+
+            if self._drain_deadline is None:
+                if self.pipeline is not None:
+                    self.pipeline.close()
+                self.pool.shutdown()
             else:
-                self.logger.error("Undefined error in consumer loop")
-                raise KafkaException(msg.error())
-            if self._stop_event.is_set():
-                self.logger.info("Stopping the consumer")
-                break
+                self.finish_draining()
+            self.message_handler.close()
+            self.close_consumer()
+        finally:
+            self._finished.set()
+
+    def consume_batch(self):
+        """ Fetch up to batch_size messages and handle them together """
+        incoming_messages = self.consumer.consume(num_messages=self.batch_size, timeout=1.0)
+        if not incoming_messages:
+            return
+
+        errors = [incoming_message.error() for incoming_message in incoming_messages if incoming_message.error()]
+        if errors:
+            self.logger.error("Undefined error in consumer loop")
+            raise KafkaException(errors[0])
 
-        self.consumer.close()
+        self.on_messages(incoming_messages)
 
     def stop(self):
         """ Stop the consumer """
         self._stop_event.set()
 
+    def drain(self, timeout: float = DRAIN_TIMEOUT) -> bool:
+        """
+        Stop fetching messages and wait up to `timeout` seconds for the
+        reductions in flight to finish. Reductions that haven't started are
+        dropped, and those still running at the deadline are requeued, so only
+        the offsets of finished messages are committed and the rest are
+        delivered again after a restart.
+
+        Returns:
+            True if every reduction finished before the deadline.
+        """
+        self.logger.info("Draining the consumer, waiting up to %s seconds for reductions in flight", timeout)
+        self._drain_deadline = time.monotonic() + timeout
+        self.stop()
+        # The polling loop notices the stop within one poll timeout
+        self._finished.wait(timeout + 5)
+        return self.in_flight() == 0
+
+    def finish_draining(self):
+        """
+        Wait until the drain deadline for the running reductions, then requeue
+        any that have not finished. Called on the polling thread once it has
+        stopped fetching.
+        """
+        discarded = []
+        if self.pipeline is not None:
+            discarded = self.pipeline.discard()
+            self.pipeline.close()
+        discarded += self.pool.discard_pending()
+        if discarded:
+            self.logger.info("Dropped %s pending reductions while draining", len(discarded))
+            self.release_discarded(discarded)
+
+        if not self.pool.wait(timeout=max(0.0, self._drain_deadline - time.monotonic())):
+            self.requeue_unfinished()
+        self.pool.shutdown(wait=False)
+
+    def release_discarded(self, discarded):
+        """
+        Give back the attempts counted for dropped messages, as they were never
+        processed, and leave their runs whose records were already created
+        queued, to be resumed when the message is delivered again.
+
+        Args:
+            discarded: The arguments of the dropped tasks.
+        """
+        for args in discarded:
+            self.dead_letters.cancel_attempt(args[0])
+        runs = [
+            args[1][0] for args in discarded
+            if len(args) > 1 and args[1] is not None and not isinstance(args[1], Message)
+        ]
+        if runs:
+            self.message_handler.requeue_runs(runs)
+
+    def in_flight(self, lane=None) -> int:
+        """ Return the number of runs being handled, in every lane or only in the given one """
+        if self.pipeline is not None:
+            return self.pipeline.in_flight(lane)
+        return self.pool.in_flight(lane)
+
+    def scheduled_lane_weights(self):
+        return self.pool.lane_weights()
+
+    def set_lane_weight(self, lane, weight):
+        self.pool.set_lane_weight(lane, weight)
+
     def stopped(self):
         """ Return whether the consumer has been stopped """
         return self._stop_event.is_set()
 
-    def on_commit(self, error, partition_list):
-        """ Called when the consumer commits it's new offset """
-        self.logger.info("On Commit: Error: %s Partitions: %s", error, partition_list)
+    def on_revoke(self, _, partitions):
+        """
+        Called before a rebalance takes partitions away from the consumer.
+        Reductions that have not started yet are dropped, as their offsets are
+        uncommitted they will be delivered in order to the new owner.
+        """
+        revoked = self.forget_partitions(partitions)
+        discarded = []
+        if self.pipeline is not None:
+            # Before the pool, so that it discards the runs the pipeline
+            # handed to it in the meantime
+            discarded = self.pipeline.discard(revoked)
+        discarded += self.pool.discard_partitions(revoked)
+        if discarded:
+            self.logger.info("Dropped %s pending reductions from revoked partitions", len(discarded))
+            self.release_discarded(discarded)
 
     def on_message(self, incoming_message):
         """ Handle a message """
         with self.mark_processing():
             topic = incoming_message.topic()
             data = incoming_message.value()
+            self.track(incoming_message)
             try:
                 message = Message.parse_raw(data)
             except (ValidationError, TypeError):
                 self.logger.error("Could not decode message: %s", data)
+                self.quarantine(incoming_message, "Could not decode message")
                 return
 
+            lane = lane_for_topic(topic)
+            if lane is not None:
+                if not self.start_attempt(incoming_message):
+                    return
+                if self.pipeline is not None:
+                    self.pipeline.put(incoming_message,
+                                      message,
+                                      key=self.ordering_key(incoming_message, message),
+                                      partition=(topic, incoming_message.partition()),
+                                      lane=lane)
+                    return
+                self.pool.submit(message.instrument,
+                                 self.process_data_ready,
+                                 incoming_message,
+                                 message,
+                                 key=self.ordering_key(incoming_message, message),
+                                 partition=(topic, incoming_message.partition()),
+                                 lane=lane)
+            else:
+                self.logger.error("Received a message on an unknown topic '%s'", topic)
+                self.mark_completed(incoming_message)
+
+    @staticmethod
+    def parse_messages(incoming_messages) -> Tuple[List[Tuple[object, Message]], list]:
+        """
+        Parse a batch of Kafka messages in a single pass.
+
+        Returns:
+            A list of (Kafka message, parsed Message) pairs, and a list of the
+            Kafka messages that could not be decoded.
+        """
+        parsed, rejected = [], []
+        for incoming_message in incoming_messages:
+            data = incoming_message.value()
             try:
-                if topic == 'data_ready':
-                    self.message_handler.data_ready(message)
+                if isinstance(data, bytes):
+                    data = data.decode('utf_8')
+                parsed.append((incoming_message, Message.parse_raw(data)))
+            except (ValidationError, TypeError, UnicodeDecodeError):
+                rejected.append(incoming_message)
+
+        return parsed, rejected
+
+    def on_messages(self, incoming_messages):
+        """
+        Handle a batch of messages. The records for every data_ready message
+        are created together, in the order they were received, before the
+        reductions are dispatched to the pool. With the pipeline, the messages
+        are queued for its intake stage instead.
+        """
+        with self.mark_processing():
+            for incoming_message in incoming_messages:
+                self.track(incoming_message)
+
+            parsed, rejected = self.parse_messages(incoming_messages)
+            if rejected:
+                self.logger.error("Could not decode %s messages: %s", len(rejected),
+                                  [incoming_message.value() for incoming_message in rejected])
+                for incoming_message in rejected:
+                    self.quarantine(incoming_message, "Could not decode message")
+
+            data_ready = []
+            for incoming_message, message in parsed:
+                if lane_for_topic(incoming_message.topic()) is not None:
+                    if self.start_attempt(incoming_message):
+                        data_ready.append((incoming_message, message))
                 else:
-                    self.logger.error("Received a message on an unknown topic '%s'", topic)
-            except Exception as exp:  # pylint:disable=broad-except
-                self.logger.error("Unhandled exception encountered: %s %s\n\n%s",
-                                  type(exp).__name__, exp, traceback.format_exc())
+                    self.logger.error("Received a message on an unknown topic '%s'", incoming_message.topic())
+                    self.mark_completed(incoming_message)
+
+            if not data_ready:
+                return
+
+            if self.pipeline is not None:
+                for incoming_message, message in data_ready:
+                    self.pipeline.put(incoming_message,
+                                      message,
+                                      key=self.ordering_key(incoming_message, message),
+                                      partition=(incoming_message.topic(), incoming_message.partition()),
+                                      lane=lane_for_topic(incoming_message.topic()))
+                return
+
+            run_records = self.message_handler.data_ready_batch([message for _, message in data_ready])
+            self.submit_run_records(data_ready, run_records)
+
+    def submit_run_records(self, data_ready, run_records):
+        """
+        Submit the reductions of runs whose records were created as a batch to
+        the pool. A message whose records could not be created is retried on
+        its own, or quarantined once it has used up its attempts.
+        """
+        for (incoming_message, message), records in zip(data_ready, run_records):
+            if isinstance(records, Exception):
+                # The handler has logged the error
+                if not self.retry_or_quarantine(incoming_message, records):
+                    continue
+                process, arg = self.process_data_ready, message
+            else:
+                process, arg = self.process_run_records, records
+
+            self.pool.submit(message.instrument,
+                             process,
+                             incoming_message,
+                             arg,
+                             key=self.ordering_key(incoming_message, message),
+                             partition=(incoming_message.topic(), incoming_message.partition()),
+                             lane=lane_for_topic(incoming_message.topic()))
+
+    def process_run_records(self, incoming_message, run_records):
+        """ Reduce a run whose records were created as part of a batch. Called on a worker thread """
+        try:
+            self.message_handler.process_run_records(*run_records)
+        except RunRequeued:
+            self.requeued(incoming_message)
+        except Exception as exp:  # pylint:disable=broad-except
+            if self.on_handler_exception(incoming_message, exp):
+                self.retry(incoming_message)
+        else:
+            self.succeeded(incoming_message)
+
+    def process_data_ready(self, incoming_message, message: Message):
+        """ Run the handler for a data_ready message. Called on a worker thread """
+        try:
+            self.message_handler.data_ready(message)
+        except RunRequeued:
+            self.requeued(incoming_message)
+        except Exception as exp:  # pylint:disable=broad-except
+            if self.on_handler_exception(incoming_message, exp):
+                self.retry(incoming_message)
+        else:
+            self.succeeded(incoming_message)
+
+    def retry(self, incoming_message):
+        """
+        Handle a message whose handling failed again from the start, after
+        RETRY_DELAY seconds, or straight away if the consumer is stopping.
+        Called on a worker thread.
+        """
+        self._stop_event.wait(RETRY_DELAY)
+        # The handler fills in the message, so a fresh copy is parsed
+        self.process_data_ready(incoming_message, Message.parse_raw(incoming_message.value()))
+
+    def finish_run(self, incoming_message, exp=None):
+        """
+        Record the outcome of a message handled by the pipeline, retrying or
+        quarantining it if it failed. Called on a pipeline or worker thread.
+        The pipeline has logged the error.
+        """
+        if exp is None:
+            self.succeeded(incoming_message)
+        elif isinstance(exp, RunRequeued):
+            self.requeued(incoming_message)
+        elif self.retry_or_quarantine(incoming_message, exp):
+            message = Message.parse_raw(incoming_message.value())
+            self.pool.submit(message.instrument,
+                             self.retry,
+                             incoming_message,
+                             key=self.ordering_key(incoming_message, message),
+                             partition=(incoming_message.topic(), incoming_message.partition()),
+                             lane=lane_for_topic(incoming_message.topic()))
 
     def is_processing_message(self):
-        """Return the processing state."""
-        return self._processing
+        """Return whether a message is being dispatched or a reduction is still in flight."""
+        return self._processing or self.in_flight() > 0
 
     @contextmanager
     def mark_processing(self):
@@ -145,17 +458,38 @@ def setup_kafka_connections() -> Tuple[Publisher, Consumer]:
     return publisher, consumer
 
 
+def drain_and_exit(consumer: Consumer, *_):
+    """
+    Signal handler that drains the consumer and exits. Reductions still running
+    after the drain have been requeued, so the process exits without waiting
+    for their worker threads.
+    """
+    consumer.drain()
+    logging.getLogger(__package__).info("Consumer drained, exiting")
+    logging.shutdown()
+    os._exit(0)  # pylint:disable=protected-access
+
+
 def main():
     """Entry point for the module."""
+    if ENGINE == "asyncio":
+        # pylint:disable=import-outside-toplevel,cyclic-import
+        from autoreduce_qp.queue_processor import async_consumer
+        async_consumer.main()
+        return
+
     logger = logging.getLogger(__package__)
     try:
-        setup_connection()
+        consumer = setup_connection()
     except ConnectionException as exp:
         logger.error("Exception occurred while connecting: %s %s\n\n%s",
                      type(exp).__name__, exp, traceback.format_exc())
         raise
 
+    signal.signal(signal.SIGTERM, partial(drain_and_exit, consumer))
     logger.info("Kafka consumer started.")
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
 
 
 if __name__ == '__main__':
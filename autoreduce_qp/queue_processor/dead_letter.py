@@ -0,0 +1,209 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""
+Quarantine of messages that the queue processor cannot process, and a command
+line tool to inspect and replay them.
+
+Quarantined messages are published unchanged to the dead-letter topic, with
+headers recording the topic they came from and why they were quarantined.
+"""
+import hashlib
+import logging
+import os
+from typing import Optional
+
+import fire
+from confluent_kafka import DeserializingConsumer, KafkaException
+from confluent_kafka.serialization import StringDeserializer
+from autoreduce_utils.clients.kafka_utils import kafka_config_from_env
+from autoreduce_utils.clients.producer import Publisher
+
+from autoreduce_qp.queue_processor.local_store import LocalStore
+from autoreduce_qp.queue_processor.metrics import MESSAGES_QUARANTINED
+
+DEAD_LETTER_TOPIC = os.getenv("KAFKA_DEAD_LETTER_TOPIC", "data_ready_dead_letter")
+REPLAY_GROUP_ID = 'data_ready_dead_letter-replay-group'
+# The number of times processing of a message may be started before it is
+# quarantined instead, e.g. because it keeps crashing the queue processor
+MAX_ATTEMPTS = int(os.getenv("AUTOREDUCE_QP_MAX_ATTEMPTS", "3"))
+
+logger = logging.getLogger(__file__)
+
+
+class DeadLetterQueue:
+    """
+    Counts the attempts made at each message and publishes the messages that
+    cannot be processed to the dead-letter topic.
+
+    Attempts are counted in a LocalStore before processing starts, so that a
+    message which takes the whole queue processor down is still counted when it
+    is delivered again after the restart.
+    """
+
+    def __init__(self,
+                 publisher: Optional[Publisher] = None,
+                 store: Optional[LocalStore] = None,
+                 topic: str = DEAD_LETTER_TOPIC,
+                 max_attempts: int = MAX_ATTEMPTS):
+        self._publisher = publisher
+        self.store = store or LocalStore("message_attempts")
+        self.topic = topic
+        self.max_attempts = max_attempts
+
+    @property
+    def publisher(self) -> Publisher:
+        """The publisher for the dead-letter topic, created when first needed."""
+        if self._publisher is None:
+            self._publisher = Publisher()
+        return self._publisher
+
+    @staticmethod
+    def message_key(incoming_message) -> str:
+        """Return a key identifying a message by its topic and contents."""
+        value = incoming_message.value() or b""
+        if isinstance(value, str):
+            value = value.encode("utf_8")
+        return hashlib.sha256(incoming_message.topic().encode("utf_8") + b"\0" + value).hexdigest()
+
+    def start_attempt(self, incoming_message) -> bool:
+        """
+        Count an attempt at processing a message.
+
+        Returns:
+            False if the message has used up its attempts and should be
+            quarantined instead of processed.
+        """
+        return self.store.increment(self.message_key(incoming_message)) <= self.max_attempts
+
+    def cancel_attempt(self, incoming_message):
+        """Give back the attempt counted for a message that was dropped before it was processed."""
+        self.store.decrement(self.message_key(incoming_message))
+
+    def succeeded(self, incoming_message):
+        """Forget the attempts made at a message that has been processed."""
+        self.store.delete(self.message_key(incoming_message))
+
+    def quarantine(self, incoming_message, reason: str) -> bool:
+        """
+        Publish a message to the dead-letter topic. Failing to publish is logged
+        rather than raised, as the message can't be processed either way.
+
+        Returns:
+            True if the message was published. Otherwise it must not be marked
+            completed until publishing it has been retried.
+        """
+        logger.warning("Quarantining message from %s to %s: %s", incoming_message.topic(), self.topic, reason)
+        try:
+            self.publisher.producer.produce(self.topic,
+                                            incoming_message.value(),
+                                            incoming_message.key(),
+                                            headers={
+                                                "original_topic": incoming_message.topic(),
+                                                "reason": reason,
+                                            },
+                                            callback=Publisher.delivery_report)
+            # The number of messages still waiting to be delivered
+            undelivered = self.publisher.producer.flush(2)
+        except (BufferError, KafkaException):
+            logger.exception("Could not publish message to dead-letter topic %s: %s", self.topic,
+                             incoming_message.value())
+            return False
+
+        if undelivered:
+            logger.error("Timed out publishing message to dead-letter topic %s: %s", self.topic,
+                         incoming_message.value())
+            return False
+
+        MESSAGES_QUARANTINED.inc(topic=incoming_message.topic())
+        self.store.delete(self.message_key(incoming_message))
+        return True
+
+
+class DeadLetterReplay:
+    """
+    Inspect and replay the messages on the dead-letter topic.
+
+    Args:
+        topic: The dead-letter topic to read from.
+        timeout: Seconds to wait for more messages before deciding the topic
+        has been read to the end.
+    """
+
+    def __init__(self, topic: str = DEAD_LETTER_TOPIC, timeout: float = 5.0, consumer=None, publisher=None):
+        self.topic = topic
+        self.timeout = timeout
+        self._consumer = consumer
+        self._publisher = publisher
+
+    def _get_consumer(self):
+        if self._consumer is None:
+            config = kafka_config_from_env()
+            config['key.deserializer'] = StringDeserializer('utf_8')
+            config['value.deserializer'] = StringDeserializer('utf_8')
+            config['group.id'] = REPLAY_GROUP_ID
+            config['auto.offset.reset'] = 'earliest'
+            config['enable.auto.commit'] = False
+            self._consumer = DeserializingConsumer(config)
+            self._consumer.subscribe([self.topic])
+        return self._consumer
+
+    def _quarantined_messages(self):
+        """Yield the messages on the dead-letter topic that have not been replayed."""
+        consumer = self._get_consumer()
+        while True:
+            msg = consumer.poll(timeout=self.timeout)
+            if msg is None:
+                return
+            if msg.error():
+                raise KafkaException(msg.error())
+            yield msg
+
+    @staticmethod
+    def _headers(msg) -> dict:
+        return {key: value.decode("utf_8") for key, value in (msg.headers() or [])}
+
+    def list(self):
+        """Print the quarantined messages that have not been replayed."""
+        try:
+            for msg in self._quarantined_messages():
+                headers = self._headers(msg)
+                print(f"[{msg.offset()}] from {headers.get('original_topic')}: {headers.get('reason')}\n{msg.value()}")
+        finally:
+            self._get_consumer().close()
+
+    def replay(self):
+        """
+        Publish every quarantined message that has not been replayed back to the
+        topic it came from.
+
+        Returns:
+            The number of messages replayed.
+        """
+        publisher = self._publisher or Publisher()
+        consumer = self._get_consumer()
+        replayed = 0
+        try:
+            for msg in self._quarantined_messages():
+                original_topic = self._headers(msg)["original_topic"]
+                publisher.producer.produce(original_topic, msg.value(), msg.key(), callback=Publisher.delivery_report)
+                if publisher.producer.flush(2):
+                    # Left uncommitted, to be replayed next time
+                    logger.error("Timed out replaying dead-letter message %s to %s", msg.offset(), original_topic)
+                    break
+                consumer.commit(message=msg, asynchronous=False)
+                replayed += 1
+                logger.info("Replayed dead-letter message %s to %s", msg.offset(), original_topic)
+        finally:
+            consumer.close()
+
+        return replayed
+
+
+def main():
+    """Entry point for the dead-letter command line tool."""
+    fire.Fire(DeadLetterReplay)
@@ -0,0 +1,88 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""
+Deduplication of messages that Kafka delivers again, e.g. after a rebalance or
+a restart between a reduction finishing and its offset being committed.
+
+Each message that finishes processing is recorded in a LocalStore, so that a
+redelivered copy can be dropped before any records are created in the database
+or a container is started.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+from autoreduce_qp.queue_processor.local_store import LocalStore
+
+# The number of seconds a processed message is remembered for. Set to 0 to turn
+# deduplication off
+DEDUPLICATION_TTL = float(os.getenv("AUTOREDUCE_QP_DEDUPLICATION_TTL", "86400"))
+# How often, in seconds, expired messages are removed from the store
+PURGE_INTERVAL = 3600
+
+logger = logging.getLogger(__file__)
+
+
+class DeduplicationStore:
+    """
+    Remembers the messages that have finished processing for `ttl` seconds.
+
+    A message is identified by the run it is for, its position in Kafka and a
+    hash of its contents. The position is included so that a run deliberately
+    submitted again, which is published at a new offset, is still processed.
+    """
+
+    def __init__(self, store: Optional[LocalStore] = None, ttl: float = DEDUPLICATION_TTL):
+        self.store = store or LocalStore("processed_messages")
+        self.ttl = ttl
+        self._last_purge = time.monotonic()
+
+    @staticmethod
+    def message_key(incoming_message) -> str:
+        """
+        Return the key of a message: its instrument, RB number, run number and
+        data location, its topic, partition and offset, and a hash of its value.
+        """
+        value = incoming_message.value() or b""
+        if isinstance(value, str):
+            value = value.encode("utf_8")
+        try:
+            fields = json.loads(value)
+        except ValueError:
+            fields = None
+        if not isinstance(fields, dict):
+            fields = {}
+
+        run = "/".join(str(fields.get(name, "")) for name in ("instrument", "rb_number", "run_number", "data"))
+        position = f"{incoming_message.topic()}:{incoming_message.partition()}:{incoming_message.offset()}"
+        return f"{run}|{position}|{hashlib.sha256(value).hexdigest()}"
+
+    def seen(self, incoming_message) -> bool:
+        """Return whether the message has finished processing within the last `ttl` seconds."""
+        if self.ttl <= 0:
+            return False
+        expires = self.store.get(self.message_key(incoming_message))
+        return expires is not None and float(expires) > time.time()
+
+    def record(self, incoming_message):
+        """Remember that the message has finished processing."""
+        if self.ttl <= 0:
+            return
+        self.store.set(self.message_key(incoming_message), str(time.time() + self.ttl))
+        if time.monotonic() - self._last_purge >= PURGE_INTERVAL:
+            self.purge()
+
+    def purge(self):
+        """Forget the messages whose time to live has passed."""
+        self._last_purge = time.monotonic()
+        purged = self.store.delete_below(time.time())
+        if purged:
+            logger.debug("Removed %s expired messages from the deduplication store", purged)
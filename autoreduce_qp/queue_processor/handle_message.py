@@ -13,7 +13,9 @@ This may include shuffling the message to another queue, updating relevant DB
 fields, or logging of the status.
 """
 import logging
-from typing import Optional
+import threading
+import time
+from typing import Dict, List, Optional, Tuple, Union
 
 from django.db import transaction
 from django.utils import timezone
@@ -23,7 +25,24 @@ from autoreduce_db.reduction_viewer.models import (Experiment, Instrument, Reduc
 from autoreduce_utils.message.message import Message
 from autoreduce_qp.model.database import access as db_access
 from autoreduce_qp.model.database import records
+from autoreduce_qp.queue_processor.log_storage import LogStore
 from autoreduce_qp.queue_processor.reduction.process_manager import ReductionProcessManager
+from autoreduce_qp.queue_processor.stage_timing import StageTimings, stage
+from autoreduce_qp.queue_processor.status_writer import StatusUpdateWriter
+
+# The records created for a run: the run itself, the message updated with the
+# values used for the reduction, the instrument and the software
+RunRecords = Tuple[ReductionRun, Message, Instrument, Software]
+# The records found for a message in a batch before its run is created
+BatchReferences = Tuple[Experiment, Instrument, Software, records.ScriptAndArguments]
+
+
+class RunRequeued(Exception):
+    """
+    Raised when a run was requeued while it was being reduced, e.g. at the
+    drain deadline. Its message must not be marked as done, so that it is
+    delivered again and resumes the run.
+    """
 
 
 class HandleMessage:
@@ -35,6 +54,22 @@ class HandleMessage:
     def __init__(self):
         self._logger = logging.getLogger(__package__)
 
+        # The runs currently being reduced, and their reductions, by primary
+        # key, so that they can be requeued if the queue processor is stopped
+        # before they finish
+        self._active_runs: Dict[int, Tuple[ReductionRun, ReductionProcessManager]] = {}
+        self._requeued_runs = set()
+        self._active_runs_lock = threading.Lock()
+        # The stage timings of runs whose records have been created, by the
+        # primary key of the run, until the run is processed
+        self._run_timings: Dict[int, StageTimings] = {}
+
+        # Writes the status transitions of runs, only waiting for those that
+        # must not be lost
+        self.status_writer = StatusUpdateWriter()
+        # Keeps large logs out of the run table, if configured to
+        self.log_store = LogStore()
+
     def data_ready(self, message: Message):
         """
         Update the reduction run in the database. This is called when
@@ -48,21 +83,268 @@ class HandleMessage:
         self._logger.info("Data ready for processing run %s on %s. Software: %s. Version %s ", message.run_number,
                           message.instrument, message.software["name"], message.software["version"])
 
+        timings = self._new_timings(message)
         try:
-            reduction_run, message, instrument, software = self.create_run_records(message)
+            with timings.activate(), stage("create_records"):
+                reduction_run, message, instrument, software = self.create_run_records(message)
         except Exception as err:
             # Failed to create the reduction run object - unrecoverable
             self._logger.error("Encountered error in transaction to create ReductionRun and related records, error: %s",
                                str(err))
+            # In case the error came from a cached record that has gone stale
+            self.invalidate_caches()
             raise
 
+        self._keep_timings(reduction_run, timings)
+        self.process_run_records(reduction_run, message, instrument, software)
+        return reduction_run, message
+
+    def data_ready_batch(self, messages: List[Message]) -> List[Union[RunRecords, Exception]]:
+        """
+        Create the records for a batch of data_ready messages, without
+        reducing them. Each run can then be reduced with process_run_records.
+
+        Returns:
+            For each message, in order, either the records created for it or
+            the exception raised while creating them.
+        """
+        for message in messages:
+            self._logger.info("Data ready for processing run %s on %s. Software: %s. Version %s ", message.run_number,
+                              message.instrument, message.software["name"], message.software["version"])
         try:
-            self.send_message_onwards(reduction_run, message, instrument, software)
-        except Exception as err:
-            self._handle_error(reduction_run, message, err)
-            raise
+            start = time.perf_counter()
+            results = self.create_batch_run_records(messages)
+            # Each message is counted as taking its share of the time for the batch
+            elapsed = (time.perf_counter() - start) / max(len(messages), 1)
+            for message, result in zip(messages, results):
+                timings = self._new_timings(message)
+                timings.add("create_records", elapsed)
+                if not isinstance(result, Exception):
+                    self._keep_timings(result[0], timings)
+            return results
+        except Exception as err:  # pylint:disable=broad-except
+            self._logger.warning("Could not create the records of the batch together, creating them one at a time: %s",
+                                 str(err))
+            self.invalidate_caches()
+
+        results = []
+        for message in messages:
+            timings = self._new_timings(message)
+            try:
+                with timings.activate(), stage("create_records"):
+                    results.append(self.create_run_records(message))
+                self._keep_timings(results[-1][0], timings)
+            except Exception as err:  # pylint:disable=broad-except
+                self._logger.error(
+                    "Encountered error in transaction to create ReductionRun and related records, error: %s", str(err))
+                self.invalidate_caches()
+                results.append(err)
+
+        return results
+
+    def _find_batch_references(self, messages: List[Message]):
+        """
+        Find the experiment, instrument and software of each message in a
+        batch, and the script and arguments a new run for it would have.
 
-        return reduction_run, message
+        Returns:
+            A list with the exception raised for each message whose records
+            couldn't be found, and None for the rest, and the records of the
+            rest by their index in the batch.
+        """
+        results: List[Optional[Exception]] = []
+        references: Dict[int, BatchReferences] = {}
+        # Many messages in a batch are usually for the same experiment
+        experiments: Dict[int, Experiment] = {}
+        for index, message in enumerate(messages):
+            try:
+                rb_number = self.normalise_rb_number(message.rb_number)
+                if rb_number not in experiments:
+                    experiments[rb_number] = db_access.get_experiment(rb_number)
+                experiment = experiments[rb_number]
+                instrument = db_access.get_instrument(str(message.instrument))
+                software = db_access.get_software(message.software.get("name"), message.software.get("version"))
+                script_and_arguments = records.find_script_and_arguments(experiment, instrument, message)
+            except Exception as err:  # pylint:disable=broad-except
+                self._logger.error("Could not find the records for run %s on %s, error: %s", message.run_number,
+                                   message.instrument, str(err))
+                self.invalidate_caches()
+                results.append(err)
+                continue
+            references[index] = (experiment, instrument, software, script_and_arguments)
+            results.append(None)
+        return results, references
+
+    @staticmethod
+    def _find_single_runs(messages: List[Message], references: Dict[int, BatchReferences]):
+        """
+        Find the requeued runs and the next run versions of the messages in a
+        batch that have a single run number, with a query for each.
+
+        Returns:
+            The requeued runs, as returned by find_requeued_runs, and the next
+            run versions, as returned by find_highest_run_versions.
+        """
+        experiment_ids = set()
+        run_numbers = set()
+        for index, (experiment, *_) in references.items():
+            if not isinstance(messages[index].run_number, list):
+                experiment_ids.add(experiment.pk)
+                run_numbers.add(messages[index].run_number)
+        if not run_numbers:
+            return {}, {}
+        return (db_access.find_requeued_runs(experiment_ids, run_numbers),
+                db_access.find_highest_run_versions(experiment_ids, run_numbers))
+
+    def _new_batch_runs(self, messages: List[Message], references: Dict[int, BatchReferences],
+                        results: list) -> Dict[int, records.NewRun]:
+        """
+        Allocate the versions of the new runs in a batch, resuming any requeued
+        runs instead. Must be called with the batch's experiments locked.
+
+        Returns:
+            The new runs by their index in the batch. The records of the resumed
+            runs are put in the results instead.
+        """
+        requeued_runs, next_versions = self._find_single_runs(messages, references)
+        new_runs = {}
+        for index, (experiment, instrument, software, script_and_arguments) in references.items():
+            message = messages[index]
+            if isinstance(message.run_number, list):
+                # Batch runs are looked up one at a time
+                requeued_run = db_access.find_requeued_run(experiment, instrument, message.run_number)
+                run_key = (experiment.pk, tuple(sorted(set(message.run_number))))
+            else:
+                requeued_run = requeued_runs.get((experiment.pk, instrument.pk, message.run_number))
+                run_key = (experiment.pk, message.run_number)
+            if requeued_run is not None and self.is_redelivery(requeued_run, script_and_arguments):
+                results[index] = self.resume_run_records(requeued_run, message, instrument, software)
+                continue
+
+            if run_key not in next_versions:
+                if isinstance(message.run_number, list):
+                    next_versions[run_key] = db_access.find_highest_run_version(experiment,
+                                                                                run_number=message.run_number)
+                else:
+                    next_versions[run_key] = 0
+            new_runs[index] = records.NewRun(experiment, instrument, message, next_versions[run_key], software,
+                                             script_and_arguments)
+            next_versions[run_key] += 1
+
+        return new_runs
+
+    def create_batch_run_records(self, messages: List[Message]) -> List[Union[RunRecords, Exception]]:
+        """
+        Create the records for a batch of messages in one transaction, inserting
+        the new runs together. The same as calling create_run_records for each
+        message, but with a few queries for the whole batch instead of several
+        for each message.
+
+        Returns:
+            For each message, in order, either the records created for it or
+            the exception raised while looking up its experiment, instrument or
+            software.
+
+        Raises:
+            Exception: If the records could not be created. None of them are.
+        """
+        results, references = self._find_batch_references(messages)
+        with transaction.atomic():
+            # Locked in a consistent order so that two hosts locking the same
+            # experiments can't deadlock
+            for experiment_id in sorted({experiment.pk for experiment, *_ in references.values()}):
+                db_access.lock_experiment(Experiment(pk=experiment_id))
+
+            new_runs = self._new_batch_runs(messages, references, results)
+            created = records.create_reduction_run_records(list(new_runs.values()), status=db_access.get_status('q'))
+            for (index, new_run), (reduction_run, message) in zip(new_runs.items(), created):
+                results[index] = (reduction_run, message, new_run.instrument, new_run.software)
+
+        return results
+
+    @staticmethod
+    def invalidate_caches():
+        """Empty the caches of database records, in case one of the records has gone stale."""
+        db_access.REFERENCE_CACHE.invalidate()
+        records.invalidate_caches()
+
+    def process_run_records(self, reduction_run: ReductionRun, message: Message, instrument: Instrument,
+                            software: Software):
+        """
+        Reduce a run whose records have already been created, marking it as
+        errored if anything goes wrong. The time spent in each stage of
+        handling the run is logged once it has been handled.
+        """
+        timings = self._take_timings(reduction_run, message)
+        with timings.activate():
+            try:
+                self.send_message_onwards(reduction_run, message, instrument, software)
+            except RunRequeued:
+                raise
+            except Exception as err:
+                self._handle_error(reduction_run, message, err)
+                raise
+            finally:
+                timings.log()
+
+    def schedule_run(self, reduction_run: ReductionRun, message: Message, instrument: Instrument) -> bool:
+        """
+        The first half of process_run_records, for when runs are reduced
+        elsewhere. Finishes a run whose records have already been created if it
+        is to be skipped or has errored, otherwise leaves it queued.
+
+        Returns:
+            True if the run should be reduced with execute_run.
+        """
+        timings = self._take_timings(reduction_run, message)
+        with timings.activate():
+            try:
+                with stage("schedule"):
+                    needs_reduction = self._check_run(reduction_run, message, instrument)
+            except Exception as err:
+                self._handle_error(reduction_run, message, err)
+                timings.log()
+                raise
+
+        if needs_reduction:
+            self._keep_timings(reduction_run, timings)
+        else:
+            timings.log()
+        return needs_reduction
+
+    def execute_run(self, reduction_run: ReductionRun, message: Message, software: Software):
+        """
+        The second half of process_run_records. Reduces a run that
+        schedule_run has said should be reduced, marking it as errored if
+        anything goes wrong.
+        """
+        timings = self._take_timings(reduction_run, message)
+        with timings.activate():
+            try:
+                self.do_reduction(reduction_run, message, software)
+            except RunRequeued:
+                raise
+            except Exception as err:
+                self._handle_error(reduction_run, message, err)
+                raise
+            finally:
+                timings.log()
+
+    @staticmethod
+    def _new_timings(message: Message) -> StageTimings:
+        return StageTimings(str(message.instrument), run_number=message.run_number)
+
+    def _take_timings(self, reduction_run: ReductionRun, message: Message) -> StageTimings:
+        """Return the timings kept for a run, or new ones if there aren't any."""
+        with self._active_runs_lock:
+            timings = self._run_timings.pop(reduction_run.pk, None)
+        return timings if timings is not None else self._new_timings(message)
+
+    def _keep_timings(self, reduction_run: ReductionRun, timings: StageTimings):
+        """Keep the timings of a run whose records were created, until it is processed."""
+        timings.fields["run_version"] = reduction_run.run_version
+        with self._active_runs_lock:
+            self._run_timings[reduction_run.pk] = timings
 
     def _handle_error(self, reduction_run: ReductionRun, message: Message, err: Exception):
         """
@@ -83,15 +365,60 @@ class HandleMessage:
         """
         rb_number = self.normalise_rb_number(message.rb_number)
         experiment = db_access.get_experiment(rb_number)
-        run_version = db_access.find_highest_run_version(experiment, run_number=message.run_number)
         instrument = db_access.get_instrument(str(message.instrument))
         software = db_access.get_software(message.software.get("name"), message.software.get("version"))
-        return self.do_create_reduction_record(message, experiment, instrument, run_version, software)
+        # Found before the experiment is locked, as reading the script and
+        # fetching remote files would hold up other queue processors
+        script_and_arguments = records.find_script_and_arguments(experiment, instrument, message)
+
+        with transaction.atomic():
+            # Hold a lock on the experiment from looking up the highest run
+            # version until the new run is committed, so that queue processors
+            # on other hosts can't allocate the same version
+            db_access.lock_experiment(experiment)
+
+            # A run requeued when the queue processor was stopped is redelivered
+            # with the same message, so carry on with its records
+            requeued_run = db_access.find_requeued_run(experiment, instrument, message.run_number)
+            if requeued_run is not None and self.is_redelivery(requeued_run, script_and_arguments):
+                return self.resume_run_records(requeued_run, message, instrument, software)
+
+            run_version = db_access.find_highest_run_version(experiment, run_number=message.run_number)
+            return self.do_create_reduction_record(message, experiment, instrument, run_version, software,
+                                                   script_and_arguments)
+
+    @staticmethod
+    def is_redelivery(reduction_run: ReductionRun, script_and_arguments: records.ScriptAndArguments) -> bool:
+        """
+        Return whether a message for a requeued run is its message delivered
+        again, rather than a new request to reduce the same run, e.g. a rerun
+        with different arguments. Only a redelivery gives the run the same
+        script and arguments.
+        """
+        return (script_and_arguments.script.pk == reduction_run.script_id
+                and script_and_arguments.arguments.pk == reduction_run.arguments_id)
+
+    def resume_run_records(self, reduction_run: ReductionRun, message: Message, instrument: Instrument,
+                           software: Software) -> RunRecords:
+        """
+        Update the message with the values of a requeued run, in the same way as
+        when its records were first created, so that it can be reduced again.
+        """
+        self._logger.info("Resuming requeued run %s version %s", message.run_number, reduction_run.run_version)
+        message.reduction_script = reduction_run.script.text
+        message.reduction_arguments = reduction_run.arguments.as_dict()
+        message.run_version = reduction_run.run_version
+        message.flat_output = instrument.is_flat_output
+        return reduction_run, message, instrument, software
 
     @staticmethod
     @transaction.atomic
-    def do_create_reduction_record(message: Message, experiment: Experiment, instrument: Instrument, run_version: int,
-                                   software: Software):
+    def do_create_reduction_record(message: Message,
+                                   experiment: Experiment,
+                                   instrument: Instrument,
+                                   run_version: int,
+                                   software: Software,
+                                   script_and_arguments: Optional[records.ScriptAndArguments] = None):
         """Create the reduction record."""
         # Make the new reduction run with the information collected so far
         reduction_run, message = records.create_reduction_run_record(experiment=experiment,
@@ -99,7 +426,8 @@ class HandleMessage:
                                                                      message=message,
                                                                      run_version=run_version,
                                                                      software=software,
-                                                                     status=Status.get_queued())
+                                                                     status=db_access.get_status('q'),
+                                                                     script_and_arguments=script_and_arguments)
 
         return reduction_run, message, instrument, software
 
@@ -110,17 +438,27 @@ class HandleMessage:
         and instrument isn't paused, otherwiese skips if either of those is
         true.
         """
+        if self._check_run(reduction_run, message, instrument):
+            self.do_reduction(reduction_run, message, software)
+
+    def _check_run(self, reduction_run: ReductionRun, message: Message, instrument: Instrument) -> bool:
+        """
+        Mark the run as skipped or errored if it shouldn't be reduced, otherwise
+        activate its instrument. Returns whether the run should be reduced.
+        """
         # Activate instrument if script was found
         skip_reason = self.find_reason_to_skip_run(reduction_run, message, instrument)
         if skip_reason is not None:
             message.message = skip_reason
             message.reduction_log = skip_reason
             self.reduction_skipped(reduction_run, message)
-        elif message.message:
+            return False
+        if message.message:
             self.reduction_error(reduction_run, message)
-        else:
-            self.activate_db_inst(instrument)
-            self.do_reduction(reduction_run, message, software)
+            return False
+
+        self.activate_db_inst(instrument)
+        return True
 
     @staticmethod
     def find_reason_to_skip_run(reduction_run: ReductionRun, message: Message, instrument) -> Optional[str]:
@@ -147,6 +485,10 @@ class HandleMessage:
         """
         Handover to the ReductionProcessManager to actually run the reduction
         process and handle the outcome from the run.
+
+        Raises:
+            RunRequeued: If the run was requeued while it was being reduced.
+            Its result is not recorded.
         """
         if reduction_run.batch_run:
             run_name = f"batch-{reduction_run.run_numbers.first()}-{reduction_run.run_numbers.last()}"
@@ -154,24 +496,95 @@ class HandleMessage:
             run_name = f"{reduction_run.run_number}"
 
         reduction_process_manager = ReductionProcessManager(message, run_name, software)
-        self.reduction_started(reduction_run, message)
-
-        output_message = reduction_process_manager.run()
-        if output_message.message is not None:
-            self.reduction_error(reduction_run, output_message)
-        else:
-            self.reduction_complete(reduction_run, output_message)
+        with self._active_runs_lock:
+            self._active_runs[reduction_run.pk] = (reduction_run, reduction_process_manager)
+        try:
+            self.reduction_started(reduction_run, message)
+            with stage("reduce"):
+                output_message = reduction_process_manager.run()
+        except Exception as err:  # pylint:disable=broad-except
+            # The reduction fails when it is stopped for the run to be requeued
+            if not self._end_active_run(reduction_run):
+                raise
+            self._logger.info("Run %s was stopped after it was requeued, leaving it queued", message.run_number)
+            raise RunRequeued(f"Run {message.run_number} was requeued while it was being reduced") from err
+
+        if self._end_active_run(reduction_run):
+            self._logger.info("Run %s finished after it was requeued, leaving it queued", message.run_number)
+            raise RunRequeued(f"Run {message.run_number} was requeued while it was being reduced")
+
+        with stage("record_result"):
+            if output_message.message is not None:
+                self.reduction_error(reduction_run, output_message)
+            else:
+                self.reduction_complete(reduction_run, output_message)
+
+    def _end_active_run(self, reduction_run: ReductionRun) -> bool:
+        """Stop tracking a run that is no longer being reduced, and return whether it was requeued meanwhile."""
+        with self._active_runs_lock:
+            self._active_runs.pop(reduction_run.pk, None)
+            requeued = reduction_run.pk in self._requeued_runs
+            self._requeued_runs.discard(reduction_run.pk)
+        return requeued
+
+    def requeue_active_runs(self) -> List[ReductionRun]:
+        """
+        Stop the runs that are still being reduced and set them back to Queued,
+        e.g. because the queue processor is stopping before they can finish.
+        Their start time is kept so that the run is resumed, instead of a new
+        version being created, when its message is delivered again. A run whose
+        reduction can't be stopped is left as it is, so that it can't write
+        over the output of the resumed run.
+
+        Returns:
+            The runs that were requeued.
+        """
+        with self._active_runs_lock:
+            active_runs = list(self._active_runs.values())
+            self._requeued_runs.update(self._active_runs)
+
+        requeued = []
+        for reduction_run, process_manager in active_runs:
+            try:
+                process_manager.stop()
+            except Exception as err:  # pylint:disable=broad-except
+                self._logger.error("Could not stop the reduction of run %s, leaving it running: %s", reduction_run.pk,
+                                   str(err))
+                with self._active_runs_lock:
+                    self._requeued_runs.discard(reduction_run.pk)
+                continue
+            requeued.append(reduction_run)
+
+        self.requeue_runs(requeued)
+        return requeued
+
+    def requeue_runs(self, reduction_runs: List[ReductionRun]):
+        """
+        Set runs back to Queued so that they are resumed when their message is
+        delivered again. A start time is recorded for runs that never started,
+        as that is what marks a queued run as requeued.
+        """
+        queued = db_access.get_status('q')
+        for reduction_run in reduction_runs:
+            self._logger.info("Requeueing unfinished run %s", reduction_run.pk)
+            self.status_writer.update(reduction_run,
+                                      wait=False,
+                                      status=queued,
+                                      started=reduction_run.started or timezone.now())
+        self.status_writer.flush()
 
     def activate_db_inst(self, instrument: Instrument):
         """
         Get the DB instrument record from the database, if one is not found,
         create and save the record to the DB, then return it.
         """
-        # Activate the instrument if it is currently set to inactive
+        # Activate the instrument if it is currently set to inactive. Only the
+        # flag is written, so that changes made to the instrument's other
+        # columns, e.g. by the web app, since it was looked up are kept
         if not instrument.is_active:
             self._logger.info("Activating %s", instrument.name)
-            instrument.is_active = 1
-            instrument.save()
+            Instrument.objects.filter(pk=instrument.pk).update(is_active=True)
+            instrument.is_active = True
 
         return instrument
 
@@ -181,9 +594,9 @@ class HandleMessage:
         called when the run is ready to start.
         """
         self._logger.info("Run %s has started reduction", message.run_number)
-        reduction_run.status = Status.get_processing()
-        reduction_run.started = timezone.now()
-        reduction_run.save()
+        # Written behind. If it were lost the run would be left queued, and
+        # reduced again when its message is delivered again
+        self.status_writer.update(reduction_run, wait=False, status=db_access.get_status('p'), started=timezone.now())
 
     @transaction.atomic
     def reduction_complete(self, reduction_run: ReductionRun, message: Message):
@@ -192,8 +605,7 @@ class HandleMessage:
         run has completed.
         """
         self._logger.info("Run %s has completed reduction", message.run_number)
-        self._common_reduction_run_update(reduction_run, Status.get_completed(), message)
-        reduction_run.save()
+        self._common_reduction_run_update(reduction_run, db_access.get_status('c'), message)
 
         if message.reduction_data is not None:
             reduction_location = ReductionLocation(file_path=message.reduction_data, reduction_run=reduction_run)
@@ -209,8 +621,7 @@ class HandleMessage:
         else:
             self._logger.info("Run %s has been skipped - No error message was found", message.run_number)
 
-        self._common_reduction_run_update(reduction_run, Status.get_skipped(), message)
-        reduction_run.save()
+        self._common_reduction_run_update(reduction_run, db_access.get_status('s'), message)
 
     def reduction_error(self, reduction_run: ReductionRun, message: Message):
         """
@@ -222,16 +633,20 @@ class HandleMessage:
         else:
             self._logger.info("Run %s has encountered an error - No error message was found", message.run_number)
 
-        self._common_reduction_run_update(reduction_run, Status.get_error(), message)
-        reduction_run.save()
+        self._common_reduction_run_update(reduction_run, db_access.get_status('e'), message)
 
-    @staticmethod
-    def _common_reduction_run_update(reduction_run: ReductionRun, status: Status, message: Message):
-        reduction_run.status = status
-        reduction_run.finished = timezone.now()
-        reduction_run.message = message.message
-        reduction_run.reduction_log = message.reduction_log
-        reduction_run.admin_log = message.admin_log
+    def _common_reduction_run_update(self, reduction_run: ReductionRun, status: Status, message: Message):
+        # A run's final status is written before its message is marked as done
+        self.status_writer.update(reduction_run,
+                                  status=status,
+                                  finished=timezone.now(),
+                                  message=message.message,
+                                  reduction_log=self.log_store.store(message.reduction_log),
+                                  admin_log=self.log_store.store(message.admin_log))
+
+    def close(self):
+        """Write any status updates that are waiting."""
+        self.status_writer.close()
 
     @staticmethod
     def normalise_rb_number(rb_number) -> int:
@@ -0,0 +1,175 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""
+Priority lanes for data_ready messages. Each lane has its own Kafka topic, and
+the worker pool shares the reduction workers between the lanes in proportion to
+their weights, so that a large rerun campaign cannot starve live runs.
+
+Weights default to AUTOREDUCE_QP_LANE_WEIGHTS and can be changed while the
+queue processor is running with the autoreduce-qp-lanes command.
+"""
+import os
+from collections import defaultdict
+from typing import Dict, Optional
+
+import fire
+
+from autoreduce_qp.queue_processor.local_store import LocalStore
+
+LIVE_LANE = "live"
+RERUN_LANE = "rerun"
+BATCH_LANE = "batch"
+
+# The topic each lane is consumed from
+LANE_TOPICS = {
+    LIVE_LANE: os.getenv("KAFKA_TOPIC", "data_ready"),
+    RERUN_LANE: os.getenv("KAFKA_RERUN_TOPIC", "data_ready_rerun"),
+    BATCH_LANE: os.getenv("KAFKA_BATCH_TOPIC", "data_ready_batch"),
+}
+DEFAULT_LANE_WEIGHTS = os.getenv("AUTOREDUCE_QP_LANE_WEIGHTS", "live=10,rerun=3,batch=1")
+# How often, in seconds, the consumer picks up weights changed at runtime
+LANE_WEIGHTS_REFRESH = float(os.getenv("AUTOREDUCE_QP_LANE_WEIGHTS_REFRESH", "10"))
+
+
+def parse_weights(weights: str) -> Dict[str, float]:
+    """
+    Parse lane weights written as comma separated lane=weight pairs, e.g.
+    "live=10,rerun=3,batch=1".
+
+    Raises:
+        ValueError: If a lane is unknown or a weight is not a positive number.
+    """
+    parsed = {}
+    for pair in weights.split(","):
+        if not pair.strip():
+            continue
+        lane, _, weight = pair.partition("=")
+        parsed[lane.strip()] = float(weight)
+    for lane, weight in parsed.items():
+        validate_weight(lane, weight)
+    return parsed
+
+
+def validate_weight(lane: str, weight: float):
+    """Raise a ValueError if the lane is unknown or the weight is not positive."""
+    if lane not in LANE_TOPICS:
+        raise ValueError(f"Unknown lane '{lane}', expected one of {', '.join(LANE_TOPICS)}")
+    if weight <= 0:
+        raise ValueError(f"The weight of lane '{lane}' must be positive, got {weight}")
+
+
+def lane_for_topic(topic: str) -> Optional[str]:
+    """Return the lane that a topic belongs to, or None if it isn't a lane's topic."""
+    for lane, lane_topic in LANE_TOPICS.items():
+        if lane_topic == topic:
+            return lane
+    return None
+
+
+class FairQueue:
+    """
+    Weighted fair queuing between lanes. Every task is tagged with the virtual
+    time at which its lane would finish it if each lane were served at a rate
+    equal to its weight, and the waiting task with the earliest tag should be
+    started first. A lane that has been idle starts from the current virtual
+    time, so it can't save up a burst of credit. Not thread-safe.
+
+    Args:
+        weights: The weight of each lane. Lanes without a weight have a weight of 1.
+    """
+
+    def __init__(self, weights: Optional[Dict[str, float]] = None):
+        self.weights = dict(weights or {})
+        # The tag of the most recently started task, and of the last task
+        # tagged in each lane
+        self._virtual_time = 0.0
+        self._lane_finish = defaultdict(float)
+
+    def tag(self, lane: Optional[str]) -> float:
+        """Return the tag of the next task in a lane."""
+        start = max(self._virtual_time, self._lane_finish[lane])
+        self._lane_finish[lane] = start + 1 / self.weights.get(lane, 1.0)
+        return self._lane_finish[lane]
+
+    def started(self, tag: float):
+        """Record that the task with the given tag has started."""
+        self._virtual_time = max(self._virtual_time, tag)
+
+    def set_weight(self, lane: str, weight: float) -> bool:
+        """
+        Change the weight of a lane. If it changed, the tasks waiting in the
+        lane should be tagged again, in order, so that it takes effect straight away.
+
+        Returns:
+            Whether the weight changed.
+        """
+        if weight <= 0:
+            raise ValueError(f"The weight of lane '{lane}' must be positive")
+        if self.weights.get(lane) == weight:
+            return False
+        self.weights[lane] = weight
+        self._lane_finish[lane] = self._virtual_time
+        return True
+
+
+class LaneWeights:
+    """
+    The weight of each lane: the default from the environment, overridden by
+    any weight set at runtime. Runtime weights are kept in a LocalStore so that
+    they can be set from another process and survive restarts.
+    """
+
+    def __init__(self, store: Optional[LocalStore] = None, defaults: str = DEFAULT_LANE_WEIGHTS):
+        self.store = store or LocalStore("lane_weights")
+        self.defaults = {lane: 1.0 for lane in LANE_TOPICS}
+        self.defaults.update(parse_weights(defaults))
+
+    def get_all(self) -> Dict[str, float]:
+        """Return the current weight of every lane."""
+        weights = dict(self.defaults)
+        for lane in LANE_TOPICS:
+            weight = self.store.get(lane)
+            if weight is not None:
+                weights[lane] = float(weight)
+        return weights
+
+    def set(self, lane: str, weight: float):
+        """Set the weight of a lane, overriding its default."""
+        validate_weight(lane, weight)
+        self.store.set(lane, str(float(weight)))
+
+    def reset(self, lane: str):
+        """Return a lane to its default weight."""
+        validate_weight(lane, self.defaults.get(lane, 1.0))
+        self.store.delete(lane)
+
+
+class LaneControl:
+    """Show and change the weights of the priority lanes."""
+
+    def __init__(self, weights: Optional[LaneWeights] = None):
+        self._weights = weights or LaneWeights()
+
+    def show(self) -> Dict[str, float]:
+        """Show the current weight of each lane."""
+        return self._weights.get_all()
+
+    def set(self, lane: str, weight: float) -> Dict[str, float]:
+        """Set the weight of a lane. Running queue processors pick it up within a few seconds."""
+        self._weights.set(lane, weight)
+        return self._weights.get_all()
+
+    def reset(self, lane: str) -> Dict[str, float]:
+        """Return a lane to the weight set by AUTOREDUCE_QP_LANE_WEIGHTS."""
+        self._weights.reset(lane)
+        return self._weights.get_all()
+
+
+def main():
+    """Entry point for the lane weights command line tool."""
+    fire.Fire(LaneControl)
@@ -0,0 +1,88 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""
+A small key-value store kept in a SQLite file on the queue processor's host. It
+holds state that must survive a restart of the queue processor but does not
+belong in the main database.
+"""
+import os
+import sqlite3
+import threading
+from typing import Optional
+
+from autoreduce_utils.settings import AUTOREDUCE_HOME_ROOT
+
+LOCAL_STORE_PATH = os.getenv("AUTOREDUCE_QP_LOCAL_STORE", os.path.join(AUTOREDUCE_HOME_ROOT, "queue_processor.sqlite3"))
+
+
+class LocalStore:
+    """
+    A table of string keys and values in a SQLite database. Safe to share
+    between threads.
+
+    Args:
+        table: The name of the table to keep the values in. Several stores can
+        share one database file by using different tables.
+        path: The path to the SQLite database file.
+    """
+
+    def __init__(self, table: str, path: str = LOCAL_STORE_PATH):
+        if not table.isidentifier():
+            raise ValueError(f"Invalid table name for local store: {table}")
+
+        self.table = table
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the value stored for the key, or None if there isn't one."""
+        with self._lock:
+            row = self._connection.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key, )).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str):
+        """Store a value for the key, replacing any existing one."""
+        with self._lock:
+            self._connection.execute(f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)", (key, value))
+
+    def increment(self, key: str) -> int:
+        """Add one to the integer stored for the key, starting from 0, and return the new value."""
+        with self._lock:
+            self._connection.execute(
+                f"INSERT INTO {self.table} (key, value) VALUES (?, '1') "
+                "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1", (key, ))
+            row = self._connection.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key, )).fetchone()
+        return int(row[0])
+
+    def decrement(self, key: str) -> int:
+        """Take one from the integer stored for the key, removing it once it reaches 0, and return the new value."""
+        with self._lock:
+            self._connection.execute(f"UPDATE {self.table} SET value = CAST(value AS INTEGER) - 1 WHERE key = ?",
+                                     (key, ))
+            row = self._connection.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key, )).fetchone()
+            if row is None or int(row[0]) <= 0:
+                self._connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (key, ))
+                return 0
+        return int(row[0])
+
+    def delete(self, key: str):
+        """Remove the key from the store, if it is present."""
+        with self._lock:
+            self._connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (key, ))
+
+    def delete_below(self, value: float) -> int:
+        """Remove every key whose value, read as a number, is below the given one, and return how many were removed."""
+        with self._lock:
+            cursor = self._connection.execute(f"DELETE FROM {self.table} WHERE CAST(value AS REAL) < ?", (value, ))
+        return cursor.rowcount
+
+    def close(self):
+        """Close the connection to the database file."""
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,174 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""
+Storage of the reduction and admin logs of runs.
+
+The logs of chatty algorithms can reach tens of MB, which bloats the run table
+and every fetch of a run. When AUTOREDUCE_QP_LOG_STORE_DIR is set, a log larger
+than AUTOREDUCE_QP_LOG_INLINE_LIMIT is compressed into a file named by the
+digest of its text in that directory, and the run only keeps the first and last
+lines of the log, within the limit, and a line pointing at the file. Logs that are the same, e.g.
+the admin logs of runs that failed the same way, are stored once. The
+directory can be put on the same mount as the reduced data.
+
+Logs are compressed with gzip, or with zstd when AUTOREDUCE_QP_LOG_COMPRESSION
+is zstd and zstandard is installed.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import re
+import tempfile
+from typing import Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The directory to store large logs in. Unset to keep every log in full in the database
+LOG_STORE_DIR = os.getenv("AUTOREDUCE_QP_LOG_STORE_DIR") or None
+# The size in bytes above which a log is stored in a file
+LOG_INLINE_LIMIT = int(os.getenv("AUTOREDUCE_QP_LOG_INLINE_LIMIT", str(64 * 1024)))
+# The number of lines kept in the database from the start, and from the end, of a stored log
+LOG_EXCERPT_LINES = int(os.getenv("AUTOREDUCE_QP_LOG_EXCERPT_LINES", "100"))
+LOG_COMPRESSION = os.getenv("AUTOREDUCE_QP_LOG_COMPRESSION", "gzip").lower()
+
+EXTENSIONS = {"gzip": ".log.gz", "zstd": ".log.zst"}
+# Stored logs are readable by everyone, like the reduced data, e.g. for the web app
+STORED_LOG_MODE = 0o644
+POINTER_PATTERN = re.compile(r"^## Full log of \d+ lines stored at (?P<path>.+) ##$", re.MULTILINE)
+
+logger = logging.getLogger(__file__)
+
+
+class LogStore:
+    """
+    Stores large logs in compressed files, returning what should be kept in
+    the database in their place. Safe to share between threads.
+
+    Args:
+        directory: The directory to store logs in, or None to keep every log
+        in full in the database.
+        inline_limit: The size in bytes above which a log is stored in a file.
+        excerpt_lines: The number of lines kept from the start, and from the
+        end, of a stored log.
+        compression: The compression of stored logs, gzip or zstd.
+    """
+
+    def __init__(self,
+                 directory: Optional[str] = LOG_STORE_DIR,
+                 inline_limit: int = LOG_INLINE_LIMIT,
+                 excerpt_lines: int = LOG_EXCERPT_LINES,
+                 compression: str = LOG_COMPRESSION):
+        if compression not in EXTENSIONS:
+            raise ValueError(f"Invalid log compression: {compression}")
+        if compression == "zstd" and zstandard is None:
+            logger.warning("zstandard is not installed, so logs will be compressed with gzip")
+            compression = "gzip"
+
+        self.directory = directory
+        self.inline_limit = inline_limit
+        self.excerpt_lines = excerpt_lines
+        self.compression = compression
+
+    def store(self, log: Optional[str]) -> Optional[str]:
+        """
+        Store a log in a file if it is too large for the database.
+
+        Returns:
+            The log itself if it is small enough or cannot be stored, or else
+            an excerpt of it with the path of the file it is stored in.
+        """
+        if self.directory is None or log is None:
+            return log
+        data = log.encode("utf_8")
+        if len(data) <= self.inline_limit:
+            return log
+
+        lines = log.splitlines()
+        if len(lines) <= 2 * self.excerpt_lines:
+            # A few very long lines, so keep the start and end of the text instead
+            head, tail = log, log
+        else:
+            head = "\n".join(lines[:self.excerpt_lines])
+            tail = "\n".join(lines[len(lines) - self.excerpt_lines:])
+        # However long the lines are, the excerpt is kept within the limit
+        head, tail = _head_bytes(head, self.inline_limit // 2), _tail_bytes(tail, self.inline_limit // 2)
+
+        try:
+            path = self._write(data)
+        except OSError:
+            logger.warning("Could not store a log of %s bytes in %s, keeping it in the database",
+                           len(data),
+                           self.directory,
+                           exc_info=True)
+            return log
+
+        return "\n".join([head, f"## Full log of {len(lines)} lines stored at {path} ##", tail])
+
+    def _write(self, data: bytes) -> str:
+        """Compress the log into a file named by its digest, unless it's already there, and return its path."""
+        digest = hashlib.sha256(data).hexdigest()
+        directory = os.path.join(self.directory, digest[:2])
+        path = os.path.join(directory, digest + EXTENSIONS[self.compression])
+        if os.path.exists(path):
+            return path
+
+        os.makedirs(directory, exist_ok=True)
+        if self.compression == "zstd":
+            compressed = zstandard.ZstdCompressor().compress(data)
+        else:
+            compressed = gzip.compress(data)
+        # Written to a temporary file first, so that a stored log is never partially written
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as temp_file:
+            try:
+                temp_file.write(compressed)
+                # Temporary files are only readable by their owner
+                os.chmod(temp_file.name, STORED_LOG_MODE)
+            except OSError:
+                os.unlink(temp_file.name)
+                raise
+        os.replace(temp_file.name, path)
+        return path
+
+    @staticmethod
+    def load(stored: Optional[str]) -> Optional[str]:
+        """
+        Return the full log for what was kept in the database, reading it from
+        its file if it was stored in one.
+
+        Raises:
+            OSError: If the file of a stored log cannot be read.
+        """
+        match = POINTER_PATTERN.search(stored or "")
+        if match is None:
+            return stored
+
+        path = match.group("path")
+        with open(path, "rb") as log_file:
+            compressed = log_file.read()
+        if path.endswith(EXTENSIONS["zstd"]):
+            if zstandard is None:
+                raise OSError(f"zstandard is needed to read {path}")
+            data = zstandard.ZstdDecompressor().decompress(compressed)
+        else:
+            data = gzip.decompress(compressed)
+        return data.decode("utf_8")
+
+
+def _head_bytes(text: str, size: int) -> str:
+    """Return the start of the text that fits in size bytes of UTF-8."""
+    return text.encode("utf_8")[:size].decode("utf_8", "ignore")
+
+
+def _tail_bytes(text: str, size: int) -> str:
+    """Return the end of the text that fits in size bytes of UTF-8."""
+    data = text.encode("utf_8")
+    return data[max(len(data) - size, 0):].decode("utf_8", "ignore")
@@ -0,0 +1,286 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""
+Metrics for the queue processor, rendered in the Prometheus text format and
+served over HTTP from a background thread.
+
+The metrics are module level objects that are updated from wherever the event
+happens, e.g. `MESSAGES_RECEIVED.inc(topic=topic)`, and rendered on request.
+"""
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# The port the metrics are served on. The server is not started if this is 0
+METRICS_PORT = int(os.getenv("AUTOREDUCE_QP_METRICS_PORT", "9102"))
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200)
+
+logger = logging.getLogger(__file__)
+
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels.items()) + "}"
+
+
+class Metric:
+    """
+    A metric with a fixed set of label names. Each combination of label
+    values is a separate series.
+    """
+    metric_type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def remove(self, **labels):
+        """Remove the series with the given label values, if it exists."""
+        with self._lock:
+            self._values.pop(self._key(labels), None)
+
+    def clear(self):
+        """Remove every series."""
+        with self._lock:
+            self._values.clear()
+
+    def samples(self) -> List[Sample]:
+        """Return the (name, labels, value) samples of every series."""
+        with self._lock:
+            return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in self._values.items()]
+
+    def render(self) -> str:
+        """Render the metric in the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """A value that only goes up, e.g. the number of messages received."""
+    metric_type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        """Add to the counter."""
+        if amount < 0:
+            raise ValueError("Counters can only be increased")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        """Return the current value of the counter."""
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down. Instead of being set, a gauge can be
+    given a function that returns its values when the metrics are rendered.
+    """
+    metric_type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._function: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None
+
+    def set(self, value: float, **labels):
+        """Set the value of the gauge."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def get(self, **labels) -> Optional[float]:
+        """Return the current value of the gauge, or None if it hasn't been set."""
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+    def set_function(self, function: Optional[Callable[[], Dict[Tuple[str, ...], float]]]):
+        """
+        Take the gauge's values from a function called when the metrics are
+        rendered. The function returns a dict of label value tuples to values.
+        """
+        self._function = function
+
+    def samples(self) -> List[Sample]:
+        function = self._function
+        if function is None:
+            return super().samples()
+        return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in function().items()]
+
+
+class _HistogramValue:
+
+    def __init__(self, buckets: Sequence[float]):
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+
+class Histogram(Metric):
+    """Counts observed values, e.g. durations, in cumulative buckets."""
+    metric_type = "histogram"
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf, )
+
+    def observe(self, value: float, **labels):
+        """Record an observed value."""
+        key = self._key(labels)
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = _HistogramValue(self.buckets)
+            histogram.count += 1
+            histogram.sum += value
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    histogram.bucket_counts[i] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observe how long the body of the `with` block takes, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get_count(self, **labels) -> int:
+        """Return the number of values observed."""
+        with self._lock:
+            histogram = self._values.get(self._key(labels))
+            return histogram.count if histogram else 0
+
+    def samples(self) -> List[Sample]:
+        samples = []
+        with self._lock:
+            for key, histogram in self._values.items():
+                labels = dict(zip(self.labelnames, key))
+                for upper_bound, count in zip(self.buckets, histogram.bucket_counts):
+                    samples.append((f"{self.name}_bucket", {**labels, "le": _format_value(upper_bound)}, count))
+                samples.append((f"{self.name}_count", labels, histogram.count))
+                samples.append((f"{self.name}_sum", labels, histogram.sum))
+        return samples
+
+
+class MetricsRegistry:
+    """A collection of metrics that are rendered together."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """Add a metric to the registry and return it."""
+        if metric.name in self._metrics:
+            raise ValueError(f"A metric called {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text format."""
+        return "".join(metric.render() for metric in self._metrics.values())
+
+
+REGISTRY = MetricsRegistry()
+
+MESSAGES_RECEIVED = REGISTRY.register(
+    Counter("autoreduce_qp_messages_received_total", "Messages received from Kafka.", ["topic"]))
+MESSAGES_COMPLETED = REGISTRY.register(
+    Counter("autoreduce_qp_messages_completed_total", "Messages that have finished processing.", ["topic"]))
+MESSAGES_QUARANTINED = REGISTRY.register(
+    Counter("autoreduce_qp_messages_quarantined_total", "Messages published to the dead-letter topic.", ["topic"]))
+CONSUMER_LAG = REGISTRY.register(
+    Gauge("autoreduce_qp_consumer_lag", "Messages on each assigned partition that have not been consumed yet.",
+          ["topic", "partition"]))
+REDUCTIONS_IN_FLIGHT = REGISTRY.register(
+    Gauge("autoreduce_qp_reductions_in_flight", "Reductions running or waiting for a worker.", ["lane"]))
+REFERENCE_CACHE_LOOKUPS = REGISTRY.register(
+    Counter("autoreduce_qp_reference_cache_lookups_total",
+            "Lookups of statuses, instruments and software, by whether they were cached.", ["kind", "result"]))
+HANDLER_STAGE_SECONDS = REGISTRY.register(
+    Histogram("autoreduce_qp_handler_stage_seconds", "Time spent in each stage of handling a run.",
+              ["stage", "instrument"]))
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):  # pylint:disable=invalid-name
+        """Serve the rendered metrics."""
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode("utf_8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint:disable=redefined-builtin
+        logger.debug(format, *args)
+
+
+def start_metrics_server(port: int = METRICS_PORT,
+                         registry: MetricsRegistry = REGISTRY,
+                         host: str = "") -> ThreadingHTTPServer:
+    """
+    Serve the metrics over HTTP on a daemon thread.
+
+    Args:
+        port: The port to listen on, or 0 to pick a free port.
+        registry: The metrics to serve.
+        host: The address to listen on. Listens on every interface by default.
+
+    Returns:
+        The server, which can be stopped with `shutdown()`.
+    """
+    handler = type("MetricsRequestHandler", (_MetricsRequestHandler, ), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    logger.info("Serving metrics on port %s", server.server_address[1])
+    return server
@@ -0,0 +1,106 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""
+Tracks which Kafka offsets have finished processing so that the consumer only
+ever commits offsets below which every message has been handled.
+"""
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+from confluent_kafka import TopicPartition
+
+
+class _PartitionOffsets:
+    """The offsets received on a single partition and their progress."""
+
+    def __init__(self):
+        self.outstanding = set()
+        self.next_offset = None
+        self.committed = None
+
+    def watermark(self):
+        """
+        Return the offset to commit for this partition - the lowest offset that
+        has not finished processing, or one past the highest offset received.
+        """
+        if self.outstanding:
+            return min(self.outstanding)
+        return self.next_offset
+
+
+class OffsetTracker:
+    """
+    Thread-safe record of the offsets received and completed on each partition.
+
+    Messages may complete in any order. The committable offset of a partition
+    only moves past a message once it, and every message before it, has
+    completed, so that a restart replays exactly the messages that were not
+    finished.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._partitions: Dict[Tuple[str, int], _PartitionOffsets] = {}
+        self._completed_since_commit = 0
+
+    def track(self, topic: str, partition: int, offset: int):
+        """Record that a message has been received and is being processed."""
+        with self._lock:
+            offsets = self._partitions.get((topic, partition))
+            if offsets is None:
+                # The first offset received is where the group's committed
+                # position already is, so there's no need to commit it again
+                offsets = self._partitions[(topic, partition)] = _PartitionOffsets()
+                offsets.committed = offset
+            offsets.outstanding.add(offset)
+            if offsets.next_offset is None or offset >= offsets.next_offset:
+                offsets.next_offset = offset + 1
+
+    def complete(self, topic: str, partition: int, offset: int):
+        """
+        Record that a message has finished processing. Completions for
+        partitions that are not being tracked, e.g. after they were revoked,
+        are ignored.
+        """
+        with self._lock:
+            offsets = self._partitions.get((topic, partition))
+            if offsets is not None:
+                offsets.outstanding.discard(offset)
+                self._completed_since_commit += 1
+
+    def completed_since_commit(self) -> int:
+        """Return the number of messages completed since `committable` was last called."""
+        with self._lock:
+            return self._completed_since_commit
+
+    def outstanding(self) -> int:
+        """Return the number of messages that have been received but not completed."""
+        with self._lock:
+            return sum(len(offsets.outstanding) for offsets in self._partitions.values())
+
+    def committable(self) -> List[TopicPartition]:
+        """
+        Return the offsets that can be committed for every partition that has
+        progressed since this was last called. The returned offsets are treated
+        as committed.
+        """
+        to_commit = []
+        with self._lock:
+            self._completed_since_commit = 0
+            for (topic, partition), offsets in self._partitions.items():
+                watermark = offsets.watermark()
+                if watermark is not None and (offsets.committed is None or watermark > offsets.committed):
+                    offsets.committed = watermark
+                    to_commit.append(TopicPartition(topic, partition, watermark))
+        return to_commit
+
+    def forget(self, partitions: Iterable[Tuple[str, int]]):
+        """Stop tracking the given (topic, partition) pairs, e.g. after they have been revoked."""
+        with self._lock:
+            for partition in partitions:
+                self._partitions.pop(partition, None)
@@ -0,0 +1,323 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""
+Handling of data_ready messages in three stages, connected by bounded queues,
+so that slow reductions don't hold up the creation of the records of new runs.
+
+- Intake: the records of waiting messages are created together, as queued, on
+  the intake thread, so every run shows up as queued in the web app as soon as
+  its message has been consumed, however busy the workers are.
+- Scheduling: on the scheduling thread, runs that are skipped or have errored
+  are finished straight away, and the rest are handed to the worker pool.
+- Execution: the worker pool reduces the runs, in its own order.
+
+The consumer keeps fetching messages while the runs in every stage stay below
+its high-water mark, so the mark is how far ahead of the workers runs are
+queued.
+"""
+import logging
+import os
+import threading
+from collections import defaultdict, deque
+from typing import Callable, Hashable, Iterable, List, NamedTuple, Optional
+
+from django.db import close_old_connections
+from autoreduce_utils.message.message import Message
+
+from autoreduce_qp.queue_processor.handle_message import HandleMessage, RunRequeued
+from autoreduce_qp.queue_processor.worker_pool import ReductionWorkerPool
+
+# The number of messages that may wait for their records to be created
+INTAKE_QUEUE_SIZE = int(os.getenv("AUTOREDUCE_QP_INTAKE_QUEUE_SIZE", "1000"))
+# The number of queued runs that may wait to be scheduled
+SCHEDULE_QUEUE_SIZE = int(os.getenv("AUTOREDUCE_QP_SCHEDULE_QUEUE_SIZE", "1000"))
+# The maximum number of messages whose records are created together
+INTAKE_BATCH_SIZE = int(os.getenv("AUTOREDUCE_QP_INTAKE_BATCH_SIZE", "100"))
+
+logger = logging.getLogger(__file__)
+
+
+class PipelineRun(NamedTuple):
+    """A message going through the pipeline, with its records once they have been created."""
+    incoming_message: object
+    message: Message
+    key: Optional[Hashable]
+    partition: Optional[Hashable]
+    lane: Optional[str]
+    records: Optional[tuple] = None
+    # The order the run was put in, used to tell whether its partition was
+    # revoked after it was put
+    sequence: int = 0
+
+
+class _StageQueue:
+    """
+    A queue in front of a stage. Putting blocks while it is full, and getting
+    blocks while it is empty, until it is closed.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def put(self, item):
+        """Add an item, waiting for room unless the queue is closed."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._closed or len(self._items) < self.maxsize)
+            self._items.append(item)
+            self._condition.notify_all()
+
+    def get_batch(self, max_items: int) -> list:
+        """
+        Remove up to max_items items, waiting for at least one. Returns an
+        empty list once the queue is closed and empty.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._closed or self._items)
+            batch = [self._items.popleft() for _ in range(min(max_items, len(self._items)))]
+            self._condition.notify_all()
+            return batch
+
+    def remove(self, predicate: Callable[[object], bool]) -> list:
+        """Remove and return the items that match the predicate."""
+        with self._condition:
+            removed = [item for item in self._items if predicate(item)]
+            for item in removed:
+                self._items.remove(item)
+            self._condition.notify_all()
+            return removed
+
+    def close(self):
+        """Wake anything waiting, and stop putting from waiting for room."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class ReductionPipeline:
+    """
+    Handles data_ready messages in the intake, scheduling and execution stages.
+
+    Args:
+        handler: The message handler that creates, schedules and reduces the runs.
+        pool: The worker pool that the runs are reduced on.
+        finish: Called with the Kafka message, and the exception if it failed
+        or was requeued, when a run has been handled, whichever stage it
+        finished in.
+        release: Called with the runs that a stage dropped because their
+        partition was revoked while they were being handled, in the same form
+        as discard returns.
+        intake_queue_size: The number of messages that may wait for their records.
+        schedule_queue_size: The number of runs that may wait to be scheduled.
+        batch_size: The maximum number of messages whose records are created together.
+    """
+
+    # pylint:disable=too-many-arguments
+    def __init__(self,
+                 handler: HandleMessage,
+                 pool: ReductionWorkerPool,
+                 finish: Callable[[object, Optional[Exception]], None],
+                 release: Optional[Callable[[List[tuple]], None]] = None,
+                 intake_queue_size: int = INTAKE_QUEUE_SIZE,
+                 schedule_queue_size: int = SCHEDULE_QUEUE_SIZE,
+                 batch_size: int = INTAKE_BATCH_SIZE):
+        self.handler = handler
+        self.pool = pool
+        self.finish = finish
+        self.release = release
+        self.batch_size = batch_size
+        # The sequence of the last run put, and for each revoked partition the
+        # sequence of the last run put before it was revoked. The stages drop
+        # the runs of revoked partitions, holding the lock while they hand runs
+        # to the pool
+        self._sequence = 0
+        self._revoked = {}
+        self._revoked_lock = threading.Lock()
+        self._intake = _StageQueue(intake_queue_size)
+        self._scheduling = _StageQueue(schedule_queue_size)
+        # The runs of each lane in the intake and scheduling stages
+        self._waiting = defaultdict(int)
+        self._waiting_lock = threading.Lock()
+        self._intake_thread = threading.Thread(target=self._run_intake, name="pipeline-intake", daemon=True)
+        self._scheduling_thread = threading.Thread(target=self._run_scheduling, name="pipeline-scheduling", daemon=True)
+        self._intake_thread.start()
+        self._scheduling_thread.start()
+
+    def put(self,
+            incoming_message,
+            message: Message,
+            key: Optional[Hashable] = None,
+            partition: Optional[Hashable] = None,
+            lane: Optional[str] = None):
+        """
+        Queue a data_ready message for intake. Blocks while the intake queue is full.
+
+        Args:
+            incoming_message: The Kafka message, passed back to finish.
+            message: The parsed message.
+            key: The ordering key the run is reduced under in the pool.
+            partition: The Kafka partition the message was consumed from.
+            lane: The lane the message belongs to.
+        """
+        with self._waiting_lock:
+            self._waiting[lane] += 1
+        with self._revoked_lock:
+            self._sequence += 1
+            sequence = self._sequence
+        self._intake.put(PipelineRun(incoming_message, message, key, partition, lane, sequence=sequence))
+
+    def in_flight(self, lane: Optional[str] = None) -> int:
+        """
+        Return the number of runs in any stage, in every lane or only in the
+        given one.
+        """
+        with self._waiting_lock:
+            waiting = sum(self._waiting.values()) if lane is None else self._waiting[lane]
+        return waiting + self.pool.in_flight(lane)
+
+    def discard(self, partitions: Optional[Iterable[Hashable]] = None) -> List[tuple]:
+        """
+        Remove the runs waiting for intake or scheduling, of every partition or
+        only of the given ones. When given partitions, runs of those partitions
+        that a stage is already handling are dropped by the stage and passed to
+        release instead of being handed to the pool, so the pool's runs must be
+        discarded after this.
+
+        Returns:
+            The Kafka message and records of each discarded run, in the same
+            form as the arguments of the pool's tasks. The records are None for
+            runs that hadn't been through intake.
+        """
+        partitions = None if partitions is None else set(partitions)
+        if partitions is not None:
+            with self._revoked_lock:
+                for partition in partitions:
+                    self._revoked[partition] = self._sequence
+        discarded = []
+        for queue in (self._scheduling, self._intake):
+            discarded.extend(queue.remove(lambda run: partitions is None or run.partition in partitions))
+        for run in discarded:
+            self._leave_stages(run)
+        return [(run.incoming_message, run.records) for run in discarded]
+
+    def close(self):
+        """
+        Handle the runs left waiting for intake and scheduling, then stop the
+        stage threads. Runs handed to the pool are left to it.
+        """
+        self._intake.close()
+        self._intake_thread.join()
+        self._scheduling_thread.join()
+
+    def _leave_stages(self, run: PipelineRun):
+        with self._waiting_lock:
+            self._waiting[run.lane] -= 1
+
+    def _is_revoked(self, run: PipelineRun) -> bool:
+        """Return whether the run's partition was revoked after it was put. Must hold the revoked lock."""
+        return run.sequence <= self._revoked.get(run.partition, 0)
+
+    def _drop_revoked(self, runs: List[PipelineRun]) -> List[PipelineRun]:
+        """Drop the runs whose partition has been revoked, passing them to release, and return the rest."""
+        with self._revoked_lock:
+            revoked = [run for run in runs if self._is_revoked(run)]
+        if not revoked:
+            return runs
+
+        self._release(revoked)
+        return [run for run in runs if run not in revoked]
+
+    def _release(self, runs: List[PipelineRun]):
+        logger.info("Dropped %s runs of revoked partitions", len(runs))
+        for run in runs:
+            self._leave_stages(run)
+        if self.release is not None:
+            self.release([(run.incoming_message, run.records) for run in runs])
+
+    def _run_intake(self):
+        """Create the records of waiting messages, in batches, and queue them for scheduling."""
+        try:
+            while True:
+                runs = self._intake.get_batch(self.batch_size)
+                if not runs:
+                    return
+                runs = self._drop_revoked(runs)
+                if not runs:
+                    continue
+                # Like a worker thread, drop connections that have gone stale between batches
+                close_old_connections()
+                try:
+                    results = self.handler.data_ready_batch([run.message for run in runs])
+                except Exception as err:  # pylint:disable=broad-except
+                    logger.exception("Could not create the records of %s runs", len(runs))
+                    results = [err] * len(runs)
+                for run, records in zip(runs, results):
+                    if isinstance(records, Exception):
+                        # The handler has logged the error
+                        self._leave_stages(run)
+                        self.finish(run.incoming_message, records)
+                    else:
+                        self._scheduling.put(run._replace(records=records))
+        finally:
+            self._scheduling.close()
+
+    def _run_scheduling(self):
+        """Finish the runs that won't be reduced, and hand the rest to the pool."""
+        while True:
+            runs = self._scheduling.get_batch(self.batch_size)
+            if not runs:
+                return
+            close_old_connections()
+            for run in self._drop_revoked(runs):
+                self._schedule(run)
+
+    def _schedule(self, run: PipelineRun):
+        reduction_run, message, instrument, _ = run.records
+        try:
+            needs_reduction = self.handler.schedule_run(reduction_run, message, instrument)
+        except Exception as err:  # pylint:disable=broad-except
+            logger.exception("Could not schedule run %s", message.run_number)
+            self._leave_stages(run)
+            self.finish(run.incoming_message, err)
+            return
+
+        if needs_reduction:
+            # Holding the lock, a revoke either happens before the check or
+            # after the submit, when the pool discards the run
+            with self._revoked_lock:
+                revoked = self._is_revoked(run)
+                if not revoked:
+                    self.pool.submit(message.instrument,
+                                     self._execute,
+                                     run.incoming_message,
+                                     run.records,
+                                     key=run.key,
+                                     partition=run.partition,
+                                     lane=run.lane)
+            if revoked:
+                self._release([run])
+            else:
+                self._leave_stages(run)
+        else:
+            self._leave_stages(run)
+            self.finish(run.incoming_message, None)
+
+    def _execute(self, incoming_message, records: tuple):
+        """Reduce a run. Called on a worker thread."""
+        reduction_run, message, _, software = records
+        try:
+            self.handler.execute_run(reduction_run, message, software)
+        except RunRequeued as err:
+            self.finish(incoming_message, err)
+        except Exception as err:  # pylint:disable=broad-except
+            logger.exception("Could not reduce run %s", message.run_number)
+            self.finish(incoming_message, err)
+        else:
+            self.finish(incoming_message, None)
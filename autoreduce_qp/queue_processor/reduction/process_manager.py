@@ -9,17 +9,22 @@ import logging
 import os
 from pathlib import Path
 import traceback
+import uuid
 import docker
-from docker.errors import APIError, ImageNotFound, ContainerError
+from docker.errors import APIError, ImageNotFound, ContainerError, NotFound
 
 from autoreduce_utils.settings import ARCHIVE_ROOT, AUTOREDUCE_HOME_ROOT, PROJECT_DEV_ROOT
 from autoreduce_utils.message.message import Message
 from autoreduce_db.reduction_viewer.models import Software
 
 from autoreduce_qp.queue_processor.reduction.utilities import get_correct_image
+from autoreduce_qp.queue_processor.stage_timing import stage
 
 logger = logging.getLogger(__file__)
 
+# Where AUTOREDUCE_HOME_ROOT is mounted in the reduction container
+CONTAINER_AUTOREDUCE_HOME = '/home/isisautoreduce/.autoreduce/'
+
 
 class ReductionProcessManager:
 
@@ -28,6 +33,9 @@ class ReductionProcessManager:
         self.run_name = run_name
         self.software = software
         self.mantid_path = os.path.expanduser("~/.mantid")
+        # Named so that the container can be found to stop it
+        self.container_name = f"autoreduce-{uuid.uuid4().hex}"
+        self.stopped = False
 
         if "AUTOREDUCTION_PRODUCTION" in os.environ:
             self.reduced_data_path = Path('/instrument')
@@ -37,12 +45,20 @@ class ReductionProcessManager:
     def run(self) -> Message:
         """Run the reduction subprocess."""
         try:
+            if self.stopped:
+                raise RuntimeError("The reduction was stopped before its container started")
             # We need to run the reduction in a new process, otherwise scripts
             # will fail when they use things that require access to a main loop
             # e.g. a GUI main loop, for matplotlib or Mantid
             serialized_vars = self.message.serialize()
             serialized_vars_truncated = self.message.serialize(limit_reduction_script=True)
-            args = ["autoreduce-runner-start", serialized_vars, self.run_name]
+            # Each reduction writes its result to its own file in the shared
+            # autoreduce directory, as several can run at the same time
+            output_name = f"output-{uuid.uuid4().hex}.txt"
+            output_path = Path(AUTOREDUCE_HOME_ROOT) / output_name
+            args = [
+                "autoreduce-runner-start", serialized_vars, self.run_name, f"{CONTAINER_AUTOREDUCE_HOME}{output_name}"
+            ]
             logger.info("Calling: %s %s %s %s ", "python3", "runner.py", serialized_vars_truncated, self.run_name)
 
             # Return a client configured from environment variables
@@ -50,7 +66,8 @@ class ReductionProcessManager:
             # https://docs.docker.com/engine/reference/commandline/cli/#environment-variables
             client = docker.from_env()
 
-            image = get_correct_image(client, self.software)
+            with stage("pull_image"):
+                image = get_correct_image(client, self.software)
 
             if "AUTOREDUCTION_PRODUCTION" not in os.environ:
                 if not os.path.exists(ARCHIVE_ROOT):
@@ -63,37 +80,42 @@ class ReductionProcessManager:
                 Path(AUTOREDUCE_HOME_ROOT).chmod(0o777)
                 Path(f'{AUTOREDUCE_HOME_ROOT}/logs/autoreduce.log').chmod(0o777)
 
-            container = client.containers.run(
-                image=image,
-                command=args,
-                volumes={
-                    AUTOREDUCE_HOME_ROOT: {
-                        'bind': '/home/isisautoreduce/.autoreduce/',
-                        'mode': 'rw'
-                    },
-                    self.mantid_path: {
-                        'bind': '/home/isisautoreduce/.mantid/',
-                        'mode': 'rw'
-                    },
-                    ARCHIVE_ROOT: {
-                        'bind': '/isis/',
-                        'mode': 'rw'
-                    },
-                    self.reduced_data_path: {
-                        'bind': '/instrument/',
-                        'mode': 'rw'
+            # The container starts, reduces the run and copies the results before this returns
+            with stage("run_container"):
+                container = client.containers.run(
+                    image=image,
+                    name=self.container_name,
+                    command=args,
+                    volumes={
+                        AUTOREDUCE_HOME_ROOT: {
+                            'bind': CONTAINER_AUTOREDUCE_HOME,
+                            'mode': 'rw'
+                        },
+                        self.mantid_path: {
+                            'bind': '/home/isisautoreduce/.mantid/',
+                            'mode': 'rw'
+                        },
+                        ARCHIVE_ROOT: {
+                            'bind': '/isis/',
+                            'mode': 'rw'
+                        },
+                        self.reduced_data_path: {
+                            'bind': '/instrument/',
+                            'mode': 'rw'
+                        },
                     },
-                },
-                stdin_open=True,
-                environment=["AUTOREDUCTION_PRODUCTION=1", "PYTHONIOENCODING=utf-8"],
-                stdout=True,
-                stderr=True,
-            )
+                    stdin_open=True,
+                    environment=["AUTOREDUCTION_PRODUCTION=1", "PYTHONIOENCODING=utf-8"],
+                    stdout=True,
+                    stderr=True,
+                )
 
             logger.info("Container logs %s", container.decode("utf-8"))
 
-            with open(f'{AUTOREDUCE_HOME_ROOT}/output.txt', encoding="utf-8", mode='r') as out_file:
-                result_message_raw = out_file.read()
+            with stage("read_result"):
+                with open(output_path, encoding="utf-8", mode='r') as out_file:
+                    result_message_raw = out_file.read()
+                output_path.unlink()
 
             result_message = Message()
 
@@ -114,3 +136,18 @@ class ReductionProcessManager:
             result_message = self.message
 
         return result_message
+
+    def stop(self):
+        """
+        Stop the reduction's container if it is running, or stop it from
+        starting if it hasn't yet.
+
+        Raises:
+            APIError: If the container could not be stopped.
+        """
+        self.stopped = True
+        try:
+            docker.from_env().containers.get(self.container_name).stop()
+        except NotFound:
+            # It hasn't started yet
+            pass
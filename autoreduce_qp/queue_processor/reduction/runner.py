@@ -119,11 +119,15 @@ class ReductionRunner:
         return None
 
 
-def write_reduction_message(reduction):
+# The file the result message is written to when the parent process doesn't give one
+DEFAULT_OUTPUT_PATH = "/home/isisautoreduce/.autoreduce/output.txt"
+
+
+def write_reduction_message(reduction, output_path: str = DEFAULT_OUTPUT_PATH):
     """
-    Write the reduction message to the reduction directory
+    Write the reduction message to the file the parent process reads it from
     """
-    with open("/home/isisautoreduce/.autoreduce/output.txt", mode="w+", encoding="utf-8") as out_file:
+    with open(output_path, mode="w+", encoding="utf-8") as out_file:
         out_file.write(reduction.message.serialize())
 
 
@@ -133,10 +137,13 @@ def main():
     ReductionProcessManager, and the required parameters to perform the reduction are passed
     as process arguments.
 
-    Additionally, the resulting Message is written to a temporary file which the
-    parent process reads back to mark the result of the reduction run in the DB.
+    Additionally, the resulting Message is written to a file, given as the third
+    argument, which the parent process reads back to mark the result of the
+    reduction run in the DB. Each reduction has its own file, so that reductions
+    running at the same time don't overwrite each other's results.
     """
     data, run_name = sys.argv[1], sys.argv[2]
+    output_path = sys.argv[3] if len(sys.argv) > 3 else DEFAULT_OUTPUT_PATH
 
     try:
         message = Message()
@@ -157,7 +164,7 @@ def main():
     try:
         reduction.reduce()
 
-        write_reduction_message(reduction)
+        write_reduction_message(reduction, output_path)
 
     except Exception as exp:
         logger.info("ReductionRunner error: %s", str(exp))
@@ -6,13 +6,16 @@
 # ############################################################################### #
 
 import os
+import tempfile
 import unittest
+from pathlib import Path
 from unittest.mock import Mock, patch
-from docker.errors import APIError, ImageNotFound
+from docker.errors import APIError, ImageNotFound, NotFound
 
 from autoreduce_db.reduction_viewer.models import Software
+from autoreduce_utils.message.message import Message
 
-from autoreduce_qp.queue_processor.reduction.process_manager import ReductionProcessManager
+from autoreduce_qp.queue_processor.reduction.process_manager import (CONTAINER_AUTOREDUCE_HOME, ReductionProcessManager)
 from autoreduce_qp.queue_processor.reduction.tests.common import (add_bad_data_and_message, add_data_and_message)
 
 
@@ -64,6 +67,44 @@ class TestReductionProcessManager(unittest.TestCase):
                 }
             })
 
+    @patch('autoreduce_qp.queue_processor.reduction.process_manager.get_correct_image')
+    @patch('autoreduce_qp.queue_processor.reduction.process_manager.docker.from_env')
+    def test_run_result_file_per_reduction(self, from_env: Mock, _):
+        """Test that each reduction reads its result from its own file, and removes it"""
+        with tempfile.TemporaryDirectory() as home:
+
+            def run_container(command, **_):
+                result = Message(run_number=command[2])
+                output_name = command[3][len(CONTAINER_AUTOREDUCE_HOME):]
+                Path(home, output_name).write_text(result.serialize(), encoding="utf-8")
+                return b""
+
+            from_env.return_value.containers.run.side_effect = run_container
+            with patch.dict(os.environ, {"AUTOREDUCTION_PRODUCTION": "1"}), \
+                    patch('autoreduce_qp.queue_processor.reduction.process_manager.AUTOREDUCE_HOME_ROOT', home):
+                results = [ReductionProcessManager(self.message, str(run), self.software).run() for run in (1, 2)]
+
+            assert [result.run_number for result in results] == [1, 2]
+            output_paths = [call[1]["command"][3] for call in from_env.return_value.containers.run.call_args_list]
+            assert len(set(output_paths)) == 2
+            assert not os.listdir(home)
+
+    @patch('autoreduce_qp.queue_processor.reduction.process_manager.docker.from_env')
+    def test_stop(self, from_env: Mock):
+        """Test that stopping a reduction stops its container, or stops it from starting"""
+        rpm = ReductionProcessManager(self.message, self.run_name, self.software)
+        rpm.stop()
+        from_env.return_value.containers.get.assert_called_once_with(rpm.container_name)
+        from_env.return_value.containers.get.return_value.stop.assert_called_once()
+
+        from_env.return_value.containers.get.side_effect = NotFound("not started")
+        rpm = ReductionProcessManager(self.message, self.run_name, self.software)
+        rpm.stop()
+        with patch('autoreduce_qp.queue_processor.reduction.process_manager.get_correct_image'):
+            result = rpm.run()
+        from_env.return_value.containers.run.assert_not_called()
+        assert "stopped before its container started" in result.message
+
     @patch('queue_processor.reduction.process_manager.docker.models.containers.ContainerCollection.run')
     def test_run_subprocess_error(self, docker_run: Mock):
         """Test proper handling of container encountering an error"""
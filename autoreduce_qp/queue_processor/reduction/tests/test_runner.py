@@ -78,6 +78,18 @@ class TestReductionRunner(unittest.TestCase):
         mock_reduce.assert_called_once()
         m_open.assert_called_with('/home/isisautoreduce/.autoreduce/output.txt', mode='w+', encoding='utf-8')
 
+    @patch(f'{DIR}.runner.ReductionRunner.reduce')
+    def test_main_output_path(self, mock_reduce):
+        """
+        Test: the result is written to the file given by the parent process
+        When: The main method is called with an output path
+        """
+        with patch('builtins.open', mock_open()) as m_open:
+            sys.argv = ['', json.dumps(self.data), self.run_name, '/home/isisautoreduce/.autoreduce/output-1.txt']
+            main()
+        mock_reduce.assert_called_once()
+        m_open.assert_called_with('/home/isisautoreduce/.autoreduce/output-1.txt', mode='w+', encoding='utf-8')
+
     @patch(f'{DIR}.runner.ReductionRunner.reduce', side_effect=Exception)
     def test_main_reduce_raises(self, mock_reduce):
         """
@@ -0,0 +1,159 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""
+Fetching of the remote files that reduction arguments point to, e.g. mask and
+map files on GitHub.
+
+Files are fetched concurrently through one shared session with a timeout, and
+kept in an on-disk cache. A cached file is revalidated with its ETag, so a file
+that hasn't changed is not downloaded again.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, NamedTuple, Optional, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from autoreduce_utils.settings import AUTOREDUCE_HOME_ROOT
+
+# The number of seconds to wait to connect to a remote source, and then for each read from it
+REMOTE_FETCH_TIMEOUT = float(os.getenv("AUTOREDUCE_QP_REMOTE_FETCH_TIMEOUT", "10"))
+# The number of files fetched at the same time
+REMOTE_FETCH_THREADS = int(os.getenv("AUTOREDUCE_QP_REMOTE_FETCH_THREADS", "4"))
+REMOTE_CACHE_DIR = os.getenv("AUTOREDUCE_QP_REMOTE_CACHE_DIR", os.path.join(AUTOREDUCE_HOME_ROOT, "remote_files"))
+
+logger = logging.getLogger(__file__)
+
+
+class RemoteFile(NamedTuple):
+    """The response for a remote file. The text is only set when the status code is 200."""
+    status_code: int
+    text: Optional[str] = None
+
+
+class RemoteFileFetcher:
+    """
+    Fetches remote files over HTTP, caching them on disk. Safe to share between
+    threads.
+
+    Args:
+        cache_dir: The directory to cache files in, or None to not cache them.
+        timeout: The number of seconds to wait to connect, and then for each read.
+        max_workers: The number of files fetched at the same time.
+        session: The session to fetch with. One is created if not given.
+    """
+
+    def __init__(self,
+                 cache_dir: Optional[str] = REMOTE_CACHE_DIR,
+                 timeout: float = REMOTE_FETCH_TIMEOUT,
+                 max_workers: int = REMOTE_FETCH_THREADS,
+                 session: Optional[requests.Session] = None):
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.max_workers = max_workers
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=max_workers)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+
+    def _cache_paths(self, url: str):
+        name = hashlib.sha256(url.encode("utf_8")).hexdigest()
+        return os.path.join(self.cache_dir, name), os.path.join(self.cache_dir, f"{name}.json")
+
+    def _read_cache(self, url: str):
+        """Return the cached text of a file and its validators, or None if it isn't cached."""
+        if self.cache_dir is None:
+            return None
+        content_path, metadata_path = self._cache_paths(url)
+        try:
+            with open(metadata_path, encoding="utf_8") as metadata_file:
+                metadata = json.load(metadata_file)
+            with open(content_path, encoding="utf_8") as content_file:
+                return content_file.read(), metadata
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, url: str, text: str, metadata: dict):
+        """Cache a file, replacing the cached copy atomically so that concurrent readers never see part of it."""
+        if self.cache_dir is None:
+            return
+        content_path, metadata_path = self._cache_paths(url)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for path, data in ((content_path, text), (metadata_path, json.dumps(metadata))):
+                with tempfile.NamedTemporaryFile("w", encoding="utf_8", dir=self.cache_dir, delete=False) as temp:
+                    temp.write(data)
+                os.replace(temp.name, path)
+        except OSError:
+            logger.exception("Could not cache remote file %s", url)
+
+    def fetch(self, url: str) -> RemoteFile:
+        """
+        Fetch a file, revalidating the cached copy if there is one.
+
+        Raises:
+            requests.RequestException: If the file could not be fetched, e.g.
+            because the connection failed or timed out.
+        """
+        cached = self._read_cache(url)
+        headers = {}
+        if cached is not None:
+            _, metadata = cached
+            if metadata.get("etag"):
+                headers["If-None-Match"] = metadata["etag"]
+            if metadata.get("last_modified"):
+                headers["If-Modified-Since"] = metadata["last_modified"]
+
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        if response.status_code == requests.codes.not_modified and cached is not None:
+            logger.debug("Using cached copy of %s", url)
+            return RemoteFile(requests.codes.ok, cached[0])
+        if response.status_code != requests.codes.ok:
+            return RemoteFile(response.status_code)
+
+        validators = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        if any(validators.values()):
+            self._write_cache(url, response.text, validators)
+        return RemoteFile(response.status_code, response.text)
+
+    def fetch_all(self, urls: Iterable[str]) -> Dict[str, Union[RemoteFile, requests.RequestException]]:
+        """
+        Fetch several files at the same time.
+
+        Returns:
+            For each URL, the file or the exception raised fetching it.
+        """
+        urls = list(dict.fromkeys(urls))
+        if len(urls) <= 1:
+            return {url: self._fetch_or_exception(url) for url in urls}
+
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="remote-files")
+        return dict(zip(urls, self._executor.map(self._fetch_or_exception, urls)))
+
+    def _fetch_or_exception(self, url: str) -> Union[RemoteFile, requests.RequestException]:
+        try:
+            return self.fetch(url)
+        except requests.RequestException as err:
+            return err
+
+
+REMOTE_FILES = RemoteFileFetcher()
@@ -0,0 +1,186 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""
+Caching of the text of the reduction scripts on disk, which are often on a
+network mount.
+
+A script is read again only when the modification time or size of its file
+changes, so most messages cost a stat instead of a read. When inotify_simple is
+installed and AUTOREDUCE_QP_SCRIPT_WATCH is true, the script directories are
+watched and a script is not even stat'ed until its file changes. Changes made
+on another host are not reported by inotify on most network filesystems, so
+only turn this on where the scripts are edited on the host running the queue
+processor.
+"""
+import hashlib
+import logging
+import os
+import threading
+from typing import Dict, NamedTuple, Optional, Tuple
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+from autoreduce_qp.queue_processor.reduction.service import ReductionScript
+
+SCRIPT_WATCH = os.getenv("AUTOREDUCE_QP_SCRIPT_WATCH", "false").lower() == "true"
+
+logger = logging.getLogger(__file__)
+
+
+def text_digest(text: str) -> str:
+    """Return the SHA-256 digest of a script's text."""
+    return hashlib.sha256(text.encode("utf_8")).hexdigest()
+
+
+class ScriptText(NamedTuple):
+    """The text of a script and its digest."""
+    text: str
+    digest: str
+
+
+class _DirectoryWatcher:
+    """
+    Watches directories with inotify, counting the changes to each file in
+    them. Any change is counted against every file if events are lost.
+    """
+    # Not CLOSE_WRITE, as ReductionScript.text opens scripts for writing as well as reading
+    FLAGS = ("MODIFY", "ATTRIB", "CREATE", "DELETE", "MOVED_FROM", "MOVED_TO", "DELETE_SELF")
+
+    def __init__(self):
+        self._inotify = inotify_simple.INotify()
+        self._mask = 0
+        for flag in self.FLAGS:
+            self._mask |= getattr(inotify_simple.flags, flag)
+        self._directories: Dict[int, str] = {}
+        self._changes: Dict[str, int] = {}
+        self._overflows = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="script-watcher", daemon=True)
+        self._thread.start()
+
+    def watch(self, directory: str) -> bool:
+        """Watch a directory, returning whether it is being watched."""
+        with self._lock:
+            if directory in self._directories.values():
+                return True
+        try:
+            descriptor = self._inotify.add_watch(directory, self._mask)
+        except OSError:
+            logger.warning("Cannot watch %s for changes to reduction scripts", directory)
+            return False
+        with self._lock:
+            self._directories[descriptor] = directory
+        return True
+
+    def changes(self, path: str) -> Optional[Tuple[int, int]]:
+        """
+        Return a count that changes whenever the file at the path changes, or
+        None if its directory is not being watched.
+        """
+        with self._lock:
+            if os.path.dirname(path) not in self._directories.values():
+                return None
+            return self._overflows, self._changes.get(path, 0)
+
+    def _run(self):
+        while not self._closed.is_set():
+            events = self._inotify.read(timeout=500)
+            with self._lock:
+                for event in events:
+                    if event.mask & inotify_simple.flags.Q_OVERFLOW:
+                        self._overflows += 1
+                        continue
+                    directory = self._directories.get(event.wd)
+                    if directory is None:
+                        continue
+                    if event.mask & (inotify_simple.flags.DELETE_SELF | inotify_simple.flags.IGNORED):
+                        # Everything in a directory that is no longer watched has to be stat'ed again
+                        del self._directories[event.wd]
+                        self._overflows += 1
+                        continue
+                    path = os.path.join(directory, event.name)
+                    self._changes[path] = self._changes.get(path, 0) + 1
+
+    def close(self):
+        """Stop watching all directories."""
+        self._closed.set()
+        self._thread.join()
+        self._inotify.close()
+
+
+class ScriptFileCache:
+    """
+    Caches the text of reduction scripts by the path, modification time and
+    size of their files. Safe to share between threads.
+
+    Args:
+        watch: Whether to watch the scripts' directories with inotify, so that
+        unchanged scripts aren't stat'ed either.
+    """
+
+    def __init__(self, watch: bool = SCRIPT_WATCH):
+        self._entries: Dict[str, Tuple[tuple, Optional[tuple], ScriptText]] = {}
+        self._lock = threading.Lock()
+        self._watcher = None
+        if watch:
+            if inotify_simple is None:
+                logger.warning("inotify_simple is not installed, so reduction scripts will be stat'ed for changes")
+            else:
+                self._watcher = _DirectoryWatcher()
+
+    def read(self, script: ReductionScript) -> ScriptText:
+        """
+        Return the text of a script, reading the file only if it has changed
+        since it was last read. A missing file has empty text, as with
+        ReductionScript.text.
+        """
+        path = str(script.script_path)
+        with self._lock:
+            entry = self._entries.get(path)
+
+        changes = None
+        if self._watcher is not None and self._watcher.watch(os.path.dirname(path)):
+            # Counted before the file is stat'ed, so that a change while it is being read is never missed
+            changes = self._watcher.changes(path)
+            if entry is not None and changes is not None and entry[1] == changes:
+                return entry[2]
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            text = script.text()
+            return ScriptText(text, text_digest(text))
+
+        file_key = (stat.st_mtime_ns, stat.st_size)
+        if entry is not None and entry[0] == file_key:
+            result = entry[2]
+        else:
+            logger.debug("Reading reduction script %s", path)
+            text = script.text()
+            result = ScriptText(text, text_digest(text))
+        with self._lock:
+            self._entries[path] = (file_key, changes, result)
+        return result
+
+    def clear(self):
+        """Forget the text of every script."""
+        with self._lock:
+            self._entries.clear()
+
+    def close(self):
+        """Stop watching for changes to the scripts."""
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+
+
+SCRIPT_FILES = ScriptFileCache()
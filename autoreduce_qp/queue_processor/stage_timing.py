@@ -0,0 +1,94 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""
+Timing of the stages of handling a run, e.g. creating its records, pulling the
+image and running the container.
+
+The timings of a run are collected while they are active, from wherever a stage
+happens, e.g. `with stage("pull_image"):`, without being passed down. Each stage
+is observed in HANDLER_STAGE_SECONDS by instrument, and when the run has been
+handled all of its stages are logged together on one line, as JSON. A stage
+inside another is counted in both, e.g. pull_image is part of reduce.
+"""
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+from autoreduce_qp.queue_processor.metrics import HANDLER_STAGE_SECONDS
+
+logger = logging.getLogger(__file__)
+
+
+class StageTimings:
+    """
+    The time spent in each stage of handling a run.
+
+    Args:
+        instrument: The name of the run's instrument, which the stages are observed under.
+        fields: Anything else to log with the timings, e.g. the run number.
+    """
+
+    def __init__(self, instrument: str, **fields):
+        self.instrument = instrument
+        self.fields = fields
+        self.stages: Dict[str, float] = {}
+        self._start = time.perf_counter()
+
+    def add(self, name: str, seconds: float):
+        """Record time spent in a stage, adding to any already spent in it."""
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        HANDLER_STAGE_SECONDS.observe(seconds, stage=name, instrument=self.instrument)
+
+    @contextmanager
+    def activate(self) -> Iterator["StageTimings"]:
+        """Record the stages in the body of the `with` block in these timings."""
+        token = _CURRENT_TIMINGS.set(self)
+        try:
+            yield self
+        finally:
+            _CURRENT_TIMINGS.reset(token)
+
+    def log(self):
+        """Log the time spent in each stage, and since the timings were created, on one line."""
+        record = {
+            "instrument": self.instrument,
+            **self.fields,
+            "elapsed_seconds": round(time.perf_counter() - self._start, 6),
+            "stages": {name: round(seconds, 6)
+                       for name, seconds in self.stages.items()},
+        }
+        logger.info("Run stage timings %s", json.dumps(record, default=str))
+
+
+_CURRENT_TIMINGS: ContextVar[Optional[StageTimings]] = ContextVar("stage_timings", default=None)
+
+
+def current_timings() -> Optional[StageTimings]:
+    """Return the timings being recorded, if any."""
+    return _CURRENT_TIMINGS.get()
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Time the body of the `with` block as a stage of the run whose timings are
+    active. Outside of a run it is only observed in HANDLER_STAGE_SECONDS.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        timings = _CURRENT_TIMINGS.get()
+        if timings is None:
+            HANDLER_STAGE_SECONDS.observe(elapsed, stage=name, instrument="")
+        else:
+            timings.add(name, elapsed)
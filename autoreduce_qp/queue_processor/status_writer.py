@@ -0,0 +1,176 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""
+Writing of the status transitions of reduction runs.
+
+Only the columns that changed are written, with a single UPDATE per run, so
+that e.g. marking a run as started doesn't rewrite its reduction log. Updates
+that can wait, like a run starting, are written behind on a background thread,
+in batches; updates to the same run that are waiting are merged. Updates that
+must not be lost, like a run finishing, are written before the caller carries
+on, together with anything still waiting. Inside a transaction they are written
+as part of it instead, and anything still waiting once it has committed.
+"""
+import logging
+import os
+import threading
+from typing import Dict
+
+from django.db import close_old_connections, connections, transaction
+from django.utils import timezone
+
+from autoreduce_db.reduction_viewer.models import ReductionRun
+
+# The number of seconds an update may wait before it is written. Set to 0 to
+# write every update straight away
+STATUS_FLUSH_INTERVAL = float(os.getenv("AUTOREDUCE_QP_STATUS_FLUSH_INTERVAL", "1"))
+# The number of waiting updates at which they are written without waiting for the interval
+STATUS_FLUSH_BATCH_SIZE = int(os.getenv("AUTOREDUCE_QP_STATUS_FLUSH_BATCH_SIZE", "100"))
+
+logger = logging.getLogger(__file__)
+
+
+class StatusUpdateWriter:
+    """
+    Writes changes to the fields of reduction runs, merging and batching those
+    that may be written behind. Safe to share between threads.
+
+    Args:
+        flush_interval: The number of seconds an update may wait before it is
+        written, or 0 to write every update straight away.
+        batch_size: The number of waiting updates at which they are written
+        without waiting for the interval.
+    """
+
+    def __init__(self, flush_interval: float = STATUS_FLUSH_INTERVAL, batch_size: int = STATUS_FLUSH_BATCH_SIZE):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        # The fields waiting to be written, by the primary key of their run
+        self._pending: Dict[int, dict] = {}
+        self._pending_lock = threading.Lock()
+        # Held while writing, so that older values can never be written over newer ones
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = None
+
+    def update(self, reduction_run: ReductionRun, wait: bool = True, **fields):
+        """
+        Set fields of a run, and write them to the database.
+
+        Args:
+            reduction_run: The run to update. The fields are set on it straight away.
+            wait: Whether to write the update, and any waiting ones, before
+            returning. Otherwise it is written behind. Inside a transaction
+            the update is written as part of it, and the waiting ones after
+            it commits.
+            fields: The values of the fields to change.
+
+        Raises:
+            DatabaseError: If wait is True and the updates could not be written.
+            They are written again with the next updates.
+        """
+        for name, value in fields.items():
+            setattr(reduction_run, name, value)
+
+        if wait and transaction.get_connection().in_atomic_block:
+            self._update_in_transaction(reduction_run.pk, fields)
+            return
+
+        with self._pending_lock:
+            self._pending.setdefault(reduction_run.pk, {}).update(fields)
+            pending = len(self._pending)
+
+        if wait or self.flush_interval <= 0 or self._closed:
+            self.flush()
+            return
+
+        self._start()
+        if pending >= self.batch_size:
+            self._wake.set()
+
+    def pending(self) -> int:
+        """Return the number of runs with updates waiting to be written."""
+        with self._pending_lock:
+            return len(self._pending)
+
+    def flush(self):
+        """
+        Write all waiting updates, with an UPDATE of the changed columns for
+        each run, in one transaction.
+
+        Raises:
+            DatabaseError: If the updates could not be written. They are kept
+            to be written again.
+        """
+        with self._flush_lock:
+            with self._pending_lock:
+                updates, self._pending = self._pending, {}
+            if not updates:
+                return
+            try:
+                # update() skips auto_now fields, so last_updated is set here
+                last_updated = timezone.now()
+                with transaction.atomic():
+                    for run_pk, fields in updates.items():
+                        ReductionRun.objects.filter(pk=run_pk).update(**fields, last_updated=last_updated)
+            except Exception:
+                with self._pending_lock:
+                    # Anything updated since takes precedence over what failed
+                    for run_pk, fields in updates.items():
+                        self._pending[run_pk] = {**fields, **self._pending.get(run_pk, {})}
+                raise
+
+    def _update_in_transaction(self, run_pk: int, fields: dict):
+        """
+        Write a run's update as part of the caller's transaction, so that it is
+        rolled back with it. The waiting updates are left out, as a rollback
+        would lose them too, and are written once the transaction commits.
+        """
+        with self._flush_lock:
+            with self._pending_lock:
+                # Waiting values of the same fields are older, and must not be written over this update
+                waiting = {name: value for name, value in self._pending.pop(run_pk, {}).items() if name not in fields}
+                if waiting:
+                    self._pending[run_pk] = waiting
+            ReductionRun.objects.filter(pk=run_pk).update(**fields, last_updated=timezone.now())
+        transaction.on_commit(self.flush)
+
+    def _start(self):
+        with self._pending_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="status-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                self._wake.wait(self.flush_interval)
+                self._wake.clear()
+                if self._closed:
+                    # Whatever is left is written by close
+                    return
+                # Drop the connection if the database has closed it since the last flush
+                close_old_connections()
+                try:
+                    self.flush()
+                except Exception:  # pylint:disable=broad-except
+                    logger.exception("Could not write %s status updates, retrying", self.pending())
+        finally:
+            connections.close_all()
+
+    def close(self):
+        """Write any waiting updates and stop the background thread."""
+        self._closed = True
+        self._wake.set()
+        with self._pending_lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        self.flush()
@@ -0,0 +1,313 @@
+import asyncio
+import functools
+import threading
+import time
+from unittest import TestCase, main, mock
+
+import confluent_kafka
+from autoreduce_utils.message.message import Message
+
+from autoreduce_qp.queue_processor.async_consumer import AsyncConsumer
+from autoreduce_qp.queue_processor.dead_letter import DeadLetterQueue
+from autoreduce_qp.queue_processor.deduplication import DeduplicationStore
+from autoreduce_qp.queue_processor.handle_message import HandleMessage, RunRequeued
+from autoreduce_qp.queue_processor.lanes import LANE_TOPICS, LaneWeights
+from autoreduce_qp.queue_processor.local_store import LocalStore
+
+
+class AsyncConsumerTestCase(TestCase):
+
+    def setUp(self):
+        self.mocked_handler = mock.MagicMock(spec=HandleMessage)
+        self.mocked_handler.data_ready_batch.side_effect = lambda messages: [("run", message) for message in messages]
+        self.dead_letter_publisher = mock.Mock()
+        self.dead_letter_publisher.producer.flush.return_value = 0
+        self.dead_letters = DeadLetterQueue(publisher=self.dead_letter_publisher,
+                                            store=LocalStore("message_attempts", ":memory:"))
+        self.deduplication = DeduplicationStore(store=LocalStore("processed_messages", ":memory:"))
+        self.lane_weights = LaneWeights(store=LocalStore("lane_weights", ":memory:"))
+        self.mock_confluent_consumer = None
+
+    def _make_consumer(self, **kwargs):
+        with mock.patch("autoreduce_qp.queue_processor.async_consumer.HandleMessage",
+                        return_value=self.mocked_handler), \
+                mock.patch("autoreduce_qp.queue_processor.async_consumer.DeserializingConsumer") \
+                as mock_confluent_consumer:
+            consumer = AsyncConsumer(dead_letters=self.dead_letters,
+                                     deduplication=self.deduplication,
+                                     lane_weights=self.lane_weights,
+                                     **kwargs)
+        self.mock_confluent_consumer = mock_confluent_consumer.return_value
+        self.mock_confluent_consumer.assignment.return_value = []
+        return consumer
+
+    @staticmethod
+    def _make_message(offset, run_number=1, key=None, topic="data_ready", value=None):
+        """Make a Kafka message for a data_ready message"""
+        incoming_message = mock.MagicMock(spec=confluent_kafka.Message)
+        incoming_message.error.return_value = None
+        incoming_message.topic.return_value = topic
+        incoming_message.partition.return_value = 0
+        incoming_message.offset.return_value = offset
+        incoming_message.key.return_value = key
+        if value is None:
+            value = Message(run_number=run_number, instrument="MARI").json()
+        incoming_message.value.return_value = value
+        return incoming_message
+
+    def _run(self, consumer, messages, until, drain_timeout=None):
+        """
+        Run the consumer on the given messages until `until()` is true, then
+        stop or drain it.
+        """
+        pending = list(messages)
+
+        def poll(_):
+            if pending:
+                return pending.pop(0)
+            time.sleep(0.01)
+            return None
+
+        self.mock_confluent_consumer.poll.side_effect = poll
+
+        async def run():
+            task = asyncio.create_task(consumer.run())
+            deadline = time.monotonic() + 5
+            while not until() and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            if drain_timeout is None:
+                consumer.stop()
+            else:
+                consumer.drain(timeout=drain_timeout)
+            await asyncio.wait_for(task, 5)
+
+        asyncio.run(run())
+
+    def test_invalid_water_marks(self):
+        """Test that the low-water mark must be below the high-water mark"""
+        with self.assertRaises(ValueError):
+            self._make_consumer(high_water_mark=2, low_water_mark=2)
+
+    def test_reductions_run_concurrently(self):
+        """Test that runs with different keys are reduced at the same time and their offsets committed"""
+        barrier = threading.Barrier(2, timeout=5)
+        self.mocked_handler.process_run_records.side_effect = lambda *_: barrier.wait()
+        consumer = self._make_consumer(concurrency=2, instrument_concurrency=2)
+
+        self._run(consumer,
+                  [self._make_message(10, key="a"), self._make_message(11, key="b")],
+                  until=lambda: self.mocked_handler.process_run_records.call_count == 2)
+
+        self.assertFalse(barrier.broken)
+        self.dead_letter_publisher.producer.produce.assert_not_called()
+        self.mock_confluent_consumer.commit.assert_called_with(
+            offsets=[confluent_kafka.TopicPartition("data_ready", 0, 12)], asynchronous=False)
+        self.mock_confluent_consumer.close.assert_called_once()
+        self.assertEqual(0, consumer.in_flight())
+
+    def test_same_key_reduced_in_order(self):
+        """Test that runs with the same key are reduced one at a time in the order they were received"""
+        reduced = []
+        running = threading.Lock()
+
+        def reduce(_, message):
+            self.assertTrue(running.acquire(blocking=False))  # pylint:disable=consider-using-with
+            time.sleep(0.05)
+            reduced.append(message.run_number)
+            running.release()
+
+        self.mocked_handler.process_run_records.side_effect = reduce
+        consumer = self._make_consumer(concurrency=2, instrument_concurrency=2)
+
+        self._run(consumer, [self._make_message(10, run_number=1),
+                             self._make_message(11, run_number=2)],
+                  until=lambda: len(reduced) == 2)
+
+        self.assertEqual([1, 2], reduced)
+        self.assertEqual({}, consumer._key_locks)  # pylint:disable=protected-access
+
+    def test_bad_message_quarantined(self):
+        """Test that a message that can't be decoded is quarantined and its offset committed"""
+        consumer = self._make_consumer()
+
+        self._run(consumer, [self._make_message(10, value="bad_message")],
+                  until=lambda: self.dead_letter_publisher.producer.produce.called)
+
+        self.mocked_handler.data_ready_batch.assert_not_called()
+        self.assertEqual("bad_message", self.dead_letter_publisher.producer.produce.call_args[0][1])
+        self.mock_confluent_consumer.commit.assert_called_with(
+            offsets=[confluent_kafka.TopicPartition("data_ready", 0, 11)], asynchronous=False)
+
+    @mock.patch("autoreduce_qp.queue_processor.async_consumer.RETRY_DELAY", 0)
+    def test_failed_records_quarantined(self):
+        """
+        Test that a message whose records can't be created is retried until it
+        has used up its attempts, then quarantined and not reduced
+        """
+        self.mocked_handler.data_ready_batch.side_effect = lambda messages: [ValueError("no experiment")]
+        consumer = self._make_consumer()
+
+        self._run(consumer, [self._make_message(10)], until=lambda: self.dead_letter_publisher.producer.produce.called)
+
+        self.assertEqual(self.dead_letters.max_attempts, self.mocked_handler.data_ready_batch.call_count)
+        self.mocked_handler.process_run_records.assert_not_called()
+        headers = self.dead_letter_publisher.producer.produce.call_args[1]["headers"]
+        self.assertEqual(f"Failed {self.dead_letters.max_attempts} times, last with ValueError: no experiment",
+                         headers["reason"])
+
+    @mock.patch("autoreduce_qp.queue_processor.async_consumer.RETRY_DELAY", 0)
+    def test_transient_error_retried(self):
+        """Test that a reduction that fails once is retried, and its offset committed once it succeeds"""
+        self.mocked_handler.process_run_records.side_effect = [RuntimeError("Docker unavailable"), None]
+        consumer = self._make_consumer()
+        incoming_message = self._make_message(10)
+
+        self._run(consumer, [incoming_message], until=lambda: self.deduplication.seen(incoming_message))
+
+        self.assertEqual(2, self.mocked_handler.data_ready_batch.call_count)
+        self.assertEqual(2, self.mocked_handler.process_run_records.call_count)
+        self.dead_letter_publisher.producer.produce.assert_not_called()
+        self.mock_confluent_consumer.commit.assert_called_with(
+            offsets=[confluent_kafka.TopicPartition("data_ready", 0, 11)], asynchronous=False)
+
+    def test_unknown_topic(self):
+        """Test that a message on an unknown topic is skipped"""
+        consumer = self._make_consumer()
+
+        self._run(consumer, [self._make_message(10, topic="fake_topic")],
+                  until=lambda: self.mock_confluent_consumer.poll.call_count > 1)
+
+        self.mocked_handler.data_ready_batch.assert_not_called()
+        self.mock_confluent_consumer.commit.assert_called_with(
+            offsets=[confluent_kafka.TopicPartition("fake_topic", 0, 11)], asynchronous=False)
+
+    def test_duplicate_dropped(self):
+        """Test that a message delivered again after a restart is not reduced again"""
+        for _ in range(2):
+            consumer = self._make_consumer()
+            finished = functools.partial(
+                lambda consumer: self.mock_confluent_consumer.poll.call_count > 1 and not consumer.in_flight(),
+                consumer)
+            self._run(consumer, [self._make_message(10)], until=finished)
+
+        self.mocked_handler.process_run_records.assert_called_once()
+        self.mock_confluent_consumer.commit.assert_called_with(
+            offsets=[confluent_kafka.TopicPartition("data_ready", 0, 11)], asynchronous=False)
+
+    def test_backpressure(self):
+        """Test that a lane's partitions are paused at the high-water mark and resumed at the low-water mark"""
+        release = threading.Event()
+        self.mocked_handler.process_run_records.side_effect = lambda *_: release.wait(5)
+        consumer = self._make_consumer(concurrency=1, high_water_mark=2, low_water_mark=1)
+        partition = confluent_kafka.TopicPartition(LANE_TOPICS["live"], 0)
+
+        def paused():
+            if self.mock_confluent_consumer.pause.called:
+                release.set()
+            return self.mock_confluent_consumer.resume.called
+
+        self.mock_confluent_consumer.assignment.return_value = [partition]
+        self._run(consumer, [self._make_message(10, key="a"), self._make_message(11, key="b")], until=paused)
+
+        self.mock_confluent_consumer.pause.assert_called_once_with([partition])
+        self.mock_confluent_consumer.resume.assert_called_once_with([partition])
+
+    def test_lanes_share_reductions_by_weight(self):
+        """Test that waiting runs are started by the weights of their lanes rather than in the order they arrived"""
+        self.lane_weights = LaneWeights(store=LocalStore("lane_weights", ":memory:"),
+                                        defaults="live=10,rerun=1,batch=1")
+        release = threading.Event()
+        reduced = []
+
+        def reduce(_, message):
+            release.wait(5)
+            reduced.append(message.run_number)
+
+        self.mocked_handler.process_run_records.side_effect = reduce
+        consumer = self._make_consumer(concurrency=1, instrument_concurrency=4, high_water_mark=10, low_water_mark=1)
+
+        def waiting():
+            if len(consumer._slots._waiting) == 3:  # pylint:disable=protected-access
+                release.set()
+            return len(reduced) == 4
+
+        # The batch run takes the only slot, and the rest wait for it
+        self._run(consumer, [
+            self._make_message(10, run_number=1, key="a", topic=LANE_TOPICS["batch"]),
+            self._make_message(11, run_number=2, key="b", topic=LANE_TOPICS["rerun"]),
+            self._make_message(12, run_number=3, key="c", topic=LANE_TOPICS["rerun"]),
+            self._make_message(13, run_number=4, key="d", topic=LANE_TOPICS["live"]),
+        ],
+                  until=waiting)
+
+        self.assertEqual([1, 4, 2, 3], reduced)
+
+    def test_refresh_lane_weights(self):
+        """Test that weights changed at runtime are used for the reductions waiting for a slot"""
+        consumer = self._make_consumer()
+        self.lane_weights.set("rerun", 7)
+
+        consumer.refresh_lane_weights(force=True)
+
+        self.assertEqual(7, consumer.scheduled_lane_weights()["rerun"])
+
+    def test_drain_requeues_unfinished_reductions(self):
+        """Test that reductions still running at the deadline are requeued and their offsets not committed"""
+        release = threading.Event()
+        self.mocked_handler.process_run_records.side_effect = lambda *_: release.wait(5)
+        self.mocked_handler.requeue_active_runs.return_value = ["run"]
+        consumer = self._make_consumer()
+
+        try:
+            # The reduction keeps running after it was requeued
+            with mock.patch("autoreduce_qp.queue_processor.async_consumer.REQUEUE_STOP_TIMEOUT", 0.1):
+                self._run(consumer, [self._make_message(10), self._make_message(11)],
+                          until=lambda: self.mocked_handler.process_run_records.called,
+                          drain_timeout=0.1)
+        finally:
+            release.set()
+
+        self.assertFalse(consumer.drained)
+        self.mocked_handler.process_run_records.assert_called_once()
+        self.mocked_handler.requeue_active_runs.assert_called_once()
+        self.mock_confluent_consumer.commit.assert_not_called()
+        self.mock_confluent_consumer.close.assert_called_once()
+
+    def test_drain_leaves_requeued_runs_unfinished(self):
+        """
+        Test that a reduction released by stopping its container at the drain
+        deadline leaves its message to be delivered again
+        """
+        release = threading.Event()
+
+        def reduce(*_):
+            release.wait(5)
+            raise RunRequeued("Run 1 was requeued while it was being reduced")
+
+        def requeue():
+            # Stopping the container is what ends the reduction
+            release.set()
+            return ["run"]
+
+        self.mocked_handler.process_run_records.side_effect = reduce
+        self.mocked_handler.requeue_active_runs.side_effect = requeue
+        consumer = self._make_consumer()
+        incoming_message = self._make_message(10)
+
+        try:
+            self._run(consumer, [incoming_message],
+                      until=lambda: self.mocked_handler.process_run_records.called,
+                      drain_timeout=0.1)
+        finally:
+            release.set()
+
+        self.mocked_handler.requeue_active_runs.assert_called_once()
+        self.assertEqual(consumer.offsets.committable(), [])
+        self.assertFalse(self.deduplication.seen(incoming_message))
+        self.assertIsNone(self.dead_letters.store.get(DeadLetterQueue.message_key(incoming_message)))
+        self.dead_letter_publisher.publish.assert_not_called()
+        self.mock_confluent_consumer.commit.assert_not_called()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,21 @@
+import json
 import os
 import threading
+import time
 from unittest import TestCase, main, mock
 import confluent_kafka
 from autoreduce_utils.clients.producer import Publisher
 from autoreduce_utils.message.message import Message
 from autoreduce_utils.clients.connection_exception import ConnectionException
 from autoreduce_qp.queue_processor.confluent_consumer import Consumer, setup_connection
-from autoreduce_qp.queue_processor.handle_message import HandleMessage
+from autoreduce_qp.queue_processor.dead_letter import DeadLetterQueue
+from autoreduce_qp.queue_processor.deduplication import DeduplicationStore
+from autoreduce_qp.queue_processor.handle_message import HandleMessage, RunRequeued
+from autoreduce_qp.queue_processor.lanes import LANE_TOPICS, LaneWeights
+from autoreduce_qp.queue_processor.local_store import LocalStore
+from autoreduce_qp.queue_processor.metrics import (CONSUMER_LAG, MESSAGES_COMPLETED, MESSAGES_RECEIVED,
+                                                   REDUCTIONS_IN_FLIGHT)
 
-TRANSACTIONS_TOPIC = os.getenv('KAFKA_TOPIC')
 KAFKA_BROKER_URL = os.getenv("KAFKA_BROKER_URL")
 GROUP_ID = 1
 
@@ -21,15 +28,27 @@ class KafkaTestCase(TestCase):
         self.bad_message = "bad_message"
         self.good_message = Message()
         self.mock_confluent_message = mock.MagicMock(spec=confluent_kafka.Message)
+        self.mock_confluent_message.partition.return_value = 0
+        self.mock_confluent_message.offset.return_value = 10
+        self.dead_letter_publisher = mock.Mock()
+        self.dead_letter_publisher.producer.flush.return_value = 0
+        self.dead_letters = DeadLetterQueue(publisher=self.dead_letter_publisher,
+                                            store=LocalStore("message_attempts", ":memory:"))
+        self.lane_weights = LaneWeights(store=LocalStore("lane_weights", ":memory:"))
+        self.deduplication = DeduplicationStore(store=LocalStore("processed_messages", ":memory:"))
 
         with mock.patch("autoreduce_qp.queue_processor.confluent_consumer.HandleMessage",
                         return_value=self.mocked_handler), \
             mock.patch("autoreduce_qp.queue_processor.confluent_consumer.DeserializingConsumer")\
                 as mock_confluent_consumer, mock.patch("logging.getLogger") as patched_logger:
-            self.consumer = Consumer()
+            self.consumer = Consumer(dead_letters=self.dead_letters,
+                                     lane_weights=self.lane_weights,
+                                     deduplication=self.deduplication)
             self.mocked_logger = patched_logger.return_value
             self.mock_confluent_consumer = mock_confluent_consumer.return_value
-            self.mock_confluent_consumer.subscribe.assert_called_with([TRANSACTIONS_TOPIC])
+            self.mock_confluent_consumer.subscribe.assert_called_with(list(LANE_TOPICS.values()),
+                                                                      on_assign=self.consumer.on_assign,
+                                                                      on_revoke=self.consumer.on_revoke)
 
     def test_on_message_unknown_topic(self):
         """Test receiving a message on an unknown topic"""
@@ -46,6 +65,8 @@ class KafkaTestCase(TestCase):
         self.mock_confluent_message.value.return_value = self.bad_message
         self.consumer.on_message(self.mock_confluent_message)
         self.mocked_logger.error.assert_called_with("Could not decode message: %s", self.bad_message)
+        self.dead_letter_publisher.producer.produce.assert_called_once()
+        self.assertEqual(self.bad_message, self.dead_letter_publisher.producer.produce.call_args[0][1])
 
     def test_on_message_handler_catches_exceptions(self):
         """Test on_message correctly handles an exception being raised"""
@@ -58,6 +79,442 @@ class KafkaTestCase(TestCase):
         self.consumer.on_message(self.mock_confluent_message)
         self.mocked_logger.error.assert_called_once()
 
+    def test_on_message_data_ready_dispatched_to_pool(self):
+        """Test that a data_ready message is reduced on the pool and its offset committed afterwards"""
+        self.mock_confluent_message.topic.return_value = "data_ready"
+        self.mock_confluent_message.value.return_value = self.good_message.json()
+        self.consumer.on_message(self.mock_confluent_message)
+        self.assertTrue(self.consumer.pool.wait(timeout=5))
+
+        self.mocked_handler.data_ready.assert_called_once_with(self.good_message)
+        self.dead_letter_publisher.producer.produce.assert_not_called()
+        self.assertIsNone(self.dead_letters.store.get(DeadLetterQueue.message_key(self.mock_confluent_message)))
+        self.mock_confluent_consumer.commit.assert_not_called()
+        self.consumer.commit_completed(force=True)
+        self.mock_confluent_consumer.commit.assert_called_once_with(
+            offsets=[confluent_kafka.TopicPartition("data_ready", 0, 11)], asynchronous=True)
+
+    def test_on_message_duplicate_dropped(self):
+        """Test that a message delivered again after it was processed is dropped without reaching the handler"""
+        self.mock_confluent_message.topic.return_value = "data_ready"
+        self.mock_confluent_message.value.return_value = self.good_message.json()
+        self.consumer.on_message(self.mock_confluent_message)
+        self.assertTrue(self.consumer.pool.wait(timeout=5))
+        self.consumer.offsets.forget({("data_ready", 0)})
+
+        self.consumer.on_message(self.mock_confluent_message)
+        self.assertTrue(self.consumer.pool.wait(timeout=5))
+
+        self.mocked_handler.data_ready.assert_called_once_with(self.good_message)
+        self.consumer.commit_completed(force=True)
+        self.mock_confluent_consumer.commit.assert_called_once_with(
+            offsets=[confluent_kafka.TopicPartition("data_ready", 0, 11)], asynchronous=True)
+
+    @mock.patch("autoreduce_qp.queue_processor.confluent_consumer.RETRY_DELAY", 0)
+    def test_process_data_ready_handler_exception(self):
+        """
+        Test that a message whose handler keeps raising is retried until it
+        has used up its attempts, then quarantined with the offset still
+        committed
+        """
+        self.mocked_handler.data_ready.side_effect = RuntimeError("Reduction failed")
+        self.mock_confluent_message.topic.return_value = "data_ready"
+        self.mock_confluent_message.value.return_value = self.good_message.json()
+        self.consumer.offsets.track("data_ready", 0, 10)
+        self.assertTrue(self.consumer.start_attempt(self.mock_confluent_message))
+
+        self.consumer.process_data_ready(self.mock_confluent_message, self.good_message)
+
+        self.assertEqual(self.dead_letters.max_attempts, self.mocked_handler.data_ready.call_count)
+        self.assertEqual(self.dead_letters.max_attempts, self.mocked_logger.error.call_count)
+        self.assertEqual(
+            {
+                "original_topic": "data_ready",
+                "reason": f"Failed {self.dead_letters.max_attempts} times, last with RuntimeError: Reduction failed"
+            }, self.dead_letter_publisher.producer.produce.call_args[1]["headers"])
+
+        self.consumer.commit_completed(force=True)
+        self.mock_confluent_consumer.commit.assert_called_once_with(
+            offsets=[confluent_kafka.TopicPartition("data_ready", 0, 11)], asynchronous=True)
+
+    @mock.patch("autoreduce_qp.queue_processor.confluent_consumer.RETRY_DELAY", 0)
+    def test_process_data_ready_retries_transient_error(self):
+        """Test that a message whose handler raises once is handled again, and not quarantined"""
+        self.mocked_handler.data_ready.side_effect = [RuntimeError("Database unavailable"), None]
+        self.mock_confluent_message.topic.return_value = "data_ready"
+        self.mock_confluent_message.value.return_value = self.good_message.json()
+        self.consumer.offsets.track("data_ready", 0, 10)
+        self.assertTrue(self.consumer.start_attempt(self.mock_confluent_message))
+
+        self.consumer.process_data_ready(self.mock_confluent_message, self.good_message)
+
+        self.assertEqual(2, self.mocked_handler.data_ready.call_count)
+        self.dead_letter_publisher.producer.produce.assert_not_called()
+        self.assertTrue(self.deduplication.seen(self.mock_confluent_message))
+        self.assertIsNone(self.dead_letters.store.get(DeadLetterQueue.message_key(self.mock_confluent_message)))
+        self.consumer.commit_completed(force=True)
+        self.mock_confluent_consumer.commit.assert_called_once_with(
+            offsets=[confluent_kafka.TopicPartition("data_ready", 0, 11)], asynchronous=True)
+
+    def test_commit_completed_is_batched(self):
+        """Test that offsets are only committed once enough messages complete, unless forced"""
+        self.mock_confluent_message.topic.return_value = "fake_topic"
+        self.mock_confluent_message.value.return_value = self.good_message.json()
+        self.consumer.on_message(self.mock_confluent_message)
+
+        self.consumer.commit_completed()
+        self.mock_confluent_consumer.commit.assert_not_called()
+
+        with mock.patch("autoreduce_qp.queue_processor.base_consumer.COMMIT_BATCH_SIZE", 1):
+            self.consumer.commit_completed()
+        self.mock_confluent_consumer.commit.assert_called_once_with(
+            offsets=[confluent_kafka.TopicPartition("fake_topic", 0, 11)], asynchronous=True)
+
+        # Nothing new has completed, so there is nothing more to commit
+        self.consumer.commit_completed(force=True)
+        self.mock_confluent_consumer.commit.assert_called_once()
+
+    def test_message_quarantined_after_max_attempts(self):
+        """
+        Test that a message whose processing was started too many times, e.g.
+        because it crashed the queue processor, is quarantined instead of processed
+        """
+        self.mock_confluent_message.topic.return_value = "data_ready"
+        self.mock_confluent_message.value.return_value = self.good_message.json()
+        for _ in range(self.dead_letters.max_attempts):
+            self.dead_letters.start_attempt(self.mock_confluent_message)
+
+        self.consumer.on_message(self.mock_confluent_message)
+        self.assertTrue(self.consumer.pool.wait(timeout=5))
+
+        self.mocked_handler.data_ready.assert_not_called()
+        self.dead_letter_publisher.producer.produce.assert_called_once()
+        self.consumer.commit_completed(force=True)
+        self.mock_confluent_consumer.commit.assert_called_once_with(
+            offsets=[confluent_kafka.TopicPartition("data_ready", 0, 11)], asynchronous=True)
+
+    def test_quarantine_failure_not_completed(self):
+        """Test that a message that could not be published to the dead-letter topic is not committed"""
+        self.dead_letter_publisher.producer.flush.return_value = 1
+        self.mock_confluent_message.topic.return_value = "data_ready"
+        self.mock_confluent_message.value.return_value = self.bad_message
+
+        self.consumer.on_message(self.mock_confluent_message)
+        self.consumer.retry_quarantines(force=True)
+
+        self.assertEqual(2, self.dead_letter_publisher.producer.produce.call_count)
+        self.consumer.commit_completed(force=True)
+        self.mock_confluent_consumer.commit.assert_not_called()
+
+    def test_quarantine_failure_retried(self):
+        """
+        Test that publishing a message to the dead-letter topic is retried
+        after it failed, and its offset committed once it has been published
+        """
+        self.dead_letter_publisher.producer.flush.side_effect = [1, 0]
+        self.mock_confluent_message.topic.return_value = "data_ready"
+        self.mock_confluent_message.value.return_value = self.bad_message
+        self.consumer.on_message(self.mock_confluent_message)
+
+        # Not retried until the interval has passed
+        self.consumer.retry_quarantines()
+        self.dead_letter_publisher.producer.produce.assert_called_once()
+
+        self.consumer.retry_quarantines(force=True)
+
+        self.assertEqual(2, self.dead_letter_publisher.producer.produce.call_count)
+        self.consumer.commit_completed(force=True)
+        self.mock_confluent_consumer.commit.assert_called_once_with(
+            offsets=[confluent_kafka.TopicPartition("data_ready", 0, 11)], asynchronous=True)
+        # Nothing is left to retry
+        self.consumer.retry_quarantines(force=True)
+        self.assertEqual(2, self.dead_letter_publisher.producer.produce.call_count)
+
+    def test_revoke_forgets_unpublished_quarantines(self):
+        """Test that the messages of revoked partitions are not published to the dead-letter topic again"""
+        self.dead_letter_publisher.producer.flush.return_value = 1
+        self.mock_confluent_message.topic.return_value = "data_ready"
+        self.mock_confluent_message.value.return_value = self.bad_message
+        self.consumer.on_message(self.mock_confluent_message)
+
+        self.consumer.on_revoke(self.mock_confluent_consumer, [confluent_kafka.TopicPartition("data_ready", 0)])
+        self.consumer.retry_quarantines(force=True)
+
+        self.dead_letter_publisher.producer.produce.assert_called_once()
+
+    def test_is_processing_message_while_in_flight(self):
+        """Test that the consumer reports it is processing while a reduction is on the pool"""
+        release = threading.Event()
+        self.mocked_handler.data_ready.side_effect = lambda _: release.wait(5)
+        self.mock_confluent_message.topic.return_value = "data_ready"
+        self.mock_confluent_message.value.return_value = self.good_message.json()
+
+        self.assertFalse(self.consumer.is_processing_message())
+        self.consumer.on_message(self.mock_confluent_message)
+        self.assertTrue(self.consumer.is_processing_message())
+
+        release.set()
+        self.assertTrue(self.consumer.pool.wait(timeout=5))
+        self.assertFalse(self.consumer.is_processing_message())
+
+    def test_ordering_key(self):
+        """Test that runs are ordered by the Kafka key, or by instrument and RB number without one"""
+        message = Message(instrument="WISH", rb_number=1234567)
+        self.mock_confluent_message.key.return_value = "custom-key"
+        self.assertEqual("custom-key", Consumer.ordering_key(self.mock_confluent_message, message))
+
+        self.mock_confluent_message.key.return_value = None
+        self.assertEqual("WISH/1234567", Consumer.ordering_key(self.mock_confluent_message, message))
+
+    def test_on_revoke_drops_pending_and_completed_offsets(self):
+        """
+        Test that revoking a partition drops its reductions that have not
+        started and does not commit offsets for it afterwards
+        """
+        release = threading.Event()
+        self.mocked_handler.data_ready.side_effect = lambda _: release.wait(5)
+        self.mock_confluent_message.topic.return_value = "data_ready"
+        self.mock_confluent_message.partition.return_value = 0
+        self.mock_confluent_message.key.return_value = "same-key"
+        self.mock_confluent_message.value.return_value = self.good_message.json()
+
+        # The second message waits behind the first as they share a key
+        self.consumer.on_message(self.mock_confluent_message)
+        self.consumer.on_message(self.mock_confluent_message)
+        self.assertEqual(2, self.consumer.pool.in_flight())
+
+        self.consumer.on_revoke(self.mock_confluent_consumer, [confluent_kafka.TopicPartition("data_ready", 0)])
+        self.assertEqual(1, self.consumer.pool.in_flight())
+        # Only the attempt of the reduction that started is still counted
+        self.assertEqual("1", self.dead_letters.store.get(DeadLetterQueue.message_key(self.mock_confluent_message)))
+
+        release.set()
+        self.assertTrue(self.consumer.pool.wait(timeout=5))
+        self.mocked_handler.data_ready.assert_called_once()
+        self.consumer.commit_completed(force=True)
+        self.mock_confluent_consumer.commit.assert_not_called()
+
+        # Committing resumes once the partition is assigned again and messages arrive
+        self.consumer.on_assign(self.mock_confluent_consumer, [confluent_kafka.TopicPartition("data_ready", 0)])
+        self.consumer.on_message(self.mock_confluent_message)
+        self.assertTrue(self.consumer.pool.wait(timeout=5))
+        self.consumer.commit_completed(force=True)
+        self.mock_confluent_consumer.commit.assert_called_once_with(
+            offsets=[confluent_kafka.TopicPartition("data_ready", 0, 11)], asynchronous=True)
+
+    def test_backpressure_pauses_and_resumes(self):
+        """
+        Test that the assigned partitions are paused at the high-water mark and
+        only resumed once the reductions in flight drop to the low-water mark
+        """
+        assignment = [confluent_kafka.TopicPartition("data_ready", 0)]
+        self.mock_confluent_consumer.assignment.return_value = assignment
+        self.consumer.high_water_mark = 4
+        self.consumer.low_water_mark = 2
+
+        with mock.patch.object(self.consumer.pool, "in_flight") as in_flight:
+            for count in [3, 4, 3, 2]:
+                in_flight.return_value = count
+                self.consumer.apply_backpressure()
+                if count == 4:
+                    self.mock_confluent_consumer.pause.assert_called_once_with(assignment)
+                    self.assertEqual({"live": assignment}, self.consumer.paused_partitions)
+                if count == 3:
+                    self.mock_confluent_consumer.resume.assert_not_called()
+
+        self.mock_confluent_consumer.pause.assert_called_once()
+        self.mock_confluent_consumer.resume.assert_called_once_with(assignment)
+        self.assertEqual({}, self.consumer.paused_partitions)
+
+    def test_backpressure_is_per_lane(self):
+        """Test that only the lane with too many reductions in flight is paused"""
+        live = confluent_kafka.TopicPartition(LANE_TOPICS["live"], 0)
+        rerun = confluent_kafka.TopicPartition(LANE_TOPICS["rerun"], 0)
+        self.mock_confluent_consumer.assignment.return_value = [live, rerun]
+        self.consumer.high_water_mark = 2
+        self.consumer.low_water_mark = 1
+
+        with mock.patch.object(self.consumer.pool, "in_flight", side_effect=lambda lane: 5 if lane == "rerun" else 0):
+            self.consumer.apply_backpressure()
+
+        self.mock_confluent_consumer.pause.assert_called_once_with([rerun])
+        self.assertEqual({"rerun": [rerun]}, self.consumer.paused_partitions)
+
+    def test_backpressure_after_rebalance(self):
+        """Test that revoked partitions are not resumed, and a new assignment is paused again"""
+        first, second = confluent_kafka.TopicPartition("data_ready", 0), confluent_kafka.TopicPartition("data_ready", 1)
+        self.mock_confluent_consumer.assignment.return_value = [first, second]
+        self.consumer.high_water_mark = 1
+        self.consumer.low_water_mark = 0
+
+        with mock.patch.object(self.consumer.pool, "in_flight", return_value=1):
+            self.consumer.apply_backpressure()
+            self.consumer.on_revoke(self.mock_confluent_consumer, [first])
+            self.assertEqual({"live": [second]}, self.consumer.paused_partitions)
+
+            self.consumer.on_assign(self.mock_confluent_consumer, [second])
+            self.mock_confluent_consumer.assignment.return_value = [second]
+            self.consumer.apply_backpressure()
+            self.mock_confluent_consumer.pause.assert_called_with([second])
+
+    def test_on_message_lanes(self):
+        """Test that messages are submitted to the pool in the lane of the topic they came from"""
+        self.mock_confluent_message.value.return_value = self.good_message.json()
+        with mock.patch.object(self.consumer.pool, "submit") as submit:
+            for topic in LANE_TOPICS.values():
+                self.mock_confluent_message.topic.return_value = topic
+                self.consumer.on_message(self.mock_confluent_message)
+        self.assertEqual(list(LANE_TOPICS), [call[1]["lane"] for call in submit.call_args_list])
+
+    def test_refresh_lane_weights(self):
+        """Test that weights changed at runtime are passed on to the pool"""
+        self.lane_weights.set("rerun", 7)
+        self.consumer.refresh_lane_weights()
+        self.assertNotEqual(7, self.consumer.pool.lane_weights()["rerun"])
+
+        self.consumer.refresh_lane_weights(force=True)
+        self.assertEqual(7, self.consumer.pool.lane_weights()["rerun"])
+
+    def test_on_stats_records_consumer_lag(self):
+        """Test that the consumer lag of each assigned partition is taken from the statistics"""
+        stats = {
+            "topics": {
+                "data_ready": {
+                    "partitions": {
+                        "0": {
+                            "consumer_lag": 12
+                        },
+                        "1": {
+                            "consumer_lag": -1
+                        },
+                        "-1": {
+                            "consumer_lag": 5
+                        }
+                    }
+                }
+            }
+        }
+        self.consumer.on_stats(json.dumps(stats))
+        self.assertEqual(12, CONSUMER_LAG.get(topic="data_ready", partition="0"))
+        self.assertIsNone(CONSUMER_LAG.get(topic="data_ready", partition="1"))
+        self.assertIsNone(CONSUMER_LAG.get(topic="data_ready", partition="-1"))
+
+        self.consumer.on_revoke(self.mock_confluent_consumer, [confluent_kafka.TopicPartition("data_ready", 0)])
+        self.assertIsNone(CONSUMER_LAG.get(topic="data_ready", partition="0"))
+
+    def test_message_metrics(self):
+        """Test that received and completed messages are counted, and reductions in flight are reported"""
+        received = MESSAGES_RECEIVED.get(topic="data_ready")
+        completed = MESSAGES_COMPLETED.get(topic="data_ready")
+        release = threading.Event()
+        self.mocked_handler.data_ready.side_effect = lambda _: release.wait(5)
+        self.mock_confluent_message.topic.return_value = "data_ready"
+        self.mock_confluent_message.value.return_value = self.good_message.json()
+
+        self.consumer.on_message(self.mock_confluent_message)
+        self.assertEqual(received + 1, MESSAGES_RECEIVED.get(topic="data_ready"))
+        self.assertIn('autoreduce_qp_reductions_in_flight{lane="live"} 1.0', REDUCTIONS_IN_FLIGHT.render())
+
+        release.set()
+        self.assertTrue(self.consumer.pool.wait(timeout=5))
+        self.assertEqual(completed + 1, MESSAGES_COMPLETED.get(topic="data_ready"))
+
+    def test_invalid_water_marks(self):
+        """Test that the low-water mark must be below the high-water mark"""
+        self.assertRaises(ValueError,
+                          Consumer,
+                          consumer=mock.Mock(),
+                          dead_letters=self.dead_letters,
+                          high_water_mark=2,
+                          low_water_mark=2)
+
+    def _drain_in_thread(self, timeout):
+        """Run the consumer and drain it from another thread, returning the drain result"""
+        self.mock_confluent_consumer.poll.return_value = None
+        run = threading.Thread(target=self.consumer.run)
+        run.start()
+        drained = self.consumer.drain(timeout=timeout)
+        run.join(5)
+        return drained
+
+    def test_drain_waits_for_reductions(self):
+        """Test that draining waits for running reductions, drops pending ones and commits what finished"""
+        release = threading.Event()
+        self.mocked_handler.data_ready.side_effect = lambda _: release.wait(5)
+        # The second message waits behind the first as they share a key
+        self.consumer.on_message(self._make_batch_message("data_ready", self.good_message.json(), 10))
+        self.consumer.on_message(self._make_batch_message("data_ready", self.good_message.json(), 11))
+
+        threading.Timer(0.5, release.set).start()
+        self.assertTrue(self._drain_in_thread(timeout=5))
+
+        self.mocked_handler.data_ready.assert_called_once()
+        self.mocked_handler.requeue_active_runs.assert_not_called()
+        self.mock_confluent_consumer.commit.assert_called_once_with(
+            offsets=[confluent_kafka.TopicPartition("data_ready", 0, 11)], asynchronous=False)
+        self.mock_confluent_consumer.close.assert_called_once()
+
+    def test_drain_requeues_unfinished_reductions(self):
+        """Test that reductions still running at the deadline are requeued and their offsets not committed"""
+        release = threading.Event()
+        self.mocked_handler.data_ready.side_effect = lambda _: release.wait(5)
+        self.mocked_handler.requeue_active_runs.return_value = [mock.Mock()]
+        self.mock_confluent_message.topic.return_value = "data_ready"
+        self.mock_confluent_message.value.return_value = self.good_message.json()
+        self.consumer.on_message(self.mock_confluent_message)
+
+        self.assertFalse(self._drain_in_thread(timeout=0.1))
+        release.set()
+
+        self.mocked_handler.requeue_active_runs.assert_called_once()
+        self.mock_confluent_consumer.commit.assert_not_called()
+        self.mock_confluent_consumer.close.assert_called_once()
+
+    def test_drain_leaves_requeued_runs_unfinished(self):
+        """
+        Test that a reduction released by stopping its container at the drain
+        deadline leaves its message to be delivered again
+        """
+        release = threading.Event()
+
+        def reduce(_):
+            release.wait(5)
+            raise RunRequeued("Run 1234 was requeued while it was being reduced")
+
+        def requeue():
+            # Stopping the container is what ends the reduction
+            release.set()
+            return [mock.Mock()]
+
+        self.mocked_handler.data_ready.side_effect = reduce
+        self.mocked_handler.requeue_active_runs.side_effect = requeue
+        self.mock_confluent_message.topic.return_value = "data_ready"
+        self.mock_confluent_message.value.return_value = self.good_message.json()
+        self.consumer.on_message(self.mock_confluent_message)
+
+        self._drain_in_thread(timeout=0.1)
+        self.assertTrue(self.consumer.pool.wait(timeout=5))
+
+        self.mocked_handler.requeue_active_runs.assert_called_once()
+        self.assertEqual(self.consumer.offsets.committable(), [])
+        self.assertFalse(self.deduplication.seen(self.mock_confluent_message))
+        self.assertIsNone(self.dead_letters.store.get(DeadLetterQueue.message_key(self.mock_confluent_message)))
+        self.dead_letter_publisher.publish.assert_not_called()
+        self.mock_confluent_consumer.commit.assert_not_called()
+
+    def test_finish_run_requeued(self):
+        """Test that a pipeline run that was requeued doesn't complete its message"""
+        self.mock_confluent_message.topic.return_value = "data_ready"
+        self.mock_confluent_message.value.return_value = self.good_message.json()
+        self.consumer.track(self.mock_confluent_message)
+        self.assertTrue(self.consumer.start_attempt(self.mock_confluent_message))
+
+        self.consumer.finish_run(self.mock_confluent_message, RunRequeued("requeued"))
+
+        self.assertEqual(self.consumer.offsets.committable(), [])
+        self.assertFalse(self.deduplication.seen(self.mock_confluent_message))
+        self.dead_letter_publisher.publish.assert_not_called()
+
     def test_success_run(self):
         """ Test that the poll loop runs successfully """
         self.mock_confluent_message.error.return_value = None
@@ -102,6 +559,210 @@ class KafkaTestCase(TestCase):
         self.consumer.run()
         self.mocked_logger.info.assert_called_with("Stopping the consumer")
 
+    def _make_batch_message(self, topic, value, offset):
+        """Make a Kafka message as returned by consume(), with an undecoded value"""
+        incoming_message = mock.MagicMock(spec=confluent_kafka.Message)
+        incoming_message.error.return_value = None
+        incoming_message.topic.return_value = topic
+        incoming_message.partition.return_value = 0
+        incoming_message.offset.return_value = offset
+        incoming_message.key.return_value = None
+        incoming_message.value.return_value = value.encode("utf_8")
+        return incoming_message
+
+    def test_batch_mode_uses_plain_consumer(self):
+        """Test that batch mode fetches with consume() on a consumer without deserializers"""
+        with mock.patch("autoreduce_qp.queue_processor.confluent_consumer.KafkaConsumer") as kafka_consumer:
+            consumer = Consumer(batch_size=10,
+                                dead_letters=self.dead_letters,
+                                lane_weights=self.lane_weights,
+                                deduplication=self.deduplication)
+        self.assertEqual(kafka_consumer.return_value, consumer.consumer)
+        self.assertNotIn("value.deserializer", kafka_consumer.call_args[0][0])
+
+        kafka_consumer.return_value.consume.return_value = []
+        consumer.consume_batch()
+        kafka_consumer.return_value.consume.assert_called_once_with(num_messages=10, timeout=1.0)
+
+    def test_parse_messages(self):
+        """Test that a batch is split into parsed messages and rejected ones"""
+        good = self._make_batch_message("data_ready", self.good_message.json(), 0)
+        bad = self._make_batch_message("data_ready", self.bad_message, 1)
+        undecodable = self._make_batch_message("data_ready", "", 2)
+        undecodable.value.return_value = b"\xff"
+
+        parsed, rejected = Consumer.parse_messages([good, bad, undecodable])
+        self.assertEqual([(good, self.good_message)], parsed)
+        self.assertEqual([bad, undecodable], rejected)
+
+    def test_on_messages(self):
+        """
+        Test that a batch creates records for all data_ready messages at once,
+        reduces the ones that succeeded on the pool, and completes the rest
+        """
+        first = Message(instrument="WISH", rb_number=1234567, run_number=1)
+        second = Message(instrument="WISH", rb_number=1234567, run_number=2)
+        batch = [
+            self._make_batch_message("data_ready", first.json(), 0),
+            self._make_batch_message("data_ready", self.bad_message, 1),
+            self._make_batch_message("fake_topic", self.good_message.json(), 2),
+            self._make_batch_message("data_ready", second.json(), 3),
+        ]
+        run_records = (mock.Mock(), first, mock.Mock(), mock.Mock())
+        self.mocked_handler.data_ready_batch.return_value = [run_records, RuntimeError("Could not create records")]
+        self.mock_confluent_consumer.consume.return_value = batch
+        self.consumer.batch_size = 4
+
+        self.consumer.consume_batch()
+        self.assertTrue(self.consumer.pool.wait(timeout=5))
+
+        self.mocked_handler.data_ready_batch.assert_called_once_with([first, second])
+        self.mocked_handler.process_run_records.assert_called_once_with(*run_records)
+        # The message whose records couldn't be created is retried on its own
+        self.mocked_handler.data_ready.assert_called_once_with(second)
+        # The undecodable message is quarantined
+        quarantined = [call[0][1] for call in self.dead_letter_publisher.producer.produce.call_args_list]
+        self.assertEqual([self.bad_message.encode()], quarantined)
+        self.mocked_logger.error.assert_any_call("Could not decode %s messages: %s", 1, [self.bad_message.encode()])
+        self.mocked_logger.error.assert_any_call("Received a message on an unknown topic '%s'", "fake_topic")
+
+        self.consumer.commit_completed(force=True)
+        self.mock_confluent_consumer.commit.assert_called_once_with(offsets=[
+            confluent_kafka.TopicPartition("data_ready", 0, 4),
+            confluent_kafka.TopicPartition("fake_topic", 0, 3)
+        ],
+                                                                    asynchronous=True)
+
+    def test_on_revoke_requeues_batch_runs(self):
+        """
+        Test that revoking a partition requeues the runs of a batch whose
+        records were created but whose reductions had not started
+        """
+        release = threading.Event()
+        self.mocked_handler.process_run_records.side_effect = lambda *_: release.wait(5)
+        first = Message(instrument="WISH", rb_number=1234567, run_number=1)
+        second = Message(instrument="WISH", rb_number=1234567, run_number=2)
+        first_records = (mock.Mock(), first, mock.Mock(), mock.Mock())
+        second_records = (mock.Mock(), second, mock.Mock(), mock.Mock())
+        self.mocked_handler.data_ready_batch.return_value = [first_records, second_records]
+        self.mock_confluent_consumer.consume.return_value = [
+            self._make_batch_message("data_ready", first.json(), 0),
+            self._make_batch_message("data_ready", second.json(), 1),
+        ]
+        self.consumer.batch_size = 2
+
+        # The second run waits behind the first as they share an experiment
+        self.consumer.consume_batch()
+        for _ in range(50):
+            if self.mocked_handler.process_run_records.called:
+                break
+            time.sleep(0.1)
+        self.consumer.on_revoke(self.mock_confluent_consumer, [confluent_kafka.TopicPartition("data_ready", 0)])
+
+        self.mocked_handler.requeue_runs.assert_called_once_with([second_records[0]])
+        release.set()
+        self.assertTrue(self.consumer.pool.wait(timeout=5))
+        self.mocked_handler.process_run_records.assert_called_once_with(*first_records)
+
+    @mock.patch("autoreduce_qp.queue_processor.confluent_consumer.RETRY_DELAY", 0)
+    def test_pipeline_retries_failed_run(self):
+        """Test that a run that failed in the pipeline is handled again on the pool"""
+        consumer = self._make_pipeline_consumer()
+        self.mocked_handler.execute_run.side_effect = RuntimeError("Docker unavailable")
+        incoming_message = self._make_batch_message("data_ready", self.good_message.json(), 0)
+
+        consumer.on_message(incoming_message)
+        consumer.pipeline.close()
+        self.assertTrue(consumer.pool.wait(timeout=5))
+
+        self.mocked_handler.data_ready.assert_called_once_with(self.good_message)
+        self.dead_letter_publisher.producer.produce.assert_not_called()
+        self.assertTrue(self.deduplication.seen(incoming_message))
+
+    def _make_pipeline_consumer(self):
+        """Make a consumer that handles data_ready messages with the pipeline"""
+        with mock.patch("autoreduce_qp.queue_processor.confluent_consumer.HandleMessage",
+                        return_value=self.mocked_handler):
+            consumer = Consumer(consumer=self.mock_confluent_consumer,
+                                dead_letters=self.dead_letters,
+                                lane_weights=self.lane_weights,
+                                deduplication=self.deduplication,
+                                pipeline=True)
+        consumer.logger = self.mocked_logger
+        self.mocked_handler.data_ready_batch.side_effect = lambda messages: [
+            (mock.Mock(), message, mock.Mock(), mock.Mock()) for message in messages
+        ]
+        self.mocked_handler.schedule_run.return_value = True
+        return consumer
+
+    def test_pipeline_queues_runs_while_reductions_run(self):
+        """
+        Test that with the pipeline, the records of every message are created
+        while the pool is busy reducing, and offsets are committed once reduced
+        """
+        consumer = self._make_pipeline_consumer()
+        release = threading.Event()
+        self.mocked_handler.execute_run.side_effect = lambda *_: release.wait(5)
+        first = Message(instrument="WISH", rb_number=1234567, run_number=1)
+        second = Message(instrument="WISH", rb_number=1234567, run_number=2)
+
+        consumer.on_message(self._make_batch_message("data_ready", first.json(), 0))
+        consumer.on_message(self._make_batch_message("data_ready", second.json(), 1))
+
+        created = []
+        for _ in range(50):
+            created = [
+                message for call in self.mocked_handler.data_ready_batch.call_args_list for message in call[0][0]
+            ]
+            if len(created) == 2 and self.mocked_handler.execute_run.called:
+                break
+            time.sleep(0.1)
+        self.assertEqual([first, second], created)
+        self.assertEqual(1, self.mocked_handler.execute_run.call_count)
+        self.assertEqual(2, consumer.in_flight())
+        self.assertTrue(consumer.is_processing_message())
+
+        release.set()
+        consumer.pipeline.close()
+        self.assertTrue(consumer.pool.wait(timeout=5))
+        self.assertEqual(2, self.mocked_handler.execute_run.call_count)
+        self.assertEqual(0, consumer.in_flight())
+        consumer.commit_completed(force=True)
+        self.mock_confluent_consumer.commit.assert_called_once_with(
+            offsets=[confluent_kafka.TopicPartition("data_ready", 0, 2)], asynchronous=True)
+
+    def test_pipeline_drain_requeues_queued_runs(self):
+        """Test that draining the pipeline requeues runs whose records were created but weren't reduced"""
+        consumer = self._make_pipeline_consumer()
+        self.consumer = consumer
+        release = threading.Event()
+        self.mocked_handler.execute_run.side_effect = lambda *_: release.wait(5)
+        self.mocked_handler.requeue_active_runs.return_value = [mock.Mock()]
+        consumer.on_message(self._make_batch_message("data_ready", self.good_message.json(), 0))
+        consumer.on_message(self._make_batch_message("data_ready", self.good_message.json(), 1))
+        for _ in range(50):
+            if self.mocked_handler.schedule_run.call_count == 2:
+                break
+            time.sleep(0.1)
+
+        self.assertFalse(self._drain_in_thread(timeout=0.1))
+        release.set()
+
+        second_run = self.mocked_handler.schedule_run.call_args_list[1][0][0]
+        self.mocked_handler.requeue_runs.assert_called_once_with([second_run])
+        self.mocked_handler.requeue_active_runs.assert_called_once()
+        self.mock_confluent_consumer.commit.assert_not_called()
+
+    def test_consume_batch_error(self):
+        """Test that an error in a fetched batch stops the consumer"""
+        errored = self._make_batch_message("data_ready", self.good_message.json(), 0)
+        errored.error.return_value = confluent_kafka.KafkaError(confluent_kafka.KafkaError._ALL_BROKERS_DOWN)  # pylint:disable=protected-access
+        self.mock_confluent_consumer.consume.return_value = [errored]
+        self.consumer.batch_size = 4
+
+        self.assertRaises(confluent_kafka.KafkaException, self.consumer.consume_batch)
+        self.mocked_logger.error.assert_called_with("Undefined error in consumer loop")
+
     def test_setup_connection_exception(self):
         """ Test that the init of Consumer can handle not being able to connect to Kafka """
         with mock.patch("autoreduce_qp.queue_processor.confluent_consumer.DeserializingConsumer",
@@ -0,0 +1,150 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""Tests for the dead-letter queue and its replay tool."""
+from unittest import TestCase, main, mock
+
+import confluent_kafka
+
+from autoreduce_qp.queue_processor.dead_letter import DeadLetterQueue, DeadLetterReplay
+from autoreduce_qp.queue_processor.local_store import LocalStore
+
+
+def make_message(topic, value, offset=0, headers=None):
+    """Make a mock Kafka message."""
+    message = mock.MagicMock(spec=confluent_kafka.Message)
+    message.topic.return_value = topic
+    message.value.return_value = value
+    message.key.return_value = "key"
+    message.offset.return_value = offset
+    message.headers.return_value = headers
+    message.error.return_value = None
+    return message
+
+
+class TestDeadLetterQueue(TestCase):
+
+    def setUp(self):
+        self.publisher = mock.Mock()
+        self.publisher.producer.flush.return_value = 0
+        self.queue = DeadLetterQueue(publisher=self.publisher,
+                                     store=LocalStore("message_attempts", ":memory:"),
+                                     topic="dead_letter",
+                                     max_attempts=2)
+        self.message = make_message("data_ready", '{"run_number": 1}')
+
+    def test_start_attempt(self):
+        """Test that attempts are allowed up to the maximum and reset on success."""
+        self.assertTrue(self.queue.start_attempt(self.message))
+        self.assertTrue(self.queue.start_attempt(self.message))
+        self.assertFalse(self.queue.start_attempt(self.message))
+
+        self.queue.succeeded(self.message)
+        self.assertTrue(self.queue.start_attempt(self.message))
+
+    def test_cancel_attempt(self):
+        """Test that a cancelled attempt is not counted towards the maximum."""
+        self.assertTrue(self.queue.start_attempt(self.message))
+        self.assertTrue(self.queue.start_attempt(self.message))
+        self.queue.cancel_attempt(self.message)
+        self.assertTrue(self.queue.start_attempt(self.message))
+        self.assertFalse(self.queue.start_attempt(self.message))
+
+    def test_message_key(self):
+        """Test that messages are identified by their topic and contents."""
+        self.assertEqual(DeadLetterQueue.message_key(self.message),
+                         DeadLetterQueue.message_key(make_message("data_ready", b'{"run_number": 1}')))
+        self.assertNotEqual(DeadLetterQueue.message_key(self.message),
+                            DeadLetterQueue.message_key(make_message("other", '{"run_number": 1}')))
+
+    def test_quarantine(self):
+        """Test that a quarantined message is published with its origin and the reason."""
+        self.queue.start_attempt(self.message)
+        self.assertTrue(self.queue.quarantine(self.message, "Could not decode message"))
+
+        self.publisher.producer.produce.assert_called_once_with("dead_letter",
+                                                                '{"run_number": 1}',
+                                                                "key",
+                                                                headers={
+                                                                    "original_topic": "data_ready",
+                                                                    "reason": "Could not decode message"
+                                                                },
+                                                                callback=mock.ANY)
+        self.publisher.producer.flush.assert_called_once()
+        self.assertIsNone(self.queue.store.get(DeadLetterQueue.message_key(self.message)))
+
+    def test_quarantine_publish_failure(self):
+        """Test that failing to publish is logged, and the attempts are kept."""
+        self.publisher.producer.produce.side_effect = BufferError
+        self.queue.start_attempt(self.message)
+        with mock.patch("autoreduce_qp.queue_processor.dead_letter.logger") as logger:
+            self.assertFalse(self.queue.quarantine(self.message, "Could not decode message"))
+        logger.exception.assert_called_once()
+        self.assertEqual("1", self.queue.store.get(DeadLetterQueue.message_key(self.message)))
+
+    def test_quarantine_publish_timeout(self):
+        """Test that a message still waiting to be delivered after the flush is not quarantined."""
+        self.publisher.producer.flush.return_value = 1
+        self.queue.start_attempt(self.message)
+        with mock.patch("autoreduce_qp.queue_processor.dead_letter.logger") as logger:
+            self.assertFalse(self.queue.quarantine(self.message, "Could not decode message"))
+        logger.error.assert_called_once()
+        self.assertEqual("1", self.queue.store.get(DeadLetterQueue.message_key(self.message)))
+
+
+class TestDeadLetterReplay(TestCase):
+
+    def test_replay(self):
+        """Test that every message is published back to its original topic and committed."""
+        messages = [
+            make_message("dead_letter", "first", 0, [("original_topic", b"data_ready"), ("reason", b"bad")]),
+            make_message("dead_letter", "second", 1, [("original_topic", b"data_ready"), ("reason", b"bad")]),
+        ]
+        consumer = mock.Mock()
+        consumer.poll.side_effect = messages + [None]
+        publisher = mock.Mock()
+        publisher.producer.flush.return_value = 0
+
+        replayed = DeadLetterReplay(consumer=consumer, publisher=publisher).replay()
+
+        self.assertEqual(2, replayed)
+        self.assertEqual([
+            mock.call("data_ready", "first", "key", callback=mock.ANY),
+            mock.call("data_ready", "second", "key", callback=mock.ANY)
+        ], publisher.producer.produce.call_args_list)
+        consumer.commit.assert_has_calls(
+            [mock.call(message=messages[0], asynchronous=False),
+             mock.call(message=messages[1], asynchronous=False)])
+        consumer.close.assert_called_once()
+
+    def test_replay_timeout(self):
+        """Test that replaying stops at a message that could not be delivered, without committing it."""
+        consumer = mock.Mock()
+        consumer.poll.side_effect = [
+            make_message("dead_letter", "first", 0, [("original_topic", b"data_ready"), ("reason", b"bad")]), None
+        ]
+        publisher = mock.Mock()
+        publisher.producer.flush.return_value = 1
+
+        self.assertEqual(0, DeadLetterReplay(consumer=consumer, publisher=publisher).replay())
+        consumer.commit.assert_not_called()
+        consumer.close.assert_called_once()
+
+    def test_list(self):
+        """Test that listing prints the messages without committing them."""
+        consumer = mock.Mock()
+        consumer.poll.side_effect = [
+            make_message("dead_letter", "first", 0, [("original_topic", b"data_ready"), ("reason", b"bad")]), None
+        ]
+        with mock.patch("builtins.print") as patched_print:
+            DeadLetterReplay(consumer=consumer).list()
+        patched_print.assert_called_once_with("[0] from data_ready: bad\nfirst")
+        consumer.commit.assert_not_called()
+
+
+if __name__ == '__main__':
+    main()
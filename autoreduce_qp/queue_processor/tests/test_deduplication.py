@@ -0,0 +1,72 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""Tests for the deduplication of redelivered messages."""
+from unittest import TestCase, main, mock
+
+from autoreduce_utils.message.message import Message
+
+from autoreduce_qp.queue_processor.deduplication import DeduplicationStore
+from autoreduce_qp.queue_processor.local_store import LocalStore
+
+
+def make_message(value, offset=10):
+    """Make a Kafka message with the given value."""
+    incoming_message = mock.Mock()
+    incoming_message.topic.return_value = "data_ready"
+    incoming_message.partition.return_value = 0
+    incoming_message.offset.return_value = offset
+    incoming_message.value.return_value = value
+    return incoming_message
+
+
+class TestDeduplicationStore(TestCase):
+
+    def setUp(self):
+        self.store = LocalStore("processed_messages", ":memory:")
+        self.deduplication = DeduplicationStore(store=self.store, ttl=60)
+        self.value = Message(instrument="MARI", rb_number=1234567, run_number=123, data="/path/file.nxs").json()
+
+    def test_message_key(self):
+        """Test that the key identifies the run, the position in Kafka and the contents."""
+        key = DeduplicationStore.message_key(make_message(self.value))
+        self.assertTrue(key.startswith("MARI/1234567/123//path/file.nxs|data_ready:0:10|"))
+        # str and bytes values give the same key
+        self.assertEqual(key, DeduplicationStore.message_key(make_message(self.value.encode("utf_8"))))
+        self.assertNotEqual(key, DeduplicationStore.message_key(make_message(self.value, offset=11)))
+
+    def test_message_key_undecodable(self):
+        """Test that a message that isn't a JSON object still has a key."""
+        self.assertTrue(DeduplicationStore.message_key(make_message("bad_message")).startswith("///|data_ready:0:10|"))
+        self.assertTrue(DeduplicationStore.message_key(make_message(None)).startswith("///|"))
+
+    def test_seen_after_record(self):
+        """Test that a recorded message is seen, and a message published again at a new offset is not."""
+        self.assertFalse(self.deduplication.seen(make_message(self.value)))
+        self.deduplication.record(make_message(self.value))
+        self.assertTrue(self.deduplication.seen(make_message(self.value)))
+        self.assertFalse(self.deduplication.seen(make_message(self.value, offset=11)))
+
+    @mock.patch("autoreduce_qp.queue_processor.deduplication.time.time")
+    def test_expiry_and_purge(self, mocked_time):
+        """Test that messages are forgotten once their time to live has passed."""
+        mocked_time.return_value = 1000
+        self.deduplication.record(make_message(self.value))
+        mocked_time.return_value = 1061
+        self.assertFalse(self.deduplication.seen(make_message(self.value)))
+        self.deduplication.purge()
+        self.assertIsNone(self.store.get(DeduplicationStore.message_key(make_message(self.value))))
+
+    def test_disabled(self):
+        """Test that a time to live of 0 turns deduplication off."""
+        deduplication = DeduplicationStore(store=self.store, ttl=0)
+        deduplication.record(make_message(self.value))
+        self.assertFalse(deduplication.seen(make_message(self.value)))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,19 +7,27 @@
 # ############################################################################ #
 """Tests message handling for the queue processor."""
 # pylint:disable=no-member,unsupported-membership-test,line-too-long
+import json
 import random
+import tempfile
 from functools import partial
 from unittest import main, mock
 from unittest.mock import Mock, patch
 
+from django.db import transaction
 from django.db.utils import IntegrityError
 from django.test import TestCase
 from parameterized import parameterized
 
 from autoreduce_db.reduction_viewer.models import (Experiment, Instrument, Status, Software)
 from autoreduce_utils.message.message import Message
+from autoreduce_qp.model.database import access as db_access
+from autoreduce_qp.model.database import records
 from autoreduce_qp.model.database.records import create_reduction_run_record
-from autoreduce_qp.queue_processor.handle_message import HandleMessage
+from autoreduce_qp.queue_processor.handle_message import HandleMessage, RunRequeued
+from autoreduce_qp.queue_processor.log_storage import LogStore
+from autoreduce_qp.queue_processor import stage_timing
+from autoreduce_qp.queue_processor.metrics import HANDLER_STAGE_SECONDS
 from autoreduce_qp.queue_processor.confluent_consumer import Consumer
 from autoreduce_qp.systemtests.utils.data_archive import DefaultDataArchive
 
@@ -57,6 +65,8 @@ class TestHandleMessage(TestCase):
     fixtures = ["status_fixture"]
 
     def setUp(self):
+        db_access.REFERENCE_CACHE.invalidate()
+        records.invalidate_caches()
         self.mocked_client = mock.Mock(spec=Consumer)
         self.instrument_name = "ARMI"
         self.msg = make_test_message(self.instrument_name)
@@ -64,6 +74,8 @@ class TestHandleMessage(TestCase):
         with patch("logging.getLogger") as patched_logger:
             self.handler = HandleMessage()
             self.mocked_logger = patched_logger.return_value
+        # Write any status updates left waiting before the test's transaction is rolled back
+        self.addCleanup(self.handler.close)
 
         self.experiment, _ = Experiment.objects.get_or_create(reference_number=1231231)
         self.instrument, _ = Instrument.objects.get_or_create(name=self.instrument_name, is_active=True)
@@ -147,6 +159,22 @@ class TestHandleMessage(TestCase):
 
         assert self.reduction_run.reduction_location.first().file_path == "/path/1"
 
+    def test_reduction_error_stores_large_log(self):
+        """Test that a log too large for the run table is stored in a file, leaving an excerpt."""
+        log_dir = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.addCleanup(log_dir.cleanup)
+        self.handler.log_store = LogStore(directory=log_dir.name, inline_limit=100, excerpt_lines=2)
+        self.msg.reduction_log = "\n".join(f"line {i}" for i in range(100))
+        self.msg.admin_log = "short"
+
+        self.handler.reduction_error(self.reduction_run, self.msg)
+
+        self.reduction_run.refresh_from_db()
+        assert self.reduction_run.reduction_log.startswith("line 0\nline 1\n## Full log of 100 lines stored at ")
+        assert self.reduction_run.reduction_log.endswith("\nline 98\nline 99")
+        assert LogStore.load(self.reduction_run.reduction_log) == self.msg.reduction_log
+        assert self.reduction_run.admin_log == "short"
+
     @patch("autoreduce_qp.queue_processor.handle_message.ReductionProcessManager")
     def test_do_reduction_success(self, rpm):
         """Test the success path of do_reduction."""
@@ -158,6 +186,42 @@ class TestHandleMessage(TestCase):
         assert self.reduction_run.finished is not None
         assert self.reduction_run.reduction_location.first().file_path == "/path/1"
 
+    @patch("autoreduce_qp.queue_processor.handle_message.ReductionProcessManager")
+    def test_do_reduction_records_stage_timings(self, rpm):
+        """Test that the time taken by the reduction and recording its result is observed."""
+        rpm.return_value.run.return_value = self.msg
+        reduce_count = HANDLER_STAGE_SECONDS.get_count(stage="reduce", instrument="")
+        record_count = HANDLER_STAGE_SECONDS.get_count(stage="record_result", instrument="")
+
+        self.handler.do_reduction(self.reduction_run, self.msg, self.software)
+        assert HANDLER_STAGE_SECONDS.get_count(stage="reduce", instrument="") == reduce_count + 1
+        assert HANDLER_STAGE_SECONDS.get_count(stage="record_result", instrument="") == record_count + 1
+
+    @patch("autoreduce_qp.queue_processor.handle_message.ReductionProcessManager")
+    def test_data_ready_batch_logs_stage_timings(self, rpm):
+        """
+        Test that the stages of a run created in a batch are logged on one line
+        when it has been processed, and observed under its instrument.
+        """
+        rpm.return_value.run.return_value = self.msg
+        create_count = HANDLER_STAGE_SECONDS.get_count(stage="create_records", instrument=self.instrument_name)
+        message = make_test_message(self.instrument_name)
+
+        records_created = self.handler.data_ready_batch([message])[0]
+        with self.assertLogs(stage_timing.logger, "INFO") as logs:
+            self.handler.process_run_records(*records_created)
+
+        assert len(logs.records) == 1
+        logged = json.loads(logs.records[0].getMessage()[len("Run stage timings "):])
+        assert logged["instrument"] == self.instrument_name
+        assert logged["run_number"] == 7654321
+        assert logged["run_version"] == 0
+        assert {"create_records", "reduce", "record_result"} <= set(logged["stages"])
+        assert logged["elapsed_seconds"] >= logged["stages"]["reduce"]
+        assert HANDLER_STAGE_SECONDS.get_count(stage="create_records",
+                                               instrument=self.instrument_name) == create_count + 1
+        assert HANDLER_STAGE_SECONDS.get_count(stage="reduce", instrument=self.instrument_name) >= 1
+
     @patch("autoreduce_qp.queue_processor.handle_message.ReductionProcessManager")
     def test_do_reduction_success_batch_run(self, rpm: Mock):
         """Test the success path of do_reduction."""
@@ -221,6 +285,20 @@ class TestHandleMessage(TestCase):
         self.handler.activate_db_inst(self.instrument)
 
         assert self.instrument.is_active
+        self.instrument.refresh_from_db()
+        assert self.instrument.is_active
+
+    def test_activate_db_inst_keeps_other_changes(self):
+        """Test that activating the instrument doesn't revert changes made to it since it was looked up."""
+        self.instrument.is_active = False
+        self.instrument.save()
+        Instrument.objects.filter(pk=self.instrument.pk).update(is_paused=True)
+
+        self.handler.activate_db_inst(self.instrument)
+
+        self.instrument.refresh_from_db()
+        assert self.instrument.is_active
+        assert self.instrument.is_paused
 
     def test_find_reason_to_skip_run_empty_script(self):
         """
@@ -286,6 +364,37 @@ class TestHandleMessage(TestCase):
         assert "Validation error" in self.reduction_run.message
         assert "Validation error" in self.reduction_run.reduction_log
 
+    def test_schedule_run_skipped(self):
+        """Test that scheduling a run that fails validation skips it, so it isn't reduced."""
+        self.msg.rb_number = 123
+
+        with self.assertLogs(stage_timing.logger, "INFO"):
+            assert not self.handler.schedule_run(self.reduction_run, self.msg, self.instrument)
+
+        assert self.reduction_run.status == Status.get_skipped()
+
+    @patch("autoreduce_qp.queue_processor.handle_message.ReductionProcessManager")
+    def test_schedule_then_execute_run(self, rpm):
+        """Test that a scheduled run is left queued until it is executed, and its stages are logged once."""
+        rpm.return_value.run = self.do_post_started_assertions
+
+        with self.assertLogs(stage_timing.logger, "INFO") as logs:
+            assert self.handler.schedule_run(self.reduction_run, self.msg, self.instrument)
+            assert self.reduction_run.status == Status.get_queued()
+            self.handler.execute_run(self.reduction_run, self.msg, self.software)
+
+        assert self.reduction_run.status == Status.get_completed()
+        assert len(logs.records) == 1
+        assert {"schedule", "reduce", "record_result"} <= set(
+            json.loads(logs.records[0].getMessage()[len("Run stage timings "):])["stages"])
+
+    def test_execute_run_error_marks_reduction_error(self):
+        """Test that an error while executing a run marks it as errored and is raised."""
+        self.handler.do_reduction = Mock(side_effect=IntegrityError)
+        with self.assertRaises(IntegrityError):
+            self.handler.execute_run(self.reduction_run, self.msg, self.software)
+        assert self.reduction_run.status == Status.get_error()
+
     def test_create_run_records_multiple_versions(self):
         """Test creating multiple version of the same run."""
         self.instrument.is_active = False
@@ -310,6 +419,38 @@ class TestHandleMessage(TestCase):
             assert software.name == self.msg.software["name"]
             assert software.version == self.msg.software["version"]
 
+    def test_create_run_records_locks_experiment(self):
+        """
+        Test that the run version is allocated while holding a lock on the
+        experiment, and the script and arguments are found before taking it.
+        """
+        lock_experiment = db_access.lock_experiment
+        find_highest_run_version = db_access.find_highest_run_version
+        find_script_and_arguments = records.find_script_and_arguments
+        calls = []
+        # The test itself runs in a transaction, so count the savepoints nested inside it
+        depth = len(transaction.get_connection().savepoint_ids)
+
+        def record_lock(experiment):
+            calls.append(("lock", experiment.reference_number, len(transaction.get_connection().savepoint_ids)))
+            return lock_experiment(experiment)
+
+        def record_version(experiment, run_number):
+            calls.append(("version", experiment.reference_number, len(transaction.get_connection().savepoint_ids)))
+            return find_highest_run_version(experiment, run_number=run_number)
+
+        def record_script(experiment, instrument, message):
+            calls.append(("script", experiment.reference_number, len(transaction.get_connection().savepoint_ids)))
+            return find_script_and_arguments(experiment, instrument, message)
+
+        with patch.object(db_access, "lock_experiment", side_effect=record_lock), \
+                patch.object(db_access, "find_highest_run_version", side_effect=record_version), \
+                patch.object(records, "find_script_and_arguments", side_effect=record_script):
+            self.handler.create_run_records(self.msg)
+
+        self.assertEqual([("script", self.msg.rb_number, depth), ("lock", self.msg.rb_number, depth + 1),
+                          ("version", self.msg.rb_number, depth + 1)], calls)
+
     def test_data_ready_other_exception_raised_ends_processing(self):
         """Test an exception being raised inside data_ready handler."""
         self.handler.create_run_records = Mock(side_effect=RuntimeError)
@@ -333,6 +474,225 @@ class TestHandleMessage(TestCase):
         assert self.reduction_run.status == Status.get_error()
         assert "Encountered error when saving run variables" in self.reduction_run.message
 
+    def test_data_ready_batch(self):
+        """
+        Test that data_ready_batch creates the records for every message together,
+        giving the next versions of runs already in the database and the batch.
+        """
+        messages = [make_test_message(self.instrument_name) for _ in range(3)]
+        messages[0].rb_number = messages[1].rb_number = self.experiment.reference_number
+        messages[2].rb_number = 7777777
+        messages[2].run_number = [100, 101]
+        messages[2].data = ["/path/100", "/path/101"]
+
+        results = self.handler.data_ready_batch(messages)
+
+        assert [message.run_version for _, message, _, _ in results] == [1, 2, 0]
+        for reduction_run, message, instrument, software in results:
+            reduction_run.refresh_from_db()
+            assert reduction_run.status == Status.get_queued()
+            assert instrument == self.instrument
+            assert software == self.software
+            assert message.reduction_script == reduction_run.script.text
+        assert sorted(results[2][0].run_numbers.values_list("run_number", flat=True)) == [100, 101]
+        assert sorted(results[2][0].data_location.values_list("file_path", flat=True)) == ["/path/100", "/path/101"]
+        assert results[2][0].batch_run
+        assert self.mocked_logger.info.call_count == 3
+
+    def test_data_ready_batch_lookup_error(self):
+        """
+        Test that a message whose instrument can't be found gets the exception,
+        and the records of the rest of the batch are still created together.
+        """
+        bad_msg = make_test_message(self.instrument_name)
+        self.msg.rb_number = self.experiment.reference_number
+
+        with patch.object(db_access, "get_instrument", side_effect=[ValueError("No instrument"), self.instrument]):
+            results = self.handler.data_ready_batch([bad_msg, self.msg])
+
+        assert isinstance(results[0], ValueError)
+        assert results[1][1].run_version == 1
+        self.mocked_logger.error.assert_called_once()
+
+    def test_data_ready_batch_script_error(self):
+        """
+        Test that a message whose script can't be read, which happens before the
+        experiments are locked, gets the exception and the rest of the batch is
+        still created.
+        """
+        bad_msg = make_test_message(self.instrument_name)
+        self.msg.rb_number = self.experiment.reference_number
+        find_script_and_arguments = records.find_script_and_arguments
+
+        def find_script(experiment, instrument, message):
+            if message is bad_msg:
+                raise FileNotFoundError("No reduce.py")
+            return find_script_and_arguments(experiment, instrument, message)
+
+        with patch.object(records, "find_script_and_arguments", side_effect=find_script):
+            results = self.handler.data_ready_batch([bad_msg, self.msg])
+
+        assert isinstance(results[0], FileNotFoundError)
+        assert results[1][1].run_version == 1
+        self.mocked_logger.error.assert_called_once()
+
+    def test_data_ready_batch_resumes_requeued_run(self):
+        """Test that a requeued run in a batch is resumed instead of a new version being created."""
+        self.handler.requeue_runs([self.reduction_run])
+        self.msg.rb_number = self.experiment.reference_number
+
+        other_message = make_test_message(self.instrument_name)
+        other_message.rb_number = self.experiment.reference_number
+        other_message.reduction_arguments = {"standard_vars": {"variable": "other value"}}
+
+        results = self.handler.data_ready_batch([self.msg, other_message])
+
+        assert results[0][0] == self.reduction_run
+        assert results[0][1].run_version == self.reduction_run.run_version
+        # Another message for the same run, with different arguments, gets a new version
+        assert results[1][0] != self.reduction_run
+        assert results[1][1].run_version == 1
+
+    def test_data_ready_batch_requeued_batch_run_other_message(self):
+        """
+        Test that a batch run message with a different script to a requeued
+        batch run gets a new version in the batch, leaving the run requeued.
+        """
+        message = make_test_message(self.instrument_name)
+        message.rb_number = self.experiment.reference_number
+        message.run_number = [100, 101]
+        message.data = ["/path/100", "/path/101"]
+        requeued_run = self.handler.data_ready_batch([message])[0][0]
+        self.handler.requeue_runs([requeued_run])
+
+        other_message = make_test_message(self.instrument_name)
+        other_message.rb_number = self.experiment.reference_number
+        other_message.run_number = [101, 100]
+        other_message.data = ["/path/101", "/path/100"]
+        other_message.reduction_script = "different script"
+
+        with patch.object(self.handler, "create_run_records") as create_run_records:
+            results = self.handler.data_ready_batch([other_message])
+
+        create_run_records.assert_not_called()
+        assert results[0][0] != requeued_run
+        assert results[0][1].run_version == 1
+        requeued_run.refresh_from_db()
+        assert requeued_run.status == Status.get_queued()
+
+    def test_data_ready_batch_falls_back_to_one_at_a_time(self):
+        """
+        Test that data_ready_batch creates the records one message at a time if
+        they can't be created together, and returns the exception for a message
+        whose records could not be created.
+        """
+        self.handler.create_batch_run_records = Mock(side_effect=IntegrityError)
+        second_msg = make_test_message(self.instrument_name)
+        self.handler.create_run_records = Mock(side_effect=[(self.reduction_run, self.msg, self.instrument,
+                                                             self.software),
+                                                            RuntimeError("Could not create records")])
+        results = self.handler.data_ready_batch([self.msg, second_msg])
+
+        assert results[0] == (self.reduction_run, self.msg, self.instrument, self.software)
+        assert isinstance(results[1], RuntimeError)
+        assert self.mocked_logger.info.call_count == 2
+        self.mocked_logger.error.assert_called_once()
+
+    def test_process_run_records_error_marks_reduction_error(self):
+        """Test that an error while reducing already created records marks the run as errored."""
+        self.handler.send_message_onwards = Mock(side_effect=IntegrityError)
+        with self.assertRaises(IntegrityError):
+            self.handler.process_run_records(self.reduction_run, self.msg, self.instrument, self.software)
+        assert self.reduction_run.status == Status.get_error()
+
+    @patch("autoreduce_qp.queue_processor.handle_message.ReductionProcessManager")
+    def test_requeue_active_runs(self, rpm: Mock):
+        """
+        Test that a run being reduced when the queue processor is stopped is
+        requeued, and stays queued when its reduction returns afterwards.
+        """
+
+        def stop_during_reduction():
+            assert self.handler.requeue_active_runs() == [self.reduction_run]
+            return self.msg
+
+        rpm.return_value.run = stop_during_reduction
+        with self.assertRaises(RunRequeued):
+            self.handler.do_reduction(self.reduction_run, self.msg, self.software)
+
+        rpm.return_value.stop.assert_called_once()
+        self.reduction_run.refresh_from_db()
+        assert self.reduction_run.status == Status.get_queued()
+        assert self.reduction_run.started is not None
+        assert self.reduction_run.finished is None
+        self.assertFalse(self.handler.requeue_active_runs())
+
+    @patch("autoreduce_qp.queue_processor.handle_message.ReductionProcessManager")
+    def test_requeue_active_runs_stops_reduction(self, rpm: Mock):
+        """Test that a run whose reduction fails because it was stopped to be requeued stays queued."""
+
+        def stop_during_reduction():
+            self.handler.requeue_active_runs()
+            raise RuntimeError("Container stopped")
+
+        rpm.return_value.run = stop_during_reduction
+        with self.assertRaises(RunRequeued):
+            self.handler.do_reduction(self.reduction_run, self.msg, self.software)
+
+        self.reduction_run.refresh_from_db()
+        assert self.reduction_run.status == Status.get_queued()
+
+    @patch("autoreduce_qp.queue_processor.handle_message.ReductionProcessManager")
+    def test_requeue_active_runs_stop_fails(self, rpm: Mock):
+        """Test that a run whose reduction can't be stopped is not requeued, and its result is still recorded."""
+
+        def stop_during_reduction():
+            self.assertFalse(self.handler.requeue_active_runs())
+            return self.msg
+
+        rpm.return_value.run = stop_during_reduction
+        rpm.return_value.stop.side_effect = RuntimeError("Docker unavailable")
+        self.handler.do_reduction(self.reduction_run, self.msg, self.software)
+
+        self.reduction_run.refresh_from_db()
+        assert self.reduction_run.status == Status.get_completed()
+
+    def test_create_run_records_resumes_requeued_run(self):
+        """
+        Test that a requeued run is resumed when its message is delivered
+        again, instead of a new version being created.
+        """
+        self.handler.requeue_runs([self.reduction_run])
+        message = make_test_message(self.instrument_name)
+        message.rb_number = self.experiment.reference_number
+
+        reduction_run, message, instrument, software = self.handler.create_run_records(message)
+
+        assert reduction_run == self.reduction_run
+        assert message.run_version == self.reduction_run.run_version
+        assert message.reduction_script == self.reduction_run.script.text
+        assert instrument == self.instrument
+        assert software == self.software
+
+    def test_create_run_records_requeued_run_other_message(self):
+        """
+        Test that a new version is created for a message with a different
+        script to a requeued run of the same run number, leaving it requeued.
+        """
+        self.handler.requeue_runs([self.reduction_run])
+        message = make_test_message(self.instrument_name)
+        message.rb_number = self.experiment.reference_number
+        message.reduction_script = "different script"
+
+        reduction_run, message, _, _ = self.handler.create_run_records(message)
+
+        assert reduction_run != self.reduction_run
+        assert message.run_version == 1
+        assert message.reduction_script == "different script"
+        self.reduction_run.refresh_from_db()
+        assert self.reduction_run.status == Status.get_queued()
+        assert self.reduction_run.started is not None
+
     def test_create_run_records_invalid_rb_number(self):
         """Test creating a run record when the rb number is invalid."""
         with DefaultDataArchive(self.instrument_name):
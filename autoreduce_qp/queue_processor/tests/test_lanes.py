@@ -0,0 +1,68 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""Tests for the priority lanes and their weights."""
+from unittest import TestCase, main
+
+from autoreduce_qp.queue_processor.lanes import (LANE_TOPICS, FairQueue, LaneControl, LaneWeights, lane_for_topic,
+                                                 parse_weights)
+from autoreduce_qp.queue_processor.local_store import LocalStore
+
+
+class TestLanes(TestCase):
+
+    def setUp(self):
+        self.weights = LaneWeights(store=LocalStore("lane_weights", ":memory:"), defaults="live=10,rerun=2")
+
+    def test_parse_weights(self):
+        """Test that weights are parsed, and unknown lanes and non-positive weights are rejected."""
+        self.assertEqual({"live": 10.0, "batch": 0.5}, parse_weights("live=10, batch=0.5,"))
+        self.assertRaises(ValueError, parse_weights, "unknown=1")
+        self.assertRaises(ValueError, parse_weights, "live=0")
+        self.assertRaises(ValueError, parse_weights, "live=fast")
+
+    def test_lane_for_topic(self):
+        """Test that each lane's topic maps back to the lane."""
+        for lane, topic in LANE_TOPICS.items():
+            self.assertEqual(lane, lane_for_topic(topic))
+        self.assertIsNone(lane_for_topic("unknown_topic"))
+
+    def test_weights(self):
+        """Test that runtime weights override the defaults until they are reset."""
+        self.assertEqual({"live": 10.0, "rerun": 2.0, "batch": 1.0}, self.weights.get_all())
+
+        self.weights.set("rerun", 5)
+        self.assertEqual(5.0, self.weights.get_all()["rerun"])
+        self.assertRaises(ValueError, self.weights.set, "rerun", -1)
+
+        self.weights.reset("rerun")
+        self.assertEqual(2.0, self.weights.get_all()["rerun"])
+
+    def test_fair_queue(self):
+        """Test that tasks are tagged in proportion to their lane's weight, and an idle lane saves up no credit."""
+        fair_queue = FairQueue({"live": 2})
+        self.assertEqual([0.5, 1.0], [fair_queue.tag("live"), fair_queue.tag("live")])
+        self.assertEqual(1.0, fair_queue.tag("rerun"))
+
+        fair_queue.started(1.0)
+        self.assertEqual(2.0, fair_queue.tag("batch"))
+
+        self.assertFalse(fair_queue.set_weight("live", 2))
+        self.assertTrue(fair_queue.set_weight("live", 4))
+        self.assertEqual(1.25, fair_queue.tag("live"))
+        self.assertRaises(ValueError, fair_queue.set_weight, "live", 0)
+
+    def test_lane_control(self):
+        """Test the command line tool shows and changes the weights."""
+        control = LaneControl(self.weights)
+        self.assertEqual(3.0, control.set("batch", 3)["batch"])
+        self.assertEqual(3.0, control.show()["batch"])
+        self.assertEqual(1.0, control.reset("batch")["batch"])
+
+
+if __name__ == '__main__':
+    main()
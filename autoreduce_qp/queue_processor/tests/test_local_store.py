@@ -0,0 +1,77 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""Tests for the local key-value store."""
+import os
+import tempfile
+from unittest import TestCase, main
+
+from autoreduce_qp.queue_processor.local_store import LocalStore
+
+
+class TestLocalStore(TestCase):
+
+    def setUp(self):
+        self.store = LocalStore("test_table", ":memory:")
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_get_set_delete(self):
+        """Test that values can be stored, replaced and removed."""
+        self.assertIsNone(self.store.get("key"))
+        self.store.set("key", "value")
+        self.assertEqual("value", self.store.get("key"))
+        self.store.set("key", "other")
+        self.assertEqual("other", self.store.get("key"))
+        self.store.delete("key")
+        self.assertIsNone(self.store.get("key"))
+        # Deleting a missing key does nothing
+        self.store.delete("key")
+
+    def test_delete_below(self):
+        """Test that keys with numeric values below the given one are removed."""
+        self.store.set("old", "1.5")
+        self.store.set("new", "10")
+        self.assertEqual(1, self.store.delete_below(5))
+        self.assertIsNone(self.store.get("old"))
+        self.assertEqual("10", self.store.get("new"))
+
+    def test_increment(self):
+        """Test that increment counts up from 1."""
+        self.assertEqual(1, self.store.increment("key"))
+        self.assertEqual(2, self.store.increment("key"))
+        self.assertEqual(1, self.store.increment("other"))
+
+    def test_decrement(self):
+        """Test that decrement counts down, removing the key at 0."""
+        self.store.increment("key")
+        self.store.increment("key")
+        self.assertEqual(1, self.store.decrement("key"))
+        self.assertEqual(0, self.store.decrement("key"))
+        self.assertIsNone(self.store.get("key"))
+        self.assertEqual(0, self.store.decrement("missing"))
+
+    def test_values_persist_in_file(self):
+        """Test that values are still there when the file is opened again."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "store.sqlite3")
+            store = LocalStore("test_table", path)
+            store.increment("key")
+            store.close()
+
+            store = LocalStore("test_table", path)
+            self.assertEqual(2, store.increment("key"))
+            store.close()
+
+    def test_invalid_table_name(self):
+        """Test that table names that aren't identifiers are rejected."""
+        self.assertRaises(ValueError, LocalStore, "bad; DROP TABLE", ":memory:")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""Tests for storing the logs of runs."""
+import os
+import tempfile
+from unittest import TestCase, main, mock, skipIf
+
+from autoreduce_qp.queue_processor import log_storage
+from autoreduce_qp.queue_processor.log_storage import LogStore
+
+LOG = "\n".join(f"Running algorithm {i}" for i in range(1000))
+
+
+class TestLogStore(TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.addCleanup(self.log_dir.cleanup)
+        self.log_store = LogStore(directory=self.log_dir.name, inline_limit=1024, excerpt_lines=3)
+
+    def stored_files(self):
+        """Return the paths of the files in the store."""
+        return [os.path.join(root, name) for root, _, names in os.walk(self.log_dir.name) for name in names]
+
+    def test_store_small_log(self):
+        """Test that a log under the limit, or no log, is kept in the database."""
+        assert self.log_store.store("short log") == "short log"
+        assert self.log_store.store(None) is None
+        assert not self.stored_files()
+
+    def test_store_without_directory(self):
+        """Test that every log is kept in the database when there is no directory to store them in."""
+        assert LogStore(directory=None, inline_limit=1).store(LOG) == LOG
+
+    def test_store_large_log(self):
+        """Test that a large log is compressed into a file, leaving its first and last lines and the path."""
+        stored = self.log_store.store(LOG)
+
+        lines = stored.splitlines()
+        assert len(lines) == 7
+        assert lines[:3] == ["Running algorithm 0", "Running algorithm 1", "Running algorithm 2"]
+        assert lines[4:] == ["Running algorithm 997", "Running algorithm 998", "Running algorithm 999"]
+        assert self.stored_files() == [lines[3][len("## Full log of 1000 lines stored at "):-len(" ##")]]
+        assert self.stored_files()[0].endswith(".log.gz")
+        assert os.path.getsize(self.stored_files()[0]) < len(LOG)
+        assert LogStore.load(stored) == LOG
+
+    def test_store_long_lines(self):
+        """Test that the start and end of a log with a few long lines are kept."""
+        log = "a" * 2000 + "\n" + "b" * 2000
+        stored = self.log_store.store(log)
+
+        assert stored.startswith("a" * 512 + "\n## Full log of 2 lines stored at ")
+        assert stored.endswith("##\n" + "b" * 512)
+        assert LogStore.load(stored) == log
+
+    def test_store_excerpt_size(self):
+        """Test that the excerpt of a log with many long lines is kept within the limit."""
+        log = "\n".join(f"{i} " + "é" * 1000 for i in range(10))
+        stored = self.log_store.store(log)
+
+        head, pointer, tail = stored.split("\n")
+        assert head.startswith("0 éé")
+        assert tail.endswith("éé")
+        assert len(head.encode("utf_8")) <= 512
+        assert len(tail.encode("utf_8")) <= 512
+        assert pointer.startswith("## Full log of 10 lines stored at ")
+        assert LogStore.load(stored) == log
+
+    def test_stored_log_readable(self):
+        """Test that a stored log can be read by everyone, e.g. by the web app."""
+        self.log_store.store(LOG)
+        assert os.stat(self.stored_files()[0]).st_mode & 0o777 == 0o644
+
+    def test_store_same_log_once(self):
+        """Test that a log is stored once however many runs have it."""
+        assert self.log_store.store(LOG) == self.log_store.store(LOG)
+        assert len(self.stored_files()) == 1
+
+    def test_store_fails(self):
+        """Test that a log that can't be written to a file is kept in the database."""
+        with mock.patch("os.makedirs", side_effect=PermissionError("denied")):
+            assert self.log_store.store(LOG) == LOG
+
+    def test_load_not_stored(self):
+        """Test that a log kept in the database is loaded as it is."""
+        assert LogStore.load("short log") == "short log"
+        assert LogStore.load(None) is None
+
+    def test_invalid_compression(self):
+        """Test that an unknown compression is rejected."""
+        with self.assertRaises(ValueError):
+            LogStore(compression="lz4")
+
+    @skipIf(log_storage.zstandard is None, "zstandard is not installed")
+    def test_store_zstd(self):
+        """Test that a log is compressed with zstd."""
+        log_store = LogStore(directory=self.log_dir.name, inline_limit=1024, compression="zstd")
+        stored = log_store.store(LOG)
+
+        assert self.stored_files()[0].endswith(".log.zst")
+        assert LogStore.load(stored) == LOG
+
+    def test_zstd_not_installed(self):
+        """Test that logs are compressed with gzip if zstandard is not installed."""
+        with mock.patch.object(log_storage, "zstandard", None):
+            assert LogStore(compression="zstd").compression == "gzip"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""Tests for the queue processor metrics and the server that exposes them."""
+import urllib.error
+import urllib.request
+from unittest import TestCase, main
+
+from autoreduce_qp.queue_processor.metrics import (Counter, Gauge, Histogram, MetricsRegistry, start_metrics_server)
+
+
+class TestMetrics(TestCase):
+
+    def test_counter(self):
+        """Test that a counter adds up per label and renders in the text format."""
+        counter = Counter("messages_total", "Messages.", ["topic"])
+        counter.inc(topic="data_ready")
+        counter.inc(2, topic="data_ready")
+        counter.inc(topic="data_ready_rerun")
+
+        self.assertEqual(3, counter.get(topic="data_ready"))
+        self.assertRaises(ValueError, counter.inc, -1, topic="data_ready")
+        self.assertRaises(ValueError, counter.inc, other="label")
+        self.assertEqual(
+            "# HELP messages_total Messages.\n"
+            "# TYPE messages_total counter\n"
+            'messages_total{topic="data_ready"} 3.0\n'
+            'messages_total{topic="data_ready_rerun"} 1.0\n', counter.render())
+
+    def test_gauge(self):
+        """Test that a gauge can be set, removed and read from a function."""
+        gauge = Gauge("lag", "Lag.", ["topic", "partition"])
+        gauge.set(5, topic="data_ready", partition=0)
+        gauge.set(3, topic="data_ready", partition=0)
+        self.assertEqual(3, gauge.get(topic="data_ready", partition=0))
+        gauge.remove(topic="data_ready", partition=0)
+        self.assertIsNone(gauge.get(topic="data_ready", partition=0))
+
+        gauge.set_function(lambda: {("data_ready", "1"): 7})
+        self.assertIn('lag{topic="data_ready",partition="1"} 7.0', gauge.render())
+
+    def test_label_values_are_escaped(self):
+        """Test that quotes, backslashes and newlines in label values are escaped."""
+        gauge = Gauge("value", "Value.", ["name"])
+        gauge.set(1, name='a"b\\c\nd')
+        self.assertIn('value{name="a\\"b\\\\c\\nd"} 1.0', gauge.render())
+
+    def test_histogram(self):
+        """Test that a histogram counts observations in cumulative buckets."""
+        histogram = Histogram("duration_seconds", "Duration.", ["stage"], buckets=[1, 5])
+        histogram.observe(0.5, stage="reduce")
+        histogram.observe(3, stage="reduce")
+        histogram.observe(10, stage="reduce")
+        with histogram.time(stage="create_records"):
+            pass
+
+        self.assertEqual(3, histogram.get_count(stage="reduce"))
+        self.assertEqual(1, histogram.get_count(stage="create_records"))
+        rendered = histogram.render()
+        self.assertIn('duration_seconds_bucket{stage="reduce",le="1.0"} 1.0', rendered)
+        self.assertIn('duration_seconds_bucket{stage="reduce",le="5.0"} 2.0', rendered)
+        self.assertIn('duration_seconds_bucket{stage="reduce",le="+Inf"} 3.0', rendered)
+        self.assertIn('duration_seconds_count{stage="reduce"} 3.0', rendered)
+        self.assertIn('duration_seconds_sum{stage="reduce"} 13.5', rendered)
+
+    def test_registry(self):
+        """Test that a registry renders all its metrics and rejects duplicate names."""
+        registry = MetricsRegistry()
+        registry.register(Counter("first_total", "First."))
+        registry.register(Gauge("second", "Second."))
+        self.assertRaises(ValueError, registry.register, Counter("first_total", "Duplicate."))
+
+        rendered = registry.render()
+        self.assertIn("# TYPE first_total counter", rendered)
+        self.assertIn("# TYPE second gauge", rendered)
+
+    def test_server(self):
+        """Test that the metrics are served over HTTP."""
+        registry = MetricsRegistry()
+        registry.register(Counter("served_total", "Served.")).inc()
+        server = start_metrics_server(port=0, registry=registry, host="127.0.0.1")
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            with urllib.request.urlopen(f"{url}/metrics", timeout=5) as response:
+                self.assertEqual(200, response.status)
+                self.assertIn("served_total 1.0", response.read().decode("utf_8"))
+
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen(f"{url}/other", timeout=5)  # pylint:disable=consider-using-with
+            self.assertEqual(404, context.exception.code)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    main()
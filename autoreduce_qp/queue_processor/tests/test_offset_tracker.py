@@ -0,0 +1,67 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""Tests for the Kafka offset tracker."""
+from unittest import TestCase, main
+
+from confluent_kafka import TopicPartition
+
+from autoreduce_qp.queue_processor.offset_tracker import OffsetTracker
+
+
+class TestOffsetTracker(TestCase):
+
+    def setUp(self):
+        self.tracker = OffsetTracker()
+        for offset in range(5):
+            self.tracker.track("data_ready", 0, offset)
+
+    def test_nothing_committable_until_first_offset_completes(self):
+        """Test that completing later offsets does not move the watermark past an unfinished one."""
+        self.tracker.complete("data_ready", 0, 1)
+        self.tracker.complete("data_ready", 0, 2)
+        self.assertEqual([], self.tracker.committable())
+        self.assertEqual(3, self.tracker.outstanding())
+
+    def test_out_of_order_completion(self):
+        """Test that the watermark moves to the lowest unfinished offset once the gap closes."""
+        self.tracker.complete("data_ready", 0, 2)
+        self.tracker.complete("data_ready", 0, 0)
+        self.assertEqual([TopicPartition("data_ready", 0, 1)], self.tracker.committable())
+
+        self.tracker.complete("data_ready", 0, 1)
+        self.assertEqual([TopicPartition("data_ready", 0, 3)], self.tracker.committable())
+
+        self.tracker.complete("data_ready", 0, 3)
+        self.tracker.complete("data_ready", 0, 4)
+        self.assertEqual([TopicPartition("data_ready", 0, 5)], self.tracker.committable())
+        self.assertEqual(0, self.tracker.outstanding())
+
+    def test_committable_only_returns_progress(self):
+        """Test that a partition is only returned again once its watermark has moved."""
+        self.tracker.complete("data_ready", 0, 0)
+        self.assertEqual(1, self.tracker.completed_since_commit())
+        self.assertEqual([TopicPartition("data_ready", 0, 1)], self.tracker.committable())
+        self.assertEqual(0, self.tracker.completed_since_commit())
+        self.assertEqual([], self.tracker.committable())
+
+    def test_partitions_are_independent(self):
+        """Test that each partition has its own watermark."""
+        self.tracker.track("data_ready", 1, 100)
+        self.tracker.complete("data_ready", 1, 100)
+        self.assertEqual([TopicPartition("data_ready", 1, 101)], self.tracker.committable())
+
+    def test_forget(self):
+        """Test that forgotten partitions are not committed and late completions are ignored."""
+        self.tracker.forget([("data_ready", 0)])
+        self.tracker.complete("data_ready", 0, 0)
+        self.assertEqual([], self.tracker.committable())
+        self.assertEqual(0, self.tracker.outstanding())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""Tests for handling messages in the intake, scheduling and execution stages."""
+import threading
+import time
+from unittest import TestCase, main, mock
+
+from autoreduce_utils.message.message import Message
+
+from autoreduce_qp.queue_processor.handle_message import HandleMessage
+from autoreduce_qp.queue_processor.pipeline import ReductionPipeline
+from autoreduce_qp.queue_processor.worker_pool import ReductionWorkerPool
+
+
+def wait_until(condition, timeout=5):
+    """Wait for a condition to become true, returning whether it did."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestReductionPipeline(TestCase):
+
+    def setUp(self):
+        self.handler = mock.MagicMock(spec=HandleMessage)
+        self.handler.data_ready_batch.side_effect = lambda messages: [
+            (mock.Mock(name=f"run {message.run_number}"), message, mock.Mock(), mock.Mock()) for message in messages
+        ]
+        self.handler.schedule_run.return_value = True
+        self.pool = ReductionWorkerPool(max_workers=1)
+        self.finished = []
+        self.released = []
+        self.pipeline = ReductionPipeline(self.handler,
+                                          self.pool,
+                                          lambda incoming, err: self.finished.append((incoming, err)),
+                                          release=self.released.extend,
+                                          intake_queue_size=10,
+                                          schedule_queue_size=10,
+                                          batch_size=10)
+        self.addCleanup(self.pool.shutdown, wait=False)
+        self.addCleanup(self.pipeline.close)
+
+    def put(self, run_number, partition=0, lane="live"):
+        """Queue a message for intake, with its run number as the Kafka message."""
+        message = Message(instrument="WISH", rb_number=1234567, run_number=run_number)
+        self.pipeline.put(run_number, message, key=f"key-{run_number}", partition=partition, lane=lane)
+        return message
+
+    def created(self):
+        """Return the run numbers whose records have been created."""
+        return [message.run_number for call in self.handler.data_ready_batch.call_args_list for message in call[0][0]]
+
+    def test_runs_queued_while_execution_busy(self):
+        """Test that the records of every run are created while the only worker is busy reducing."""
+        release = threading.Event()
+        self.handler.execute_run.side_effect = lambda *_: release.wait(5)
+
+        for run_number in range(1, 6):
+            self.put(run_number)
+
+        assert wait_until(lambda: len(self.created()) == 5 and self.handler.schedule_run.call_count == 5)
+        assert self.handler.execute_run.call_count == 1
+        assert self.pipeline.in_flight() == 5
+        assert self.pipeline.in_flight("live") == 5
+        assert self.pipeline.in_flight("rerun") == 0
+
+        release.set()
+        assert wait_until(lambda: len(self.finished) == 5)
+        assert sorted(incoming for incoming, _ in self.finished) == [1, 2, 3, 4, 5]
+        assert all(err is None for _, err in self.finished)
+        assert self.pipeline.in_flight() == 0
+
+    def test_run_not_reduced_finished_when_scheduled(self):
+        """Test that a run that is skipped or has errored is finished without a worker."""
+        self.handler.schedule_run.return_value = False
+        self.put(1)
+
+        assert wait_until(lambda: self.finished == [(1, None)])
+        self.handler.execute_run.assert_not_called()
+        assert self.pipeline.in_flight() == 0
+
+    def test_errors_finish_runs(self):
+        """Test that a run that fails in any stage is finished with its error."""
+        intake_error, schedule_error, execute_error = (RuntimeError("intake"), RuntimeError("schedule"),
+                                                       RuntimeError("execute"))
+        self.handler.data_ready_batch.side_effect = lambda messages: [
+            intake_error if message.run_number == 1 else (mock.Mock(), message, mock.Mock(), mock.Mock())
+            for message in messages
+        ]
+
+        def schedule_run(_, message, __):
+            if message.run_number == 2:
+                raise schedule_error
+            return True
+
+        self.handler.schedule_run.side_effect = schedule_run
+        self.handler.execute_run.side_effect = execute_error
+
+        for run_number in (1, 2, 3):
+            self.put(run_number)
+
+        assert wait_until(lambda: len(self.finished) == 3)
+        assert sorted(self.finished, key=lambda finished: finished[0]) == [(1, intake_error), (2, schedule_error),
+                                                                           (3, execute_error)]
+        assert self.pipeline.in_flight() == 0
+
+    def test_discard(self):
+        """Test that runs waiting in the pipeline can be dropped by partition, with any records created."""
+        release = threading.Event()
+        self.handler.execute_run.side_effect = lambda *_: release.wait(5)
+        # The first run takes the only worker, the second waits in the pool
+        # and the third is held up by the scheduling stage
+        schedule_third = threading.Event()
+        self.handler.schedule_run.side_effect = lambda _, message, __: message.run_number != 3 or schedule_third.wait(5)
+        self.put(1)
+        self.put(2)
+        self.put(3, partition=1)
+        assert wait_until(lambda: self.handler.schedule_run.call_count == 3)
+        # Held up behind the third run
+        fourth = self.put(4, partition=1)
+        assert wait_until(lambda: len(self.created()) == 4)
+
+        discarded = []
+        assert wait_until(lambda: discarded.extend(self.pipeline.discard([1])) or discarded)
+
+        assert len(discarded) == 1
+        assert discarded[0][0] == 4
+        assert discarded[0][1][1] is fourth
+        assert self.pipeline.in_flight() == 3
+        schedule_third.set()
+        # The third run was being scheduled, and is dropped instead of being handed to the pool
+        assert wait_until(lambda: len(self.released) == 1)
+        assert self.released[0][0] == 3
+        release.set()
+        assert wait_until(lambda: len(self.finished) == 2)
+        assert sorted(incoming for incoming, _ in self.finished) == [1, 2]
+        assert self.handler.execute_run.call_count == 2
+        assert wait_until(lambda: self.pipeline.in_flight() == 0)
+
+    def test_discard_during_intake(self):
+        """
+        Test that a run whose records are being created when its partition is
+        revoked is dropped with its records, before it is scheduled
+        """
+        creating, release = threading.Event(), threading.Event()
+        create_records = self.handler.data_ready_batch.side_effect
+
+        def data_ready_batch(messages):
+            creating.set()
+            release.wait(5)
+            return create_records(messages)
+
+        self.handler.data_ready_batch.side_effect = data_ready_batch
+        message = self.put(1)
+        assert creating.wait(5)
+
+        assert not self.pipeline.discard([0])
+        release.set()
+
+        assert wait_until(lambda: len(self.released) == 1)
+        assert self.released[0][0] == 1
+        assert self.released[0][1][1] is message
+        self.handler.schedule_run.assert_not_called()
+        assert not self.finished
+        assert self.pipeline.in_flight() == 0
+
+    def test_partition_assigned_again_after_discard(self):
+        """Test that runs put after their partition was revoked and assigned again are handled"""
+        self.pipeline.discard([0])
+        self.put(1)
+
+        assert wait_until(lambda: self.finished == [(1, None)])
+        assert not self.released
+
+    def test_close_handles_waiting_runs(self):
+        """Test that closing the pipeline handles the runs left in it before stopping."""
+        for run_number in range(1, 4):
+            self.put(run_number)
+
+        self.pipeline.close()
+
+        assert self.handler.schedule_run.call_count == 3
+        assert self.pool.wait(timeout=5)
+        assert len(self.finished) == 3
+
+
+if __name__ == '__main__':
+    main()
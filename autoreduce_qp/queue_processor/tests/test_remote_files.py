@@ -0,0 +1,118 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""Tests for fetching remote files, against a local HTTP server."""
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase, main
+
+from requests.exceptions import ConnectionError, Timeout  # pylint:disable=redefined-builtin
+
+from autoreduce_qp.queue_processor.remote_files import RemoteFileFetcher
+
+FILES = {"/mask.msk": ("mask contents", '"mask-v1"'), "/map.map": ("map contents", '"map-v1"')}
+
+
+class _RemoteFileHandler(BaseHTTPRequestHandler):
+    """Serves FILES with ETags, and delays the response by ?delay=<seconds>."""
+    requests = []
+
+    def do_GET(self):  # pylint:disable=invalid-name
+        """Serve a file, or 304 if the client's ETag matches."""
+        path, _, query = self.path.partition("?")
+        self.requests.append((path, self.headers.get("If-None-Match")))
+        if query.startswith("delay="):
+            time.sleep(float(query[len("delay="):]))
+
+        if path not in FILES:
+            self.send_error(404)
+            return
+        text, etag = FILES[path]
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        body = text.encode("utf_8")
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint:disable=redefined-builtin
+        pass
+
+
+class TestRemoteFileFetcher(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), _RemoteFileHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        _RemoteFileHandler.requests = []
+        self.cache_dir = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.fetcher = RemoteFileFetcher(cache_dir=self.cache_dir.name, timeout=2)
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_fetch(self):
+        """Test that a file is fetched, and a missing file gives its status code."""
+        remote_file = self.fetcher.fetch(f"{self.base_url}/mask.msk")
+        self.assertEqual((200, "mask contents"), remote_file)
+        self.assertEqual((404, None), self.fetcher.fetch(f"{self.base_url}/missing.msk"))
+
+    def test_fetch_revalidates_cached_copy(self):
+        """Test that a cached file is revalidated with its ETag instead of being downloaded again."""
+        self.fetcher.fetch(f"{self.base_url}/mask.msk")
+        # A new fetcher only shares the cache on disk
+        remote_file = RemoteFileFetcher(cache_dir=self.cache_dir.name).fetch(f"{self.base_url}/mask.msk")
+
+        self.assertEqual((200, "mask contents"), remote_file)
+        self.assertEqual([("/mask.msk", None), ("/mask.msk", '"mask-v1"')], _RemoteFileHandler.requests)
+
+    def test_fetch_without_cache(self):
+        """Test that nothing is revalidated when there is no cache."""
+        fetcher = RemoteFileFetcher(cache_dir=None)
+        fetcher.fetch(f"{self.base_url}/mask.msk")
+        fetcher.fetch(f"{self.base_url}/mask.msk")
+        self.assertEqual([("/mask.msk", None), ("/mask.msk", None)], _RemoteFileHandler.requests)
+
+    def test_fetch_all_concurrently(self):
+        """Test that several files are fetched at the same time, and errors are returned for their URLs."""
+        urls = [f"{self.base_url}/mask.msk?delay=0.5", f"{self.base_url}/map.map?delay=0.5", "http://127.0.0.1:1/x"]
+        start = time.monotonic()
+        fetched = self.fetcher.fetch_all(urls)
+
+        self.assertLess(time.monotonic() - start, 0.9)
+        self.assertEqual((200, "mask contents"), fetched[urls[0]])
+        self.assertEqual((200, "map contents"), fetched[urls[1]])
+        self.assertIsInstance(fetched[urls[2]], ConnectionError)
+
+    def test_fetch_timeout(self):
+        """Test that a slow remote source times out."""
+        fetcher = RemoteFileFetcher(cache_dir=None, timeout=0.2)
+        with self.assertRaises(Timeout):
+            fetcher.fetch(f"{self.base_url}/mask.msk?delay=1")
+
+
+if __name__ == '__main__':
+    main()
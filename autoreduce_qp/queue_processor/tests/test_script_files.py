@@ -0,0 +1,90 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""Tests for caching the text of reduction scripts."""
+import os
+import tempfile
+import time
+from pathlib import Path
+from unittest import TestCase, main, mock, skipIf
+
+from autoreduce_qp.queue_processor import script_files
+from autoreduce_qp.queue_processor.reduction.service import ReductionScript
+from autoreduce_qp.queue_processor.script_files import ScriptFileCache, ScriptText, text_digest
+
+
+class TestScriptFileCache(TestCase):
+
+    def setUp(self):
+        self.scripts_dir = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.path = Path(self.scripts_dir.name, "reduce.py")
+        self.path.write_text("print('v1')", encoding="utf_8")
+        self.script = ReductionScript("TESTINSTRUMENT", script_path=self.path)
+
+    def tearDown(self):
+        self.scripts_dir.cleanup()
+
+    def _modify(self, text):
+        """Change the script, making sure its modification time changes too."""
+        stat = self.path.stat()
+        self.path.write_text(text, encoding="utf_8")
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    def test_read_cached_until_modified(self):
+        """Test that a script is read once while it is unchanged, and again once it changes."""
+        cache = ScriptFileCache(watch=False)
+        with mock.patch.object(ReductionScript, "text", autospec=True, side_effect=ReductionScript.text) as text:
+            self.assertEqual(ScriptText("print('v1')", text_digest("print('v1')")), cache.read(self.script))
+            self.assertEqual("print('v1')", cache.read(self.script).text)
+            self.assertEqual(1, text.call_count)
+
+            self._modify("print('v2')")
+            self.assertEqual(ScriptText("print('v2')", text_digest("print('v2')")), cache.read(self.script))
+            self.assertEqual(2, text.call_count)
+
+    def test_read_missing_script(self):
+        """Test that a missing script has empty text and is not cached."""
+        cache = ScriptFileCache(watch=False)
+        self.path.unlink()
+        self.assertEqual("", cache.read(self.script).text)
+        self.path.write_text("print('v1')", encoding="utf_8")
+        self.assertEqual("print('v1')", cache.read(self.script).text)
+
+    @mock.patch.object(script_files, "inotify_simple", None)
+    def test_watch_without_inotify(self):
+        """Test that the scripts are stat'ed when inotify_simple isn't installed."""
+        cache = ScriptFileCache(watch=True)
+        self.assertEqual("print('v1')", cache.read(self.script).text)
+        self._modify("print('v2')")
+        self.assertEqual("print('v2')", cache.read(self.script).text)
+
+    @skipIf(script_files.inotify_simple is None, "inotify_simple is not installed")
+    def test_watch(self):
+        """Test that a watched script is not stat'ed until it changes."""
+        cache = ScriptFileCache(watch=True)
+        self.addCleanup(cache.close)
+        cache.read(self.script)
+
+        # Other threads may stat files too, so only the script's own stats are counted
+        with mock.patch("autoreduce_qp.queue_processor.script_files.os.stat", side_effect=os.stat) as stat:
+
+            def script_stats():
+                return [call for call in stat.call_args_list if call.args[0] == str(self.path)]
+
+            self.assertEqual("print('v1')", cache.read(self.script).text)
+            self.assertEqual([], script_stats())
+
+            self._modify("print('v2')")
+            deadline = time.monotonic() + 5
+            while cache.read(self.script).text != "print('v2')" and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual("print('v2')", cache.read(self.script).text)
+            self.assertNotEqual([], script_stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""Tests for timing the stages of handling a run."""
+import json
+import threading
+from unittest import TestCase, main
+
+from autoreduce_qp.queue_processor import stage_timing
+from autoreduce_qp.queue_processor.metrics import HANDLER_STAGE_SECONDS
+from autoreduce_qp.queue_processor.stage_timing import StageTimings, current_timings, stage
+
+
+class TestStageTimings(TestCase):
+
+    def test_stage_recorded_in_active_timings(self):
+        """Test that stages, nested or repeated, are added to the active timings and observed by instrument."""
+        timings = StageTimings("TESTINST", run_number=123)
+        count = HANDLER_STAGE_SECONDS.get_count(stage="pull_image", instrument="TESTINST")
+
+        with timings.activate():
+            assert current_timings() is timings
+            with stage("reduce"):
+                with stage("pull_image"):
+                    pass
+            with stage("pull_image"):
+                pass
+
+        assert current_timings() is None
+        assert list(timings.stages) == ["pull_image", "reduce"]
+        assert HANDLER_STAGE_SECONDS.get_count(stage="pull_image", instrument="TESTINST") == count + 2
+
+    def test_stage_without_timings(self):
+        """Test that a stage outside of a run is only observed, without an instrument."""
+        count = HANDLER_STAGE_SECONDS.get_count(stage="read_result", instrument="")
+        with stage("read_result"):
+            pass
+        assert HANDLER_STAGE_SECONDS.get_count(stage="read_result", instrument="") == count + 1
+
+    def test_stage_timed_on_error(self):
+        """Test that a stage that raises is still timed."""
+        timings = StageTimings("TESTINST")
+        with self.assertRaises(ValueError), timings.activate(), stage("run_container"):
+            raise ValueError("container failed")
+        assert "run_container" in timings.stages
+
+    def test_timings_not_shared_between_threads(self):
+        """Test that the timings active on one thread are not seen by another."""
+        seen = []
+        with StageTimings("TESTINST").activate():
+            thread = threading.Thread(target=lambda: seen.append(current_timings()))
+            thread.start()
+            thread.join()
+        assert seen == [None]
+
+    def test_log(self):
+        """Test that the timings are logged as JSON on one line."""
+        timings = StageTimings("TESTINST", run_number=123, run_version=2)
+        timings.add("create_records", 0.25)
+
+        with self.assertLogs(stage_timing.logger, "INFO") as logs:
+            timings.log()
+
+        message = logs.records[0].getMessage()
+        assert "\n" not in message
+        logged = json.loads(message[len("Run stage timings "):])
+        assert logged["instrument"] == "TESTINST"
+        assert logged["run_number"] == 123
+        assert logged["run_version"] == 2
+        assert logged["stages"] == {"create_records": 0.25}
+        assert logged["elapsed_seconds"] >= 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""Tests for writing the status transitions of reduction runs."""
+# pylint:disable=no-member
+import threading
+from unittest import mock
+
+from django.db import DatabaseError, connection, transaction
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from autoreduce_db.reduction_viewer.models import ReductionRun, Status
+from autoreduce_qp.queue_processor.status_writer import StatusUpdateWriter
+
+
+# Not wrapped in a transaction, as the writer leaves waiting updates out of the caller's transactions
+class TestStatusUpdateWriter(TransactionTestCase):
+    fixtures = ["status_fixture", "run_with_multiple_variables"]
+
+    def setUp(self):
+        self.reduction_run = ReductionRun.objects.first()
+        self.writer = StatusUpdateWriter(flush_interval=60)
+        self.addCleanup(self.writer.close)
+
+    def copy_run(self) -> ReductionRun:
+        """Create another run with the same fields as the fixture's."""
+        return ReductionRun.objects.create(
+            **{
+                field.attname: getattr(self.reduction_run, field.attname)
+                for field in ReductionRun._meta.concrete_fields if not field.primary_key
+            })
+
+    def test_update_writes_changed_fields(self):
+        """Test that an update sets the fields on the run and writes only those columns."""
+        with CaptureQueriesContext(connection) as queries:
+            self.writer.update(self.reduction_run, status=Status.get_error(), message="failed")
+
+        assert self.reduction_run.status == Status.get_error()
+        updates = [query["sql"] for query in queries.captured_queries if query["sql"].startswith("UPDATE")]
+        assert len(updates) == 1
+        assert "message" in updates[0]
+        assert "reduction_log" not in updates[0]
+        self.reduction_run.refresh_from_db()
+        assert self.reduction_run.status == Status.get_error()
+        assert self.reduction_run.message == "failed"
+
+    def test_update_sets_last_updated(self):
+        """Test that writing an update moves on the time the run was last updated."""
+        last_updated = self.reduction_run.last_updated
+        self.writer.update(self.reduction_run, status=Status.get_error())
+
+        assert ReductionRun.objects.get(pk=self.reduction_run.pk).last_updated > last_updated
+
+    def test_update_behind(self):
+        """Test that updates that don't wait are merged, and written together when flushed."""
+        other_run = self.copy_run()
+        self.writer.update(self.reduction_run, wait=False, status=Status.get_processing())
+        self.writer.update(self.reduction_run, wait=False, status=Status.get_completed(), message="done")
+
+        assert self.writer.pending() == 1
+        assert ReductionRun.objects.get(pk=self.reduction_run.pk).message != "done"
+
+        self.writer.update(other_run, status=Status.get_error())
+
+        assert self.writer.pending() == 0
+        self.reduction_run.refresh_from_db()
+        assert self.reduction_run.status == Status.get_completed()
+        assert self.reduction_run.message == "done"
+        assert ReductionRun.objects.get(pk=other_run.pk).status == Status.get_error()
+
+    def test_update_in_transaction(self):
+        """
+        Test that an update inside a transaction is written as part of it, and
+        the waiting updates of other runs once it has committed.
+        """
+        other_run = self.copy_run()
+        self.writer.update(other_run, wait=False, status=Status.get_processing())
+
+        with transaction.atomic():
+            self.writer.update(self.reduction_run, status=Status.get_completed())
+            assert self.writer.pending() == 1
+            assert ReductionRun.objects.get(pk=self.reduction_run.pk).status == Status.get_completed()
+
+        assert self.writer.pending() == 0
+        assert ReductionRun.objects.get(pk=other_run.pk).status == Status.get_processing()
+
+    def test_update_in_transaction_rolled_back(self):
+        """Test that rolling back a transaction doesn't lose the waiting updates of other runs."""
+        other_run = self.copy_run()
+        status = self.reduction_run.status
+        self.writer.update(other_run, wait=False, status=Status.get_processing())
+
+        with self.assertRaises(DatabaseError), transaction.atomic():
+            self.writer.update(self.reduction_run, status=Status.get_error())
+            raise DatabaseError("rolled back")
+
+        assert ReductionRun.objects.get(pk=self.reduction_run.pk).status == status
+        assert self.writer.pending() == 1
+        self.writer.flush()
+        assert ReductionRun.objects.get(pk=other_run.pk).status == Status.get_processing()
+
+    def test_failed_flush_kept(self):
+        """Test that updates that could not be written are written with the next flush, under newer values."""
+        self.writer.update(self.reduction_run, wait=False, status=Status.get_processing(), message="started")
+        with mock.patch.object(ReductionRun.objects, "filter", side_effect=DatabaseError("gone away")):
+            with self.assertRaises(DatabaseError):
+                self.writer.flush()
+
+        assert self.writer.pending() == 1
+        self.writer.update(self.reduction_run, status=Status.get_completed())
+
+        self.reduction_run.refresh_from_db()
+        assert self.reduction_run.status == Status.get_completed()
+        assert self.reduction_run.message == "started"
+
+    def test_no_flush_interval(self):
+        """Test that every update is written straight away when there is no flush interval."""
+        writer = StatusUpdateWriter(flush_interval=0)
+        writer.update(self.reduction_run, wait=False, status=Status.get_processing())
+
+        assert writer.pending() == 0
+        self.reduction_run.refresh_from_db()
+        assert self.reduction_run.status == Status.get_processing()
+
+    def test_written_behind(self):
+        """Test that an update that doesn't wait is written by the background thread."""
+        writer = StatusUpdateWriter(flush_interval=0.05)
+        self.addCleanup(writer.close)
+        flushed = threading.Event()
+
+        with mock.patch.object(writer, "flush", side_effect=flushed.set) as flush:
+            writer.update(self.reduction_run, wait=False, status=Status.get_error())
+            flush.assert_not_called()
+            assert flushed.wait(5)
+
+    def test_written_behind_at_batch_size(self):
+        """Test that the background thread is woken once enough updates are waiting."""
+        writer = StatusUpdateWriter(flush_interval=60, batch_size=1)
+        self.addCleanup(writer.close)
+        flushed = threading.Event()
+
+        with mock.patch.object(writer, "flush", side_effect=flushed.set):
+            writer.update(self.reduction_run, wait=False, status=Status.get_error())
+            assert flushed.wait(5)
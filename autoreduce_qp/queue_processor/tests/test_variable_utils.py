@@ -9,6 +9,9 @@ Test utility functions for constructing run variables
 """
 
 import datetime
+import os
+import tempfile
+from pathlib import Path
 from unittest.mock import patch
 from parameterized import parameterized
 
@@ -16,6 +19,7 @@ from django.test import TestCase
 
 from autoreduce_db.reduction_viewer.models import ReductionArguments, ReductionRun, ReductionScript
 
+from autoreduce_qp.queue_processor.reduction.service import ReductionScript as ScriptFile
 from autoreduce_qp.queue_processor.variable_utils import VariableUtils as vu
 
 
@@ -49,6 +53,7 @@ class TestVariableUtils(TestCase):
     fixtures = ["status_fixture"]
 
     def setUp(self):
+        vu.clear_cache()
         script = ReductionScript(text="def main(input_file, output_dir): print(123)")
         arguments = ReductionArguments(raw="{}")
         self.reduction_run = ReductionRun(run_version=0,
@@ -151,3 +156,97 @@ class TestVariableUtils(TestCase):
         for _, variables in result.items():
             for var in variables:
                 assert var.help_text == ""
+
+    def test_get_default_variables_cached(self):
+        """
+        Test: The variables are loaded once while reduce_vars.py is unchanged, and
+        again as soon as it changes
+        """
+        with tempfile.TemporaryDirectory() as scripts_dir, \
+                patch("autoreduce_qp.queue_processor.reduction.service.SCRIPTS_DIRECTORY", f"{scripts_dir}/%s"):
+            reduce_vars = Path(scripts_dir, "TESTINSTRUMENT", "reduce_vars.py")
+            reduce_vars.parent.mkdir()
+            # Not a literal, so the script has to be loaded
+            reduce_vars.write_text("standard_vars = {'var1': list(range(2))}", encoding="utf_8")
+
+            with patch("autoreduce_qp.queue_processor.variable_utils.ReductionScript.load",
+                       autospec=True,
+                       side_effect=ScriptFile.load) as load:
+                first = vu.get_default_variables("TESTINSTRUMENT")
+                first["standard_vars"]["var1"].append(3)
+                second = vu.get_default_variables("TESTINSTRUMENT")
+                self.assertEqual(1, load.call_count)
+                self.assertEqual({"var1": [0, 1]}, second["standard_vars"])
+
+                reduce_vars.write_text("standard_vars = {'var1': list(range(4))}", encoding="utf_8")
+                stat = reduce_vars.stat()
+                os.utime(reduce_vars, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+                third = vu.get_default_variables("TESTINSTRUMENT")
+                self.assertEqual(2, load.call_count)
+                self.assertEqual({"var1": [0, 1, 2, 3]}, third["standard_vars"])
+
+    def test_get_default_variables_literal(self):
+        """
+        Test: Variables assigned as literals are read without running the script
+        """
+        with tempfile.TemporaryDirectory() as scripts_dir, \
+                patch("autoreduce_qp.queue_processor.reduction.service.SCRIPTS_DIRECTORY", f"{scripts_dir}/%s"):
+            reduce_vars = Path(scripts_dir, "TESTINSTRUMENT", "reduce_vars.py")
+            reduce_vars.parent.mkdir()
+            reduce_vars.write_text(
+                "import not_a_module\n"
+                "standard_vars = {'var1': 1, 'var2': 'two'}\n"
+                "advanced_vars = {'adv_var1': [1.0, None, True]}\n"
+                "variable_help = {'standard_vars': {'var1': 'help'}}\n",
+                encoding="utf_8")
+
+            with patch("autoreduce_qp.queue_processor.variable_utils.ReductionScript.load") as load:
+                result = vu.get_default_variables("TESTINSTRUMENT", raise_exc=True)
+
+            load.assert_not_called()
+            self.assertEqual(
+                {
+                    "standard_vars": {
+                        "var1": 1,
+                        "var2": "two"
+                    },
+                    "advanced_vars": {
+                        "adv_var1": [1.0, None, True]
+                    },
+                    "variable_help": {
+                        "standard_vars": {
+                            "var1": "help"
+                        }
+                    },
+                }, result)
+
+    @parameterized.expand([
+        ["standard_vars = {'var1': 1}", {
+            "standard_vars": {
+                "var1": 1
+            }
+        }],
+        ["", {}],
+        ["standard_vars = {'var1': VALUE}", None],
+        ["standard_vars = {'var1': 1}\nstandard_vars['var2'] = 2", None],
+        ["standard_vars = {'var1': 1}\nstandard_vars = {'var1': 2}", None],
+        ["from defaults import standard_vars", None],
+        ["from defaults import *", None],
+        ["globals()['standard_vars'] = {}", None],
+        ["standard_vars = {", None],
+    ])
+    def test_literal_variables(self, text, expected):
+        """
+        Test: Only variables that are assigned once as literals, and not used
+        anywhere else, are read without running the script
+        """
+        with tempfile.TemporaryDirectory() as scripts_dir:
+            reduce_vars = Path(scripts_dir, "reduce_vars.py")
+            reduce_vars.write_text(text, encoding="utf_8")
+            self.assertEqual(expected, vu.literal_variables(str(reduce_vars)))
+
+    def test_literal_variables_missing_file(self):
+        """
+        Test: A missing file has no literal variables
+        """
+        self.assertIsNone(vu.literal_variables("/not/a/reduce_vars.py"))
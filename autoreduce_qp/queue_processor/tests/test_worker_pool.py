@@ -0,0 +1,194 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""Tests for the reduction worker pool."""
+import threading
+from unittest import TestCase, main
+
+from autoreduce_qp.queue_processor.worker_pool import ReductionWorkerPool
+
+
+class TestReductionWorkerPool(TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.running = []
+        self.max_running = {}
+
+    def tearDown(self):
+        self.release.set()
+
+    def _blocking_task(self, instrument):
+        """Record that the task is running, then block until released."""
+        with self.lock:
+            self.running.append(instrument)
+            self.max_running[instrument] = max(self.max_running.get(instrument, 0), self.running.count(instrument))
+        self.release.wait(5)
+        with self.lock:
+            self.running.remove(instrument)
+
+    def test_runs_tasks_concurrently(self):
+        """Test that tasks for different instruments run at the same time."""
+        pool = ReductionWorkerPool(max_workers=3, instrument_limit=1)
+        for instrument in ["WISH", "MARI", "GEM"]:
+            pool.submit(instrument, self._blocking_task, instrument)
+
+        self.assertFalse(pool.wait(timeout=0.2))
+        self.assertCountEqual(["WISH", "MARI", "GEM"], self.running)
+        self.assertEqual(3, pool.in_flight())
+
+        self.release.set()
+        self.assertTrue(pool.wait(timeout=5))
+        self.assertEqual(0, pool.in_flight())
+        pool.shutdown()
+
+    def test_instrument_limit(self):
+        """
+        Test that an instrument at its limit does not run more tasks, but does
+        not stop other instruments from using the free workers.
+        """
+        pool = ReductionWorkerPool(max_workers=3, instrument_limit=1)
+        pool.submit("WISH", self._blocking_task, "WISH")
+        pool.submit("WISH", self._blocking_task, "WISH")
+        pool.submit("MARI", self._blocking_task, "MARI")
+
+        pool.wait(timeout=0.2)
+        self.assertCountEqual(["WISH", "MARI"], self.running)
+        self.assertEqual(3, pool.in_flight())
+
+        self.release.set()
+        self.assertTrue(pool.wait(timeout=5))
+        self.assertEqual(1, self.max_running["WISH"])
+        pool.shutdown()
+
+    def test_same_key_runs_in_order(self):
+        """Test that tasks sharing a key run one at a time in submission order."""
+        pool = ReductionWorkerPool(max_workers=4, instrument_limit=4)
+        order = []
+
+        def record(name):
+            with self.lock:
+                self.running.append(name)
+                self.max_running[name[0]] = max(self.max_running.get(name[0], 0),
+                                                sum(1 for running in self.running if running[0] == name[0]))
+            order.append(name)
+            self.release.wait(0.05)
+            with self.lock:
+                self.running.remove(name)
+
+        for i in range(5):
+            pool.submit("WISH", record, f"a{i}", key="a")
+            pool.submit("WISH", record, f"b{i}", key="b")
+
+        self.assertTrue(pool.wait(timeout=5))
+        self.assertEqual([f"a{i}" for i in range(5)], [name for name in order if name[0] == "a"])
+        self.assertEqual([f"b{i}" for i in range(5)], [name for name in order if name[0] == "b"])
+        self.assertEqual(1, self.max_running["a"])
+        self.assertEqual(1, self.max_running["b"])
+        pool.shutdown()
+
+    def test_discard_partitions(self):
+        """Test that pending tasks for a partition are dropped, and running ones are left alone."""
+        pool = ReductionWorkerPool(max_workers=1)
+        pool.submit("WISH", self._blocking_task, "WISH", partition=("data_ready", 0))
+        pool.submit("WISH", self._blocking_task, "WISH", partition=("data_ready", 0))
+        pool.submit("MARI", self._blocking_task, "MARI", partition=("data_ready", 1))
+
+        self.assertEqual([("WISH", )], pool.discard_partitions([("data_ready", 0)]))
+        self.assertEqual(2, pool.in_flight())
+
+        self.release.set()
+        self.assertTrue(pool.wait(timeout=5))
+        pool.shutdown()
+
+    def test_discard_pending(self):
+        """Test that every pending task is dropped, and running ones are left alone."""
+        pool = ReductionWorkerPool(max_workers=1)
+        pool.submit("WISH", self._blocking_task, "WISH")
+        pool.submit("MARI", self._blocking_task, "MARI")
+        pool.submit("GEM", self._blocking_task, "GEM")
+
+        self.assertEqual([("MARI", ), ("GEM", )], pool.discard_pending())
+        self.assertEqual(1, pool.in_flight())
+
+        self.release.set()
+        self.assertTrue(pool.wait(timeout=5))
+        pool.shutdown()
+
+    def test_weighted_fair_queuing(self):
+        """Test that waiting tasks are started in proportion to the weights of their lanes."""
+        pool = ReductionWorkerPool(max_workers=1, lane_weights={"live": 4, "rerun": 1})
+        order = []
+        pool.submit("WISH", self._blocking_task, "WISH")
+        for i in range(6):
+            pool.submit("MARI", order.append, f"rerun{i}", lane="rerun")
+        for i in range(4):
+            pool.submit("GEM", order.append, f"live{i}", lane="live")
+        self.assertEqual(6, pool.in_flight("rerun"))
+        self.assertEqual(4, pool.in_flight("live"))
+
+        self.release.set()
+        self.assertTrue(pool.wait(timeout=5))
+        # Live tasks are started four times as often, even though the reruns were submitted first
+        self.assertEqual(["live0", "live1", "live2", "rerun0", "live3", "rerun1"], order[:6])
+        pool.shutdown()
+
+    def test_set_lane_weight(self):
+        """Test that changing a lane's weight re-orders the tasks already waiting."""
+        pool = ReductionWorkerPool(max_workers=1)
+        order = []
+        pool.submit("WISH", self._blocking_task, "WISH")
+        for i in range(3):
+            pool.submit("MARI", order.append, f"rerun{i}", lane="rerun")
+        for i in range(3):
+            pool.submit("GEM", order.append, f"live{i}", lane="live")
+
+        pool.set_lane_weight("live", 10)
+        self.assertEqual({"live": 10}, pool.lane_weights())
+        self.assertRaises(ValueError, pool.set_lane_weight, "live", 0)
+
+        self.release.set()
+        self.assertTrue(pool.wait(timeout=5))
+        self.assertEqual(["live0", "live1", "live2", "rerun0", "rerun1", "rerun2"], order)
+        pool.shutdown()
+
+    def test_same_key_ordered_across_lanes(self):
+        """Test that a task can't overtake an earlier task with the same key from a slower lane."""
+        pool = ReductionWorkerPool(max_workers=1, lane_weights={"live": 10, "rerun": 1})
+        order = []
+        pool.submit("WISH", self._blocking_task, "WISH")
+        pool.submit("WISH", order.append, "rerun", key="WISH/1", lane="rerun")
+        pool.submit("WISH", order.append, "live", key="WISH/1", lane="live")
+
+        self.release.set()
+        self.assertTrue(pool.wait(timeout=5))
+        self.assertEqual(["rerun", "live"], order)
+        pool.shutdown()
+
+    def test_task_exception_does_not_stop_pool(self):
+        """Test that an exception raised by a task is logged and the pool carries on."""
+        pool = ReductionWorkerPool(max_workers=1)
+        done = []
+
+        def raise_exception():
+            raise RuntimeError("Reduction failed")
+
+        pool.submit("WISH", raise_exception)
+        pool.submit("WISH", done.append, True)
+
+        self.assertTrue(pool.wait(timeout=5))
+        self.assertEqual([True], done)
+        pool.shutdown()
+
+    def test_invalid_worker_count(self):
+        """Test that a pool cannot be made without any workers."""
+        self.assertRaises(ValueError, ReductionWorkerPool, 0)
+
+
+if __name__ == '__main__':
+    main()
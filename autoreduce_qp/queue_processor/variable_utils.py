@@ -6,13 +6,39 @@
 # SPDX - License - Identifier: GPL-3.0-or-later
 # ############################################################################ #
 """Class to deal with reduction run variables."""
+import ast
+import copy
 import logging
+import threading
 import traceback
+from typing import Dict, Optional, Tuple
 
 from autoreduce_qp.queue_processor.reduction.service import ReductionScript
 
 logger = logging.getLogger(__file__)
 
+# The variables loaded from each instrument's reduce_vars.py, with the path,
+# modification time and size of the file they were loaded from
+_DEFAULT_VARIABLES: Dict[str, Tuple[tuple, dict]] = {}
+_DEFAULT_VARIABLES_LOCK = threading.Lock()
+
+VARIABLE_DICTS = ("standard_vars", "advanced_vars", "variable_help")
+
+
+def _used_elsewhere(tree: ast.Module, targets: list) -> bool:
+    """
+    Return whether the variables could be changed anywhere other than their
+    assignments to the given targets.
+    """
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id in VARIABLE_DICTS and node not in targets:
+            return True
+        if isinstance(node, ast.Name) and node.id in ("globals", "vars", "exec", "eval"):
+            return True
+        if isinstance(node, ast.alias) and (node.name == "*" or (node.asname or node.name) in VARIABLE_DICTS):
+            return True
+    return False
+
 
 class VariableUtils:
 
@@ -21,6 +47,13 @@ class VariableUtils:
         """
         Load the variables from the reduction script on disk for the instrument.
 
+        The variables are cached for each instrument, and only loaded again
+        when the path, modification time or size of reduce_vars.py changes.
+        Each call returns a copy, so callers are free to modify it.
+
+        If the variables are assigned as literals they are read without running
+        the script, otherwise the script is imported.
+
         Args:
             instrument_name: The name of the instrument to get the variables for
             raise_exc: If True, re-raise any exception encountered while getting
@@ -48,12 +81,27 @@ class VariableUtils:
         }
         reduce_vars = ReductionScript(instrument_name, script_path=None, module='reduce_vars.py')
 
+        script_path = str(reduce_vars.script_path)
         try:
-            module = reduce_vars.load()
+            stat = reduce_vars.script_path.stat()
+            file_key = (script_path, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            # Let loading the script raise the error
+            file_key = None
+        with _DEFAULT_VARIABLES_LOCK:
+            cached = _DEFAULT_VARIABLES.get(instrument_name)
+        if file_key is not None and cached is not None and cached[0] == file_key:
+            return copy.deepcopy(cached[1])
 
-            for dict_name in ["standard_vars", "advanced_vars", "variable_help"]:
-                if hasattr(module, dict_name):
-                    arguments[dict_name] = getattr(module, dict_name)
+        try:
+            variables = VariableUtils.literal_variables(script_path) if file_key is not None else None
+            if variables is None:
+                module = reduce_vars.load()
+                variables = {name: getattr(module, name) for name in VARIABLE_DICTS if hasattr(module, name)}
+            arguments.update(variables)
+            if file_key is not None:
+                with _DEFAULT_VARIABLES_LOCK:
+                    _DEFAULT_VARIABLES[instrument_name] = (file_key, copy.deepcopy(arguments))
         except (FileNotFoundError, ImportError, SyntaxError):
             if not raise_exc:
                 logger.error(traceback.format_exc())
@@ -64,3 +112,41 @@ class VariableUtils:
             raise
 
         return arguments
+
+    @staticmethod
+    def literal_variables(script_path: str) -> Optional[dict]:
+        """
+        Read the variables from a reduce_vars.py without running it.
+
+        Args:
+            script_path: The path to the reduce_vars.py file.
+
+        Returns:
+            The variables assigned in the file, or None if any of them is not a
+            literal, is assigned more than once or is used elsewhere in the file
+            (e.g. updated after it is assigned), or the file can't be parsed.
+            The file must then be run to get its variables.
+        """
+        try:
+            with open(script_path, encoding="utf_8") as script_file:
+                tree = ast.parse(script_file.read(), filename=script_path)
+        except (OSError, ValueError, SyntaxError):
+            return None
+
+        assignments = [
+            node for node in tree.body if isinstance(node, ast.Assign) and len(node.targets) == 1
+            and isinstance(node.targets[0], ast.Name) and node.targets[0].id in VARIABLE_DICTS
+        ]
+        names = [node.targets[0].id for node in assignments]
+        if len(names) != len(set(names)) or _used_elsewhere(tree, [node.targets[0] for node in assignments]):
+            return None
+        try:
+            return {name: ast.literal_eval(node.value) for name, node in zip(names, assignments)}
+        except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+            return None
+
+    @staticmethod
+    def clear_cache():
+        """Forget the variables loaded for every instrument."""
+        with _DEFAULT_VARIABLES_LOCK:
+            _DEFAULT_VARIABLES.clear()
@@ -0,0 +1,245 @@
+# ############################################################################ #
+# Autoreduction Repository :
+# https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################ #
+"""
+A pool of worker threads used by the consumer to run several reductions at the
+same time, with a cap on how many of them may belong to a single instrument.
+Tasks that share an ordering key are run one at a time in submission order, and
+the workers are shared between lanes by weighted fair queuing.
+"""
+import logging
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Iterable, List, Optional
+
+from django.db import close_old_connections
+
+from autoreduce_qp.queue_processor.lanes import FairQueue
+
+logger = logging.getLogger(__file__)
+
+
+class _Task:
+    """A unit of work waiting for, or running on, a worker thread."""
+
+    def __init__(self, instrument: str, func: Callable, args: tuple, key: Optional[Hashable],
+                 partition: Optional[Hashable], lane: Optional[str]):
+        self.instrument = instrument
+        self.func = func
+        self.args = args
+        self.key = key
+        self.partition = partition
+        self.lane = lane
+        # The virtual time at which the task's lane would have finished it
+        # under fair sharing. Pending tasks are started in order of this tag
+        self.finish_tag = 0.0
+
+
+class ReductionWorkerPool:
+    """
+    Run submitted tasks on a fixed number of worker threads.
+
+    Tasks for an instrument that already has `instrument_limit` tasks running
+    are held back in submission order until one of them finishes, so they do
+    not occupy a worker thread that another instrument could be using.
+
+    Tasks submitted with the same `key` never run at the same time and always
+    start in the order they were submitted, while tasks with different keys run
+    in parallel.
+
+    Each task belongs to a lane. When tasks from several lanes are waiting, the
+    workers are shared between the lanes in proportion to their weights by
+    weighted fair queuing: every task is tagged with the virtual time at which
+    its lane would finish it if each lane were served at a rate equal to its
+    weight, and the waiting task with the earliest tag is started first. A
+    lane that has been idle starts from the current virtual time, so it can't
+    save up a burst of credit.
+    """
+
+    def __init__(self,
+                 max_workers: int = 1,
+                 instrument_limit: Optional[int] = None,
+                 lane_weights: Optional[Dict[str, float]] = None):
+        if max_workers < 1:
+            raise ValueError("The worker pool needs at least one worker")
+
+        self.max_workers = max_workers
+        self.instrument_limit = instrument_limit or max_workers
+        self._fair_queue = FairQueue(lane_weights)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="reduction-worker")
+        self._condition = threading.Condition()
+        self._pending = deque()
+        self._running = defaultdict(int)
+        self._running_lanes = defaultdict(int)
+        self._busy_keys = set()
+        self._active = 0
+
+    def submit(self,
+               instrument: str,
+               func: Callable,
+               *args,
+               key: Optional[Hashable] = None,
+               partition: Optional[Hashable] = None,
+               lane: Optional[str] = None):
+        """
+        Queue `func(*args)` to be run on a worker thread once a worker and the
+        instrument's concurrency allowance are both available.
+
+        Args:
+            instrument: The name of the instrument the task belongs to.
+            func: The callable to run.
+            args: Positional arguments passed to the callable.
+            key: The ordering key. Tasks with the same key are run serially in
+            submission order.
+            partition: The Kafka partition the task was consumed from, used to
+            drop pending tasks when the partition is revoked.
+            lane: The lane the task belongs to. Lanes without a weight have a
+            weight of 1.
+        """
+        with self._condition:
+            task = _Task(instrument, func, args, key, partition, lane)
+            task.finish_tag = self._fair_queue.tag(lane)
+            self._pending.append(task)
+            self._schedule()
+
+    def set_lane_weight(self, lane: str, weight: float):
+        """
+        Change the weight of a lane. The tasks already waiting in the lane are
+        re-tagged, so the new weight takes effect straight away.
+        """
+        with self._condition:
+            if not self._fair_queue.set_weight(lane, weight):
+                return
+            for task in self._pending:
+                if task.lane == lane:
+                    task.finish_tag = self._fair_queue.tag(lane)
+            self._schedule()
+
+    def lane_weights(self) -> Dict[str, float]:
+        """Return the weight of each lane that has been given one."""
+        with self._condition:
+            return dict(self._fair_queue.weights)
+
+    def discard_partitions(self, partitions: Iterable[Hashable]) -> List[tuple]:
+        """
+        Remove the tasks that have not started yet for the given partitions.
+        Tasks that are already running are left to finish.
+
+        Args:
+            partitions: The partitions whose pending tasks should be dropped.
+
+        Returns:
+            The arguments of each discarded task, in submission order.
+        """
+        partitions = set(partitions)
+        with self._condition:
+            discarded = [task for task in self._pending if task.partition in partitions]
+            for task in discarded:
+                self._pending.remove(task)
+            self._condition.notify_all()
+        return [task.args for task in discarded]
+
+    def discard_pending(self) -> List[tuple]:
+        """
+        Remove every task that has not started yet, e.g. when the queue
+        processor is stopping. Tasks that are already running are left to
+        finish.
+
+        Returns:
+            The arguments of each discarded task, in submission order.
+        """
+        with self._condition:
+            discarded = list(self._pending)
+            self._pending.clear()
+            self._condition.notify_all()
+        return [task.args for task in discarded]
+
+    def in_flight(self, lane: Optional[str] = None) -> int:
+        """
+        Return the number of tasks that are either running or waiting to run,
+        in every lane or only in the given one.
+        """
+        with self._condition:
+            if lane is None:
+                return self._active + len(self._pending)
+            return self._running_lanes[lane] + sum(1 for task in self._pending if task.lane == lane)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Block until every submitted task has finished.
+
+        Args:
+            timeout: The maximum number of seconds to wait. Waits forever if None.
+
+        Returns:
+            True if the pool is idle, False if the timeout expired first.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._active == 0 and not self._pending, timeout=timeout)
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stop accepting work and release the worker threads.
+
+        Args:
+            wait: If True, block until the running and pending tasks finish.
+        """
+        if wait:
+            self.wait()
+        self._executor.shutdown(wait=wait)
+
+    def _schedule(self):
+        """
+        Move pending tasks onto the executor, earliest finish tag first, while
+        there are free workers. Must be called with the condition held.
+        """
+        if self._active >= self.max_workers or not self._pending:
+            return
+
+        # Only the earliest pending task of each key may start, so that tasks
+        # with the same key start in submission order whichever lane they are in
+        first_of_key = {}
+        for task in self._pending:
+            if task.key is not None:
+                first_of_key.setdefault(task.key, task)
+
+        for task in sorted(self._pending, key=lambda task: task.finish_tag):
+            if self._active >= self.max_workers:
+                break
+            if task.key is not None and (task.key in self._busy_keys or first_of_key[task.key] is not task):
+                continue
+            if self._running[task.instrument] >= self.instrument_limit:
+                continue
+
+            self._pending.remove(task)
+            self._running[task.instrument] += 1
+            self._running_lanes[task.lane] += 1
+            self._active += 1
+            self._fair_queue.started(task.finish_tag)
+            if task.key is not None:
+                self._busy_keys.add(task.key)
+            self._executor.submit(self._run, task)
+
+    def _run(self, task: _Task):
+        """Run a task on the current worker thread and schedule the next one."""
+        # Each worker thread holds its own database connection, so treat every
+        # task like a Django request and drop connections that have gone stale
+        close_old_connections()
+        try:
+            task.func(*task.args)
+        except Exception:  # pylint:disable=broad-except
+            logger.exception("Unhandled exception in reduction worker for %s", task.instrument)
+        finally:
+            close_old_connections()
+            with self._condition:
+                self._running[task.instrument] -= 1
+                self._running_lanes[task.lane] -= 1
+                self._active -= 1
+                self._busy_keys.discard(task.key)
+                self._schedule()
+                self._condition.notify_all()
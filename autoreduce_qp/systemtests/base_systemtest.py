@@ -23,6 +23,7 @@ from autoreduce_utils.settings import MANTID_PATH, PROJECT_DEV_ROOT
 from autoreduce_qp.queue_processor.confluent_consumer import setup_kafka_connections
 from autoreduce_qp.systemtests.utils.data_archive import DataArchive
 from autoreduce_qp.model.database import access as db
+from autoreduce_qp.model.database import records
 
 REDUCE_SCRIPT = \
     'def main(input_file, output_dir):\n' \
@@ -53,6 +54,9 @@ class BaseAutoreduceSystemTest(TransactionTestCase):
 
     def setUp(self):
         """ Start all external services """
+        # The database is flushed between tests, so nothing cached can be reused
+        db.REFERENCE_CACHE.invalidate()
+        records.invalidate_caches()
         # Get all clients
         try:
             self.publisher, self.consumer = setup_kafka_connections()